@@ -0,0 +1,127 @@
+# Socket I/O for the event-loop engine
+import asyncio
+
+import iostats
+from httpmsg import RecvBuffer, MIN_SEND_RATE
+
+# Buffered counterpart of socket.makefile('rwb') for a non-blocking socket
+# Data is received straight into a reusable RecvBuffer, and reads and writes
+# are awaited on the running event loop instead of blocking
+# idleTimeout: Seconds one receive or send may wait for the peer before TimeoutError
+#              is raised, or None to wait as long as it takes
+class AsyncSocketFile:
+    def __init__(self, sock, idleTimeout=None):
+        self.sock = sock
+        self.loop = asyncio.get_running_loop()
+        self.rbuf = RecvBuffer()
+        self.eof = False
+        # Bytes sent so far
+        self.sent = 0
+        self.idleTimeout = idleTimeout
+        # Whether a receive or send ran out of time; the connection is no use after that
+        self.timedOut = False
+
+    # Await a receive or send, giving up after timeout seconds
+    async def timed(self, aw, timeout):
+        if timeout is None:
+            return await aw
+        try:
+            return await asyncio.wait_for(aw, timeout)
+        except asyncio.TimeoutError:
+            self.timedOut = True
+            raise TimeoutError(f'Peer made no progress in {timeout:.0f}s') from None
+
+    # Number of received bytes not read yet
+    def pending(self):
+        return len(self.rbuf)
+
+    # Receive more data from the socket into the buffer
+    # Returns: False once the peer has closed the connection
+    async def fill(self):
+        if self.eof:
+            return False
+        nbytes = await self.timed(self.loop.sock_recv_into(self.sock, self.rbuf.space()), self.idleTimeout)
+        iostats.count('recv')
+        if nbytes == 0:
+            self.eof = True
+            return False
+        self.rbuf.advance(nbytes)
+        return True
+
+    # Read a request or status line and its headers, up to the blank line
+    # Raises: HeaderTooLarge if the section runs past MAX_HEADER_BYTES
+    # Returns: The header section, or b'' if the peer closed before completing it
+    async def read_head(self):
+        while True:
+            head = self.rbuf.take_head()
+            if head is not None:
+                return head
+            if not await self.fill():
+                return b''
+
+    async def readline(self):
+        while True:
+            line = self.rbuf.take_line()
+            if line is not None:
+                return line
+            if not await self.fill():
+                return self.rbuf.take(len(self.rbuf))
+
+    # Read up to nbytes, returning b'' at EOF
+    async def read(self, nbytes):
+        if not len(self.rbuf):
+            await self.fill()
+        return self.rbuf.take(nbytes)
+
+    # Read up to nbytes without copying them out of the receive buffer
+    # The view is only valid until the next read
+    async def read_view(self, nbytes):
+        if not len(self.rbuf):
+            await self.fill()
+        return self.rbuf.take_view(nbytes)
+
+    async def write(self, data):
+        await self.writev([data])
+
+    # Send several buffers with a single sendmsg() call when the socket has room,
+    # waiting on the event loop only for whatever doesn't fit
+    async def writev(self, buffers):
+        total = sum(len(b) for b in buffers)
+        self.sent += total
+        try:
+            sent = self.sock.sendmsg(buffers)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        iostats.count('send')
+        if sent < total:
+            await self.timed(self.loop.sock_sendall(self.sock, memoryview(b''.join(buffers))[sent:]),
+                             self.idleTimeout)
+            iostats.count('send')
+
+    # Send count bytes of a file from offset with os.sendfile(), so they go from
+    # the page cache to the socket without passing through Python
+    # asyncio falls back to reading and sending the file in chunks on sockets
+    # or platforms that don't support sendfile()
+    async def sendfile(self, file, offset, count):
+        timeout = None if self.idleTimeout is None else self.idleTimeout + count / MIN_SEND_RATE
+        await self.timed(self.loop.sock_sendfile(self.sock, file, offset, count), timeout)
+        iostats.count('sendfile')
+        self.sent += count
+
+    async def flush(self):
+        pass
+
+# Stands in for a client connection when the proxy makes a request on its own
+# behalf, such as a background refresh: whatever is sent to it is dropped
+class NullSocketFile:
+    async def write(self, data):
+        pass
+
+    async def writev(self, buffers):
+        pass
+
+    async def sendfile(self, file, offset, count):
+        pass
+
+    async def flush(self):
+        pass
@@ -0,0 +1,78 @@
+# Benchmark: the disk cache's 'files' layout, one file per response, against
+# its 'segments' layout, responses appended to segment files, on many small objects
+# Each layout stores the objects, reads every one back in random order the way a
+# cache hit does, and is reopened from its journal; the space it takes on disk
+# is counted in allocated blocks, as small files waste most of theirs
+# Usage: python bench_cache.py [objects] [directory]
+# The directory should be on the filesystem the cache would live on; by default
+# a temporary one is used
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from cache import DiskCache, cache_key, read_cached_head
+
+# A stored response: header section and a body of the given size
+def response(i, bodySize):
+    head = (f'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {bodySize}\r\n'
+            f'Cache-Control: max-age=3600\r\nETag: "{i:x}"\r\n\r\n').encode()
+    return head + b'x' * bodySize
+
+# Bytes allocated to every file under a directory, and how many files there are
+def disk_usage(directory):
+    allocated = files = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            allocated += os.stat(os.path.join(dirpath, name)).st_blocks * 512
+            files += 1
+    return allocated, files
+
+def bench(layout, keys, sizes, directory):
+    cacheDir = tempfile.mkdtemp(dir=directory)
+    diskCache = DiskCache(cacheDir, maxEntries=len(keys), layout=layout)
+
+    start = time.perf_counter()
+    for i, key in enumerate(keys):
+        cachef = diskCache.open_entry(key)
+        cachef.write(response(i, sizes[i]))
+        cachef.commit()
+    store = time.perf_counter() - start
+
+    order = list(keys)
+    random.Random(2).shuffle(order)
+    start = time.perf_counter()
+    for key in order:
+        with diskCache.open(key) as cachef:
+            data, headerEnd = read_cached_head(cachef)
+            if len(data) < cachef.size:
+                data += cachef.read()
+    hit = time.perf_counter() - start
+
+    diskCache.close()
+    start = time.perf_counter()
+    diskCache = DiskCache(cacheDir, maxEntries=len(keys), layout=layout)
+    reopen = time.perf_counter() - start
+    assert len(diskCache) == len(keys)
+    diskCache.close()
+    allocated, files = disk_usage(cacheDir)
+    shutil.rmtree(cacheDir)
+    return store, hit, reopen, allocated, files
+
+def main():
+    objects = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    directory = sys.argv[2] if len(sys.argv) > 2 else None
+    keys = [cache_key(f'localhost:5000/objects/{i}') for i in range(objects)]
+    sizes = [random.Random(i).randint(100, 2000) for i in range(objects)]
+    stored = sum(len(response(i, sizes[i])) for i in range(objects))
+    print(f'{objects} objects, {stored / objects:.0f} bytes on average')
+    print(f'{"layout":<10}{"store us/obj":>14}{"hit us/obj":>12}{"reopen ms":>11}{"disk MB":>9}{"files":>8}')
+    for layout in ('files', 'segments'):
+        store, hit, reopen, allocated, files = bench(layout, keys, sizes, directory)
+        print(f'{layout:<10}{store / objects * 1e6:>14.1f}{hit / objects * 1e6:>12.1f}{reopen * 1e3:>11.0f}'
+              f'{allocated / 1e6:>9.1f}{files:>8}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+# Load test: starts an origin, the proxy or one of the tcp/ web servers in
+# processes of their own, waits until each is accepting connections, drives it
+# with concurrent clients for a while and reports requests per second, latency
+# percentiles and the CPU time and memory of every process it started
+# Results can be written as JSON and compared against a stored baseline, so a
+# change that costs throughput or tail latency shows up as a failed run
+# Usage: python bench_load.py [options]; python bench_load.py --help lists them
+# Example: python bench_load.py --targets proxy-event,proxy-blocking --json new.json --baseline base.json
+from socket import *
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+tcpDir = os.path.join(os.path.dirname(here), 'tcp')
+
+ORIGIN_PORT = 5100
+PROXY_PORT = 8890
+TCP_SERVER_PORT = 6790
+# What can be load tested
+# origin: the benchmark origin on its own, to see what the load generator and origin manage without the proxy
+# proxy-event, proxy-blocking: proxy.py in either mode, in front of the benchmark origin
+# tcp-server, tcp-multithreaded: tcp/server.py and tcp/multithreaded_server.py serving HelloWorld.html
+TARGETS = ('origin', 'proxy-event', 'proxy-blocking', 'tcp-server', 'tcp-multithreaded')
+# Percentiles reported, by name
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))
+
+# Origin for the benchmark, much faster than the Flask app.py so it isn't what
+# is being measured: GET /obj/<size>/<name> returns <size> bytes that can be
+# cached for an hour, on keep-alive connections
+# port: Port to listen on
+def run_origin(port):
+    bodies = {}
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                requestLine = head.split(b'\r\n', 1)[0].decode()
+                parts = requestLine.split()[1].split('/')
+                size = int(parts[2]) if len(parts) > 3 and parts[1] == 'obj' and parts[2].isdigit() else 0
+                if size not in bodies:
+                    bodies[size] = b'x' * size
+                close = b'connection: close' in head.lower()
+                writer.write(f'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nContent-Length: {size}\r\n'
+                             f'Cache-Control: max-age=3600\r\n{"Connection: close" if close else ""}\r\n\r\n'.encode()
+                             + bodies[size])
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=SOMAXCONN, reuse_address=True)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+# Command line to start a process serving a target, and the port it listens on
+# cacheDir: Empty cache directory for the proxy
+# layout: Disk cache layout for the proxy
+def server_commands(target, cacheDir, layout):
+    if target == 'origin':
+        return []
+    if target.startswith('proxy-'):
+        mode = target.partition('-')[2]
+        code = f'import proxy; proxy.proxyServer({PROXY_PORT}, {mode!r}, {cacheDir!r}, cacheLayout={layout!r})'
+        return [('proxy', [sys.executable, '-c', code], here, PROXY_PORT)]
+    script = 'server.py' if target == 'tcp-server' else 'multithreaded_server.py'
+    return [(target, [sys.executable, script, str(TCP_SERVER_PORT)], tcpDir, TCP_SERVER_PORT)]
+
+# Wait until something accepts connections on a port
+# process: Popen of the process that should be listening, to give up early if it exits
+# timeout: Seconds to wait
+# Raises: RuntimeError if the process exits or the port isn't listening in time
+def wait_for_port(port, process, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'process listening on {port} exited with status {process.returncode}')
+        try:
+            create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'nothing listening on {port} after {timeout} seconds')
+
+# CPU seconds used so far, and current and peak resident memory in bytes, of a process
+# Returns: (cpu, rss, peakRss), or None where /proc isn't available
+def process_usage(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name in parentheses may contain spaces, so fields are counted after it
+            fields = f.read().rpartition(')')[2].split()
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return cpu, int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+
+# Read a response from a stream: its header section and body, framed by
+# Content-Length, chunked, or by the connection closing
+# Returns: (status: int, bodyBytes: int, closed: bool) where closed is whether
+#          the connection can't carry another request
+async def read_response(reader):
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').lower()
+    status = int(head.split(None, 2)[1])
+    closed = 'connection: close' in head or head.startswith('http/1.0')
+    length = None
+    for line in head.split('\r\n'):
+        name, colon, value = line.partition(':')
+        if name == 'content-length':
+            length = int(value)
+    if length is not None:
+        await reader.readexactly(length)
+        return status, length, closed
+    if 'transfer-encoding: chunked' in head:
+        total = 0
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Trailer fields, up to the blank line
+                while (await reader.readline()) not in (b'\r\n', b''):
+                    pass
+                return status, total, closed
+            await reader.readexactly(size + 2)
+            total += size
+    body = await reader.read()
+    return status, len(body), True
+
+# Paths of a hot set of objects of the benchmark origin
+# objects: Number of objects
+# sizes: Body sizes; there are as many objects of each size
+def hot_paths(objects, sizes):
+    return [f'/obj/{sizes[i % len(sizes)]}/hot{i}' for i in range(objects)]
+
+# The paths a load is made of: a hot set that is requested again and again,
+# and cache misses that are never requested twice
+# hot: Paths of the hot set
+# hitRatio: Share of requests for the hot set
+# sizes: Body sizes to pick from for misses
+# seed: Seed of this mix's choices, which also keeps its misses apart from other mixes'
+class UrlMix:
+    def __init__(self, hot, hitRatio, sizes, seed):
+        self.hot = hot
+        self.hitRatio = hitRatio
+        self.sizes = sizes
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.misses = 0
+
+    def next(self):
+        if self.random.random() < self.hitRatio:
+            return self.random.choice(self.hot)
+        self.misses += 1
+        return f'/obj/{self.random.choice(self.sizes)}/miss{self.seed}-{self.misses}'
+
+# A GET request for a path on the target
+# viaProxy: Whether the target is the proxy, which is asked for the path on the benchmark origin
+# host: Host header to send when the target isn't the proxy
+def request_bytes(path, viaProxy, host, keepAlive):
+    if viaProxy:
+        host = f'127.0.0.1:{ORIGIN_PORT}'
+        path = f'http://{host}{path}'
+    connection = '' if keepAlive else 'Connection: close\r\n'
+    return f'GET {path} HTTP/1.1\r\nHost: {host}\r\n{connection}\r\n'.encode()
+
+# Run one load generator process's clients until the deadline
+# Returns: {'latencies': [seconds], 'errors': int, 'bytes': int, 'statuses': {status: count}}
+def generate_load(host, port, viaProxy, concurrency, keepAlive, deadline, mix):
+    result = {'latencies': [], 'errors': 0, 'bytes': 0, 'statuses': {}}
+
+    async def client():
+        reader = writer = None
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(host, port)
+                writer.write(request_bytes(mix.next(), viaProxy, host, keepAlive))
+                status, nbytes, closed = await read_response(reader)
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                result['errors'] += 1
+                closed = True
+            else:
+                result['latencies'].append(time.perf_counter() - start)
+                result['bytes'] += nbytes
+                result['statuses'][status] = result['statuses'].get(status, 0) + 1
+            if closed or not keepAlive:
+                if writer is not None:
+                    writer.close()
+                reader = writer = None
+        if writer is not None:
+            writer.close()
+
+    async def clients():
+        await asyncio.gather(*(client() for i in range(concurrency)))
+
+    asyncio.run(clients())
+    return result
+
+def generate_load_args(args):
+    return generate_load(*args)
+
+# Value at a percentile of sorted values
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+# Load test one target
+# options: Parsed command line
+# Returns: Results, as they are written to the JSON file
+def bench(target, options):
+    cacheDir = tempfile.mkdtemp()
+    started = []
+    try:
+        commands = server_commands(target, cacheDir, options.layout)
+        if not target.startswith('tcp-'):
+            code = f'import bench_load; bench_load.run_origin({ORIGIN_PORT})'
+            commands.insert(0, ('origin', [sys.executable, '-c', code], here, ORIGIN_PORT))
+        for name, command, cwd, port in commands:
+            # The servers print on every request; that is left out of what is measured
+            process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            started.append((name, process))
+            wait_for_port(port, process)
+
+        host = '127.0.0.1'
+        port = commands[-1][3]
+        viaProxy = target.startswith('proxy-')
+        if target.startswith('tcp-'):
+            # These serve files, and close the connection after each response
+            mixes = [UrlMix(['/HelloWorld.html'], 1.0, [], options.seed + i) for i in range(options.processes)]
+            keepAlive = False
+        else:
+            hot = hot_paths(options.objects, options.sizes)
+            mixes = [UrlMix(hot, options.hit_ratio, options.sizes, options.seed + i) for i in range(options.processes)]
+            keepAlive = options.keep_alive
+            # Fetch the hot set once, so its requests are cache hits from the start
+            for path in hot:
+                sock = create_connection((host, port))
+                sock.sendall(request_bytes(path, viaProxy, host, False))
+                while sock.recv(65536):
+                    pass
+                sock.close()
+
+        before = {name: process_usage(process.pid) for name, process in started}
+        start = time.time()
+        deadline = start + options.duration
+        perProcess = [options.concurrency // options.processes + (i < options.concurrency % options.processes)
+                      for i in range(options.processes)]
+        work = [(host, port, viaProxy, perProcess[i], keepAlive, deadline, mixes[i])
+                for i in range(options.processes) if perProcess[i]]
+        with multiprocessing.Pool(len(work)) as pool:
+            results = pool.map(generate_load_args, work)
+        elapsed = time.time() - start
+        after = {name: process_usage(process.pid) for name, process in started}
+    finally:
+        for name, process in started:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(cacheDir, ignore_errors=True)
+
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    statuses = {}
+    for result in results:
+        for status, count in result['statuses'].items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    processes = {}
+    for name, process in started:
+        if before[name] is None or after[name] is None:
+            continue
+        cpu = after[name][0] - before[name][0]
+        processes[name] = {'cpu_seconds': round(cpu, 3), 'cpu_percent': round(100 * cpu / elapsed, 1),
+                           'rss_mb': round(after[name][1] / 2 ** 20, 1),
+                           'peak_rss_mb': round(after[name][2] / 2 ** 20, 1)}
+    return {'requests': len(latencies), 'errors': sum(result['errors'] for result in results),
+            'statuses': statuses, 'seconds': round(elapsed, 3),
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'mb_per_second': round(sum(result['bytes'] for result in results) / elapsed / 2 ** 20, 2),
+            'latency_ms': {name: round(percentile(latencies, fraction) * 1000, 3) if latencies else None
+                           for name, fraction in PERCENTILES},
+            'processes': processes}
+
+# Compare results against a baseline
+# tolerance: Share throughput may fall, or p99 latency rise, by before it is a regression
+# Returns: [str] describing each regression
+def compare(results, baseline, tolerance):
+    regressions = []
+    for target, result in results.items():
+        base = baseline.get(target)
+        if base is None:
+            continue
+        if result['requests_per_second'] < base['requests_per_second'] * (1 - tolerance):
+            regressions.append(f'{target}: {result["requests_per_second"]} req/s, '
+                               f'baseline {base["requests_per_second"]} req/s')
+        p99, baseP99 = result['latency_ms']['p99'], base['latency_ms']['p99']
+        if p99 is not None and baseP99 is not None and p99 > baseP99 * (1 + tolerance):
+            regressions.append(f'{target}: p99 {p99} ms, baseline {baseP99} ms')
+        if result['errors'] > base['errors']:
+            regressions.append(f'{target}: {result["errors"]} errors, baseline {base["errors"]}')
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load test the proxy and the tcp/ web servers.')
+    parser.add_argument('--targets', default='proxy-event',
+                        help=f'comma-separated targets, of {", ".join(TARGETS)} (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per target (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=50, help='concurrent clients (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=2,
+                        help='load generator processes the clients are spread over (default: %(default)s)')
+    parser.add_argument('--hit-ratio', type=float, default=0.9,
+                        help='share of requests for the hot set, the rest being cache misses (default: %(default)s)')
+    parser.add_argument('--objects', type=int, default=100, help='objects in the hot set (default: %(default)s)')
+    parser.add_argument('--sizes', default='1024,16384,262144',
+                        help='comma-separated object sizes in bytes (default: %(default)s)')
+    parser.add_argument('--keep-alive', action=argparse.BooleanOptionalAction, default=True,
+                        help='reuse client connections (default: on)')
+    parser.add_argument('--layout', default='files', help='disk cache layout for the proxy (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the URL mix (default: %(default)s)')
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--baseline', help='results file to compare against; regressions fail the run')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='share throughput may drop or p99 rise by before it is a regression (default: %(default)s)')
+    options = parser.parse_args(argv)
+    options.targets = options.targets.split(',')
+    for target in options.targets:
+        if target not in TARGETS:
+            parser.error(f'unknown target {target}')
+    options.sizes = [int(size) for size in options.sizes.split(',')]
+    options.processes = max(1, min(options.processes, options.concurrency))
+    return options
+
+def main(argv):
+    options = parse_args(argv)
+    config = {name: value for name, value in vars(options).items() if name not in ('json', 'baseline')}
+    results = {}
+    print(f'{"target":<20}{"req/s":>10}{"MB/s":>8}{"p50 ms":>10}{"p99 ms":>10}{"p999 ms":>10}{"errors":>8}  cpu% / peak rss MB')
+    for target in options.targets:
+        result = results[target] = bench(target, options)
+        # A target with no successful requests has no latencies
+        latency = {name: 'n/a' if ms is None else ms for name, ms in result['latency_ms'].items()}
+        usage = ', '.join(f'{name} {p["cpu_percent"]}% / {p["peak_rss_mb"]}'
+                          for name, p in result['processes'].items())
+        print(f'{target:<20}{result["requests_per_second"]:>10}{result["mb_per_second"]:>8}{latency["p50"]:>10}'
+              f'{latency["p99"]:>10}{latency["p999"]:>10}{result["errors"]:>8}  {usage}')
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        # Targets may be added or left out; the load each one gets has to match
+        differing = [name for name in config if name != 'targets' and baseline['config'].get(name) != config[name]]
+        if differing:
+            print(f'Warning: the baseline was run with different {", ".join(differing)}')
+        regressions = compare(results, baseline['results'], options.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
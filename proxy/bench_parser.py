@@ -0,0 +1,125 @@
+# Microbenchmark: the line-at-a-time header parser the proxy used to have
+# against RecvBuffer + parse_head, on realistic request and response headers
+# Usage: python bench_parser.py [iterations]
+from socket import *
+import io
+import sys
+import time
+
+from httpmsg import RecvBuffer, parse_head
+from proxy import SocketFile, parse_http_headers
+
+REQUEST = (
+    b'GET http://localhost:5000/static/js/app.bundle.js?v=3f2a HTTP/1.1\r\n'
+    b'Host: localhost:5000\r\n'
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n'
+    b'Accept: */*\r\n'
+    b'Accept-Language: en-US,en;q=0.5\r\n'
+    b'Accept-Encoding: gzip, deflate, br\r\n'
+    b'Referer: http://localhost:5000/index.html\r\n'
+    b'Cookie: session=6b1f0e8a2c3d4e5f; theme=dark; _ga=GA1.1.123456789.1700000000\r\n'
+    b'Connection: keep-alive\r\n'
+    b'Sec-Fetch-Dest: script\r\n'
+    b'Sec-Fetch-Mode: no-cors\r\n'
+    b'Sec-Fetch-Site: same-origin\r\n'
+    b'If-None-Match: "5d8c72a5edda8d6a"\r\n'
+    b'\r\n'
+)
+
+RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Server: Werkzeug/3.1.3 Python/3.12.2\r\n'
+    b'Date: Wed, 26 Nov 2025 07:43:56 GMT\r\n'
+    b'Content-Type: application/javascript; charset=utf-8\r\n'
+    b'Content-Length: 48213\r\n'
+    b'Last-Modified: Tue, 25 Nov 2025 18:02:11 GMT\r\n'
+    b'ETag: "5d8c72a5edda8d6b"\r\n'
+    b'Cache-Control: public, max-age=3600\r\n'
+    b'Vary: Accept-Encoding\r\n'
+    b'X-Content-Type-Options: nosniff\r\n'
+    b'Access-Control-Allow-Origin: *\r\n'
+    b'Connection: keep-alive\r\n'
+    b'\r\n'
+)
+
+LOOKUPS = ('Content-Length', 'Host', 'Transfer-Encoding', 'Connection')
+
+# The parser the proxy used before RecvBuffer: one readline() per header line
+# on an unbuffered socket file, then a linear scan per header lookup
+def legacy_parse(sockf):
+    headline = sockf.readline().decode().strip()
+    headers = []
+    while True:
+        header = sockf.readline().decode()
+        if len(header.rstrip('\r\n')) == 0:
+            break
+        headerPartitions = header.partition(':')
+        if headerPartitions[1] == '':
+            continue
+        headers.append((headerPartitions[0].strip(), headerPartitions[2].strip()))
+    return headline, headers
+
+def legacy_lookup(headers, name):
+    for header in headers:
+        if header[0].lower() == name.lower():
+            return header[1]
+    return None
+
+# Parse messages already in memory, so only the parsing itself is timed
+def bench_memory(message, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        headline, headers = legacy_parse(io.BytesIO(message))
+        for name in LOOKUPS:
+            legacy_lookup(headers, name)
+    legacy = time.perf_counter() - start
+
+    rbuf = RecvBuffer()
+    start = time.perf_counter()
+    for i in range(iterations):
+        space = rbuf.space()
+        space[:len(message)] = message
+        rbuf.advance(len(message))
+        headline, headers = parse_head(rbuf.take_head())
+        for name in LOOKUPS:
+            headers.get(name)
+    current = time.perf_counter() - start
+    return legacy, current
+
+# Parse messages arriving on a real socket, so the reads are timed too
+def bench_socket(message, iterations):
+    a, b = socketpair()
+    try:
+        legacyf = b.makefile('rwb', 0)
+        start = time.perf_counter()
+        for i in range(iterations):
+            a.sendall(message)
+            headline, headers = legacy_parse(legacyf)
+            for name in LOOKUPS:
+                legacy_lookup(headers, name)
+        legacy = time.perf_counter() - start
+
+        sockf = SocketFile(b)
+        start = time.perf_counter()
+        for i in range(iterations):
+            a.sendall(message)
+            headline, headers = parse_http_headers(sockf)
+            for name in LOOKUPS:
+                headers.get(name)
+        current = time.perf_counter() - start
+    finally:
+        a.close()
+        b.close()
+    return legacy, current
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f'{"benchmark":<18}{"legacy us/msg":>15}{"current us/msg":>16}{"speedup":>9}')
+    for name, message in (('request', REQUEST), ('response', RESPONSE)):
+        for where, bench in (('memory', bench_memory), ('socket', bench_socket)):
+            legacy, current = bench(message, iterations)
+            print(f'{name + " " + where:<18}{legacy / iterations * 1e6:>15.2f}'
+                  f'{current / iterations * 1e6:>16.2f}{legacy / current:>8.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,811 @@
+# Cache storage shared by the blocking proxy loop and the event-loop engine
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+import hashlib
+import os
+import shutil
+import time
+
+from codings import CODECS, accepted_codings
+from httpmsg import Headers, parse_head, header_block, strip_hop_by_hop, response_body_length, get_header
+from storage import LAYOUTS, COMPACT_BUDGET
+
+# Identity of a cached response: the md5 of its filename (host and path)
+# Every cache tier is keyed by this, so an entry means the same thing in all of them
+# filename: Filename from request_filename(), e.g. 'localhost:5000/test'
+def cache_key(filename):
+    return hashlib.md5(filename.encode()).hexdigest()
+
+# Most variants of one URL stored at a time; storing another removes the one
+# stored least recently, so a header with endless values can't fill the cache
+MAX_VARIANTS = 8
+
+# Request headers a response varies on (RFC 9110 12.5.5)
+# headers: Headers of the response
+# Returns: Lower-case header names, sorted, or ('*',) if it varies on more than
+#          request headers and no stored copy can ever be selected
+def vary_names(headers):
+    names = {name.strip().lower() for name in (get_header(headers, 'Vary') or '').split(',') if name.strip()}
+    if '*' in names:
+        return ('*',)
+    return tuple(sorted(names))
+
+# Value of a request header as it goes into a secondary cache key, normalized
+# so that requests differing only in case or spacing select the same variant
+# Accept-Encoding is cut down to the codings the proxy can't decode itself:
+# a response in any of the others can be sent to every client, so a gzip
+# client and an identity client share a variant
+# requestHeaders: Headers of the request
+# name: Lower-case header name, from vary_names()
+def vary_value(requestHeaders, name):
+    if name == 'accept-encoding':
+        codings = accepted_codings(requestHeaders)
+        return ','.join(sorted(coding for coding, q in codings.items()
+                               if q > 0 and coding not in CODECS and coding not in ('identity', 'x-gzip')))
+    value = get_header(requestHeaders, name) or ''
+    return ','.join(part.strip() for part in value.lower().split(','))
+
+# Key of the variant of a URL's response that a request selects (RFC 9111 4.1)
+# key: cache_key() of the URL
+# names: Request headers the response varies on, from vary_names()
+# requestHeaders: Headers of the request
+# Returns: The variant's key, or key itself if the response doesn't vary
+def variant_key(key, names, requestHeaders):
+    if not names:
+        return key
+    secondary = '\n'.join(f'{name}: {vary_value(requestHeaders, name)}' for name in names)
+    return cache_key(f'{key}\n{secondary}')
+
+# Read the start of a cache file, at least up to the end of its header section
+# cachef: Cache file opened for reading, positioned at the start
+# blockSize: How much to read at a time
+# Returns: (data: bytes, headerEnd: int) the bytes read, and the offset of the body
+def read_cached_head(cachef, blockSize=65536):
+    data = cachef.read(blockSize)
+    while True:
+        end = data.find(b'\r\n\r\n')
+        if end >= 0:
+            return data, end + 4
+        more = cachef.read(blockSize)
+        if not more:
+            return data, len(data)
+        data += more
+
+# Read the header section of a stored response
+# cachef: Stored response from DiskCache.open(), which is closed again
+# Returns: The header section without its blank line
+def read_stored_head(cachef):
+    with cachef:
+        data, headerEnd = read_cached_head(cachef)
+    return data[:headerEnd - 4]
+
+# Header section to send a stored response with
+# Hop-by-hop headers are dropped and a Content-Length is filled in for bodies
+# stored without framing, so the response can go out on a kept-alive connection
+# head: Stored header section without its blank line
+# bodySize: Size of the stored body
+# keepAlive: Which Connection header to add, or None to add none
+def cached_head(head, bodySize, keepAlive=None):
+    statusLine, headers = parse_head(head)
+    headers = strip_hop_by_hop(headers)
+    if response_body_length('GET', statusLine, headers) is None:
+        headers.append(('Content-Length', str(bodySize)))
+    if keepAlive is not None:
+        headers.append(('Connection', 'keep-alive' if keepAlive else 'close'))
+    return header_block(statusLine, headers)
+
+# Turn a stored response into a memory cache entry
+# data: Complete response as stored in a cache file
+# Returns: (data: bytes, headerEnd: int) with data[:headerEnd] the header
+#          section from cached_head(), without a Connection header
+def make_entry(data):
+    end = data.find(b'\r\n\r\n')
+    body = data[end + 4:]
+    head = cached_head(data[:end], len(body))
+    return head + body, len(head)
+
+# Buffers that send a memory cache entry with the given Connection header, for
+# a single sendmsg(); the entry itself is never copied
+# entry: (data: bytes, headerEnd: int) from make_entry()
+# keepAlive: Whether the client connection stays open after this response
+def entry_buffers(entry, keepAlive):
+    data, headerEnd = entry
+    view = memoryview(data)
+    connectionHeader = b'Connection: keep-alive\r\n\r\n' if keepAlive else b'Connection: close\r\n\r\n'
+    # The header section minus its final CRLF, our Connection header, then the body
+    return [view[:headerEnd - 2], connectionHeader, view[headerEnd:]]
+
+# Most ranges one request may ask for; a Range header with more is ignored and
+# the whole response sent, so a request can't make the proxy send thousands of parts
+MAX_RANGES = 16
+
+# Parse a Range header against a body of a known size (RFC 9110 14.1.2)
+# value: Range header value, e.g. 'bytes=0-99,200-' or 'bytes=-500'
+# size: Size of the body
+# Returns: [(first, last)] inclusive byte positions of the satisfiable ranges,
+#          which may be none, or None if the header is invalid and must be ignored
+def parse_range(value, size):
+    unit, equals, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not equals:
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or not (first.isdigit() or first == '') or not (last.isdigit() or last == ''):
+            return None
+        if first == '':
+            # The last n bytes
+            if last == '':
+                return None
+            if int(last) > 0 and size > 0:
+                ranges.append((max(0, size - int(last)), size - 1))
+        else:
+            if last != '' and int(last) < int(first):
+                return None
+            if int(first) < size:
+                ranges.append((int(first), min(int(last), size - 1) if last != '' else size - 1))
+    return ranges
+
+# Check an If-Range precondition against a stored response (RFC 9110 13.1.5)
+# A range is only sent if the stored response is the one the client already
+# has part of, which takes a strong validator to tell
+# ifRange: If-Range header value, an entity tag or an HTTP-date
+# headers: Headers of the stored response
+def if_range_matches(ifRange, headers):
+    ifRange = ifRange.strip()
+    if ifRange.startswith('W/'):
+        return False
+    if ifRange.startswith('"'):
+        return get_header(headers, 'ETag') == ifRange
+    lastModified = http_date(get_header(headers, 'Last-Modified'))
+    return lastModified is not None and lastModified == http_date(ifRange)
+
+# Work out which byte ranges of a stored response a request asks for
+# head: Stored header section without its blank line
+# bodySize: Size of the stored body
+# requestHeaders: Headers of the request
+# Returns: [(first, last)] as from parse_range(), or None to send the whole
+#          response: no or an invalid Range, not a 200, or a failed If-Range
+def requested_ranges(head, bodySize, requestHeaders):
+    rangeHeader = get_header(requestHeaders, 'Range')
+    if rangeHeader is None:
+        return None
+    statusLine, headers = parse_head(head)
+    if statusLine.split()[1] != '200':
+        return None
+    ifRange = get_header(requestHeaders, 'If-Range')
+    if ifRange is not None and not if_range_matches(ifRange, headers):
+        return None
+    return parse_range(rangeHeader, bodySize)
+
+# Partial response for byte ranges of a stored response: a 206 with the range,
+# a 206 multipart/byteranges with a part per range, or a 416 if none is satisfiable
+# The body is described rather than built, so the ranges can be sent straight
+# from the cache file without reading them into memory
+# head: Stored header section without its blank line
+# ranges: [(first, last)] from requested_ranges()
+# bodySize: Size of the stored body
+# keepAlive: Which Connection header to add, or None to add none
+# Returns: (header section: bytes, parts) where each part is either bytes to
+#          send as they are, or (offset, count) of a range of the stored body
+def range_response(head, ranges, bodySize, keepAlive=None):
+    statusLine, headers = parse_head(head)
+    version = statusLine.split()[0]
+    headers = [h for h in strip_hop_by_hop(headers)
+               if h[0].lower() not in ('content-length', 'content-range', 'transfer-encoding')]
+    if not ranges:
+        status = '416 Range Not Satisfiable'
+        headers += [('Content-Range', f'bytes */{bodySize}'), ('Content-Length', '0')]
+        parts = []
+    elif len(ranges) == 1:
+        status = '206 Partial Content'
+        first, last = ranges[0]
+        headers += [('Content-Range', f'bytes {first}-{last}/{bodySize}'), ('Content-Length', str(last - first + 1))]
+        parts = [(first, last - first + 1)]
+    else:
+        status = '206 Partial Content'
+        boundary = os.urandom(12).hex()
+        contentType = get_header(headers, 'Content-Type')
+        headers = [h for h in headers if h[0].lower() != 'content-type']
+        parts = []
+        for first, last in ranges:
+            partHead = f'\r\n--{boundary}\r\n'
+            if contentType is not None:
+                partHead += f'Content-Type: {contentType}\r\n'
+            partHead += f'Content-Range: bytes {first}-{last}/{bodySize}\r\n\r\n'
+            parts += [partHead.encode('latin-1'), (first, last - first + 1)]
+        parts.append(f'\r\n--{boundary}--\r\n'.encode('latin-1'))
+        length = sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+        headers += [('Content-Type', f'multipart/byteranges; boundary={boundary}'), ('Content-Length', str(length))]
+    if keepAlive is not None:
+        headers.append(('Connection', 'keep-alive' if keepAlive else 'close'))
+    return header_block(f'{version} {status}', headers), parts
+
+# Freshness lifetime given to responses that have no explicit expiry and no
+# Last-Modified header to base a heuristic on
+DEFAULT_TTL = 300
+# Cap on the heuristic freshness lifetime worked out from Last-Modified
+MAX_HEURISTIC_TTL = 24 * 3600
+# Status codes a response may be stored for without explicit freshness (RFC 9110 15.1)
+HEURISTICALLY_CACHEABLE = {'200', '203', '204', '300', '301', '308', '404', '405', '410', '414', '501'}
+# Origin statuses a stale response may stand in for under stale-if-error (RFC 5861 4)
+SERVER_ERRORS = {'500', '502', '503', '504'}
+# Stale windows for responses that don't give their own, in seconds: none is served
+# stale while it is revalidated unless it asks for it, but any may be when the origin is down
+STALE_WHILE_REVALIDATE = 0
+STALE_IF_ERROR = 600
+# Missing resources, which are negatively cached like server errors
+NOT_FOUND = {'404', '410'}
+# How long errors without an explicit expiry are cached, in seconds, by class:
+# missing resources, server errors, and origins that can't be connected to
+# (which have no response to store, so the origin itself is remembered instead)
+NEGATIVE_TTLS = {'not-found': 60, 'server-error': 5, 'connect': 5}
+# Request headers the proxy replaces with its own validators when revalidating
+CONDITIONAL_HEADERS = {'if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since'}
+# Request headers that ask for part of a response, which the proxy serves from
+# the stored response itself rather than asking the origin for
+RANGE_HEADERS = {'range', 'if-range'}
+
+# Split a Cache-Control header into its directives
+# Returns: {directive: str (lower case): argument: str or None}
+def cache_control(headers):
+    directives = {}
+    for directive in (get_header(headers, 'Cache-Control') or '').split(','):
+        name, equals, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') if equals else None
+    return directives
+
+# Parse an HTTP-date into a Unix time
+# Returns: The time, or None if the date is missing or invalid
+def http_date(value):
+    if value is None:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+# Work out until when a response may be served from the cache without revalidating
+# (RFC 9111 4.2). Explicit freshness (s-maxage, max-age, Expires) wins; otherwise
+# errors get their negative TTL, and other responses a tenth of the time since
+# Last-Modified, or DEFAULT_TTL
+# statusLine: Status line of the response
+# headers: Headers of the response
+# requestHeaders: Headers of the request it answers, or None
+# now: Current Unix time, or None for time.time()
+# negativeTtls: TTLs by error class, as in NEGATIVE_TTLS
+# Returns: Unix time the response goes stale at, or None if it mustn't be stored
+def response_expiry(statusLine, headers, requestHeaders=None, now=None, negativeTtls=NEGATIVE_TTLS):
+    now = time.time() if now is None else now
+    status = statusLine.split()[1] if len(statusLine.split()) > 1 else ''
+    directives = cache_control(headers)
+    # A shared cache can't store private responses, nor partial or not-modified ones
+    if 'no-store' in directives or 'private' in directives or status in ('206', '304'):
+        return None
+    # Vary: * can never be matched by a later request
+    if vary_names(headers) == ('*',):
+        return None
+    if requestHeaders is not None:
+        if 'no-store' in cache_control(requestHeaders):
+            return None
+        # Responses to authenticated requests are per user unless marked otherwise
+        if get_header(requestHeaders, 'Authorization') is not None and not (
+                'public' in directives or 's-maxage' in directives or 'must-revalidate' in directives):
+            return None
+
+    date = http_date(get_header(headers, 'Date')) or now
+    try:
+        age = max(0, int(get_header(headers, 'Age') or 0))
+    except ValueError:
+        age = 0
+
+    if 'no-cache' in directives:
+        lifetime = 0
+    elif 's-maxage' in directives or 'max-age' in directives:
+        try:
+            lifetime = int(directives['s-maxage'] if 's-maxage' in directives else directives['max-age'])
+        except (TypeError, ValueError):
+            lifetime = 0
+    elif get_header(headers, 'Expires') is not None:
+        # An invalid Expires means already expired
+        expires = http_date(get_header(headers, 'Expires'))
+        lifetime = expires - date if expires is not None else 0
+    elif status in NOT_FOUND:
+        lifetime = negativeTtls['not-found']
+    elif status in SERVER_ERRORS:
+        # Briefly, so a failing origin isn't asked again by every request
+        lifetime = negativeTtls['server-error']
+    elif status in HEURISTICALLY_CACHEABLE or 'public' in directives:
+        lastModified = http_date(get_header(headers, 'Last-Modified'))
+        if lastModified is not None:
+            lifetime = min(MAX_HEURISTIC_TTL, max(0, (date - lastModified) / 10))
+        else:
+            lifetime = DEFAULT_TTL
+    else:
+        return None
+    return now + max(0, lifetime) - age
+
+# How long after it expires a stored response may still be served (RFC 5861)
+# stale-while-revalidate: served at once while it is revalidated in the background
+# stale-if-error: served when revalidating it fails
+# storedHead: Stored header section
+# staleWhileRevalidate: Window used when the response doesn't give one
+# staleIfError: Window used when the response doesn't give one
+# Returns: (staleWhileRevalidate: seconds, staleIfError: seconds), both 0 for
+#          responses that must be revalidated before they are served again
+def stale_windows(storedHead, staleWhileRevalidate=0, staleIfError=0):
+    statusLine, headers = parse_head(storedHead)
+    directives = cache_control(headers)
+    # s-maxage implies proxy-revalidate for shared caches (RFC 9111 5.2.2.10)
+    if {'must-revalidate', 'proxy-revalidate', 's-maxage', 'no-cache'} & directives.keys():
+        return 0, 0
+    windows = []
+    for name, default in (('stale-while-revalidate', staleWhileRevalidate), ('stale-if-error', staleIfError)):
+        try:
+            windows.append(int(directives[name]) if name in directives else default)
+        except (TypeError, ValueError):
+            windows.append(default)
+    return windows[0], windows[1]
+
+# Validators to revalidate a stored response with (RFC 9111 4.3.1)
+# storedHead: Stored header section
+# Returns: [(header: str, header_value: str)] If-None-Match and/or If-Modified-Since,
+#          empty if the response has neither an ETag nor a Last-Modified
+def stored_validators(storedHead):
+    statusLine, headers = parse_head(storedHead)
+    validators = []
+    if headers.get('ETag') is not None:
+        validators.append(('If-None-Match', headers.get('ETag')))
+    if headers.get('Last-Modified') is not None:
+        validators.append(('If-Modified-Since', headers.get('Last-Modified')))
+    return validators
+
+# Request headers for revalidating a stored response: the client's, with its
+# own conditionals replaced by the stored response's validators
+# Any Range is dropped too, so that a changed response comes back whole and can be stored
+# requestHeaders: Headers of the client request
+# validators: From stored_validators()
+def revalidation_headers(requestHeaders, validators):
+    return [h for h in requestHeaders
+            if h[0].lower() not in CONDITIONAL_HEADERS and h[0].lower() not in RANGE_HEADERS] + validators
+
+# Expiry of a stored response after a 304 Not Modified, whose headers update
+# the stored ones (RFC 9111 4.3.4)
+# storedHead: Stored header section
+# headers: Headers of the 304 response
+# requestHeaders: Headers of the request that was revalidated
+# Returns: As for response_expiry()
+def refreshed_expiry(storedHead, headers, requestHeaders=None):
+    statusLine, storedHeaders = parse_head(storedHead)
+    updated = {h[0].lower() for h in headers}
+    merged = Headers([h for h in storedHeaders if h[0].lower() not in updated] + list(headers))
+    return response_expiry(statusLine, merged, requestHeaders)
+
+# In-memory LRU of complete responses in front of the disk cache
+# Entries are promoted from disk when they are hit there, so URLs that are
+# only requested once never take up memory
+# budget: Most bytes of entries held in total
+# maxEntrySize: Biggest response that is held; bigger ones are always sent from disk
+class MemoryCache:
+    def __init__(self, budget=64 * 1024 * 1024, maxEntrySize=256 * 1024):
+        self.budget = budget
+        self.maxEntrySize = maxEntrySize
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Look up an entry, marking it most recently used
+    # Returns: (data: bytes, headerEnd: int), or None
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    # Add an entry, evicting least recently used ones to stay within budget
+    # Returns: False if the entry is too big to be held
+    def put(self, key, entry):
+        if len(entry[0]) > self.maxEntrySize:
+            return False
+        self.discard(key)
+        self.entries[key] = entry
+        self.size += len(entry[0])
+        while self.size > self.budget:
+            oldKey, oldEntry = self.entries.popitem(last=False)
+            self.size -= len(oldEntry[0])
+            self.evictions += 1
+        return True
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+# Count-min sketch of how often each key has been requested, for TinyLFU admission
+# Counters saturate at 15, and every sampleSize increments all of them are
+# halved, so keys that were popular a long time ago lose their advantage
+# width: Counters per row, a power of two
+# depth: Rows, each indexed by a different 32-bit slice of the md5 key
+class FrequencySketch:
+    HALVE = bytes(i >> 1 for i in range(256))
+
+    def __init__(self, width=65536, depth=4):
+        self.mask = width - 1
+        self.rows = [bytearray(width) for i in range(depth)]
+        self.sampleSize = 10 * width
+        self.additions = 0
+
+    def indexes(self, key):
+        h = int(key, 16)
+        return [(h >> (32 * i)) & self.mask for i in range(len(self.rows))]
+
+    def increment(self, key):
+        for row, i in zip(self.rows, self.indexes(key)):
+            if row[i] < 15:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sampleSize:
+            self.rows = [row.translate(self.HALVE) for row in self.rows]
+            self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self.indexes(key)))
+
+# Bounded disk cache of response files under cacheDir
+# Which keys are stored, and their sizes, is tracked in memory, so lookups need
+# no stat() and eviction never scans the directory. Eviction is segmented LRU:
+# new entries go on probation and move to the protected segment when hit again.
+# When the cache is full a new entry is only admitted (TinyLFU) if it has been
+# requested more often than the entry it would push out, so one-off URLs can't
+# flush out popular ones
+# The index survives restarts in an append-only journal, cacheDir/index: one
+# line per entry added or removed. Startup replays it without touching the
+# cache files, and once it has grown to twice the live entries it is rewritten
+# as a checkpoint of just those, in LRU order. Files still being written live
+# in cacheDir/tmp until they are renamed into place, and are cleared at startup
+# Each entry's expiry from response_expiry() is kept in the index too, so a
+# freshness check costs no file read and a 304 updates it without rewriting the file
+# With the 'segments' layout the index also says where in which segment each
+# entry is, and compact() journals the entries it moves
+# Prefork workers can share one cacheDir with the 'files' layout. Each keeps an
+# index and journal (cacheDir/index.<worker>) and tmp directory of its own, and
+# a miss that finds a file another worker stored takes it into its index. A
+# stored file is only ever replaced by a rename and a worker that finds one gone
+# forgets it, so workers evicting each other's entries is safe; each one's
+# maxBytes only bounds the entries it knows of
+# cacheDir: Directory holding the cache files
+# maxBytes: Most bytes of cache files kept
+# maxEntries: Most cache files kept
+# protectedShare: Share of maxBytes the protected segment may take up
+# maxVariants: Most variants of one URL kept
+# layout: How responses are stored, a name in storage.LAYOUTS: 'files' or 'segments'
+# worker: Number of the prefork worker this is, if several share cacheDir, or None
+class DiskCache:
+    def __init__(self, cacheDir, maxBytes=1024 * 1024 * 1024, maxEntries=100000, protectedShare=0.8,
+                 maxVariants=MAX_VARIANTS, layout='files', worker=None):
+        if worker is not None and layout != 'files':
+            # Segment entries can only be found through the journal of the worker that wrote them
+            raise ValueError(f"the '{layout}' layout can't be shared between workers")
+        self.cacheDir = cacheDir
+        self.worker = worker
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.maxVariants = maxVariants
+        self.protectedBytes = int(maxBytes * protectedShare)
+        # key -> size, least recently used first
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.size = 0
+        self.protectedSize = 0
+        # key -> Unix time the entry goes stale at
+        self.expires = {}
+        self.sketch = FrequencySketch(max(1024, 1 << (4 * maxEntries - 1).bit_length()))
+        # Keys whose cache file is being written
+        self.writing = set()
+        # URL key -> request headers its responses vary on, from vary_names()
+        self.varies = {}
+        # URL key -> keys of its stored variants, least recently stored first
+        self.variants = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+
+        os.makedirs(cacheDir, exist_ok=True)
+        if worker is None:
+            self.indexPath = os.path.join(cacheDir, 'index')
+            self.tmpDir = os.path.join(cacheDir, 'tmp')
+        else:
+            self.indexPath = os.path.join(cacheDir, f'index.{worker}')
+            self.tmpDir = os.path.join(cacheDir, 'tmp', str(worker))
+        # Anything left in tmp was being written when the proxy (or this worker) last stopped
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+        os.makedirs(self.tmpDir)
+        # Where the stored responses themselves are kept: a file each, or in segments
+        self.store = LAYOUTS[layout](cacheDir, self.tmpDir)
+        self.journalLines = 0
+        self.journal = None
+        self.load()
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
+
+    # Path of the file a stored response is in
+    def path(self, key):
+        return self.store.path(key)
+
+    # Open a stored response for reading
+    # Raises: FileNotFoundError if it isn't stored, or its file has gone
+    # Returns: A StoredFile, to be closed once the response has been read
+    def open(self, key):
+        return self.store.open(key)
+
+    # Key a request's response is stored under: the URL's own key, or the key of
+    # the variant the request selects if the URL's responses vary
+    # key: cache_key() of the URL
+    # requestHeaders: Headers of the request
+    def select(self, key, requestHeaders):
+        names = self.varies.get(key)
+        return variant_key(key, names, requestHeaders) if names else key
+
+    # Work out where to store a response, recording which request headers the
+    # URL's responses vary on. If that has changed, whatever was stored for the
+    # URL can't be selected any more and is removed
+    # key: cache_key() of the URL
+    # names: Request headers the response varies on, from vary_names()
+    # requestHeaders: Headers of the request the response answers
+    # Returns: Key to store the response under
+    def store_key(self, key, names, requestHeaders):
+        if names != self.varies.get(key, ()):
+            for variant in self.variants.pop(key, ()):
+                self.remove(variant)
+            self.remove(key)
+            self.set_varies(key, names)
+            self.log(f'~ {key} {",".join(names) or "-"}\n')
+        if not names:
+            return key
+        variant = variant_key(key, names, requestHeaders)
+        self.add_variant(key, variant)
+        self.log(f'> {key} {variant}\n')
+        return variant
+
+    # Record the request headers a URL's responses vary on, in memory only
+    def set_varies(self, key, names):
+        self.variants.pop(key, None)
+        if names:
+            self.varies[key] = names
+        else:
+            self.varies.pop(key, None)
+
+    # Record that a variant of a URL was stored, in memory only, removing the
+    # least recently stored variants beyond maxVariants
+    def add_variant(self, key, variant):
+        variants = self.variants.setdefault(key, OrderedDict())
+        variants[variant] = None
+        variants.move_to_end(variant)
+        while len(variants) > self.maxVariants:
+            self.remove(variants.popitem(last=False)[0])
+
+    # Record a request for a key and check whether it is stored
+    # A hit moves an entry on probation to the protected segment
+    def lookup(self, key):
+        self.sketch.increment(key)
+        if key in self.protected:
+            self.protected.move_to_end(key)
+        elif key in self.probation:
+            size = self.probation.pop(key)
+            self.protected[key] = size
+            self.protectedSize += size
+            # Demote the protected segment's least recently used entries back to probation
+            while self.protectedSize > self.protectedBytes and len(self.protected) > 1:
+                oldKey, oldSize = self.protected.popitem(last=False)
+                self.protectedSize -= oldSize
+                self.probation[oldKey] = oldSize
+        elif self.worker is None or not self.adopt(key):
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    # Take a response another worker stored into the index, if its file is there
+    # Its expiry is worked out again from its header section, as of when the file was written
+    # Returns: Whether there was one
+    def adopt(self, key):
+        if key in self.writing:
+            return False
+        try:
+            cachef = self.store.open(key)
+            size = cachef.size
+            written = os.fstat(cachef.file.fileno()).st_mtime
+            statusLine, headers = parse_head(read_stored_head(cachef))
+        except FileNotFoundError:
+            return False
+        self.add(key, size, response_expiry(statusLine, headers, now=written) or 0)
+        return key in self.probation
+
+    # Check whether a stored entry can be served without revalidating it
+    def fresh(self, key, now=None):
+        return self.expires.get(key, 0) > (time.time() if now is None else now)
+
+    # Seconds since a stored entry expired; negative while it is still fresh
+    def staleness(self, key, now=None):
+        return (time.time() if now is None else now) - self.expires.get(key, 0)
+
+    # Give a stored entry a new expiry, after the origin said it is unchanged
+    def refresh(self, key, expires):
+        if key in self.expires:
+            self.expires[key] = expires
+            self.log(f'= {key} {int(expires)}\n')
+
+    # Entry that the next eviction would remove, or None if the cache is empty
+    def victim(self):
+        for segment in (self.probation, self.protected):
+            for key in segment:
+                return key
+        return None
+
+    # Start storing the response for a key that missed or is being replaced
+    # expires: Unix time the response goes stale at, from response_expiry()
+    # Returns: A CacheFile to write the response to, or None if it isn't admitted
+    #          or another request is already storing it
+    def open_entry(self, key, expires=0):
+        if key in self.writing:
+            return None
+        # A new copy of a stored entry takes its place, so it needn't be admitted
+        if key not in self.expires and (len(self) >= self.maxEntries or self.size >= self.maxBytes):
+            victim = self.victim()
+            if victim is not None and self.sketch.estimate(key) <= self.sketch.estimate(victim):
+                self.rejections += 1
+                return None
+        self.writing.add(key)
+        return self.store.create(key, lambda size, location=None: self.close_entry(key, size, expires, location))
+
+    # Called when a CacheFile from open_entry() is committed or aborted
+    # location: Where the layout put the response, if it needs to be told again after a restart
+    def close_entry(self, key, size, expires=0, location=None):
+        self.writing.discard(key)
+        if size is not None:
+            self.add(key, size, expires, location)
+
+    # Add a committed cache file, evicting entries until the limits hold again
+    # Each eviction is one unlink() of a known file, so the cost is spread over inserts
+    def add(self, key, size, expires=0, location=None):
+        self.remove(key, unlink=False)
+        self.store.place(key, location, size)
+        if size > self.maxBytes:
+            self.store.forget(key)
+            self.store.delete(key)
+            return
+        self.probation[key] = size
+        self.size += size
+        self.expires[key] = expires
+        self.log(f'+ {key} {size} {int(expires)}{self.store.where(key)}\n')
+        while self.size > self.maxBytes or len(self) > self.maxEntries:
+            victim = self.victim()
+            self.remove(victim)
+            self.evictions += 1
+
+    # Forget an entry, deleting its file unless told not to
+    def remove(self, key, unlink=True):
+        if key not in self.probation and key not in self.protected:
+            return
+        self.forget(key)
+        self.log(f'- {key}\n')
+        if unlink:
+            try:
+                self.store.delete(key)
+            except FileNotFoundError:
+                pass
+
+    # Take a step of compacting the layout's storage, if it needs any, journaling
+    # where the responses it moves are now
+    # Returns: Whether there was anything to compact, so another step may be due
+    def compact(self, budget=COMPACT_BUDGET):
+        return self.store.compact(lambda key: self.log(f'@ {key}{self.store.where(key)}\n'), budget)
+
+    # Rebuild the index from the journal left by the last run
+    # Lines are applied in order; a torn last line from a crash is skipped
+    def load(self):
+        try:
+            with open(self.indexPath, 'rb') as f:
+                lines = f.read().decode('ascii', 'replace').split('\n')
+        except FileNotFoundError:
+            lines = []
+        for line in lines:
+            fields = line.split()
+            try:
+                if fields[0] == '-' and len(fields) == 2:
+                    self.forget(fields[1])
+                elif fields[0] == '=' and len(fields) == 3:
+                    if fields[1] in self.expires:
+                        self.expires[fields[1]] = int(fields[2])
+                elif fields[0] == '@' and len(fields) == 4:
+                    # Moved by a compaction
+                    key = fields[1]
+                    if key in self.expires:
+                        size = self.probation[key] if key in self.probation else self.protected[key]
+                        self.store.place(key, (int(fields[2]), int(fields[3])), size)
+                elif fields[0] == '~' and len(fields) == 3:
+                    self.set_varies(fields[1], () if fields[2] == '-' else tuple(fields[2].split(',')))
+                elif fields[0] == '>' and len(fields) == 3:
+                    self.add_variant(fields[1], fields[2])
+                elif fields[0] in ('+', '*') and len(fields) in (4, 6):
+                    key, size = fields[1], int(fields[2])
+                    location = (int(fields[4]), int(fields[5])) if len(fields) == 6 else None
+                    self.forget(key)
+                    if fields[0] == '+':
+                        self.probation[key] = size
+                    else:
+                        self.protected[key] = size
+                        self.protectedSize += size
+                    self.size += size
+                    self.expires[key] = int(fields[3])
+                    self.store.place(key, location, size)
+            except (IndexError, ValueError):
+                continue
+        for key in self.store.loaded():
+            # Its segment is gone
+            self.forget(key)
+        # The limits may be lower than last time: drop the least recently used entries
+        while self.size > self.maxBytes or len(self) > self.maxEntries:
+            self.remove(self.victim())
+        self.checkpoint()
+
+    # Drop a key from the in-memory index only
+    def forget(self, key):
+        self.store.forget(key)
+        self.expires.pop(key, None)
+        if key in self.probation:
+            self.size -= self.probation.pop(key)
+        elif key in self.protected:
+            size = self.protected.pop(key)
+            self.size -= size
+            self.protectedSize -= size
+
+    # Append a line to the journal, rewriting it as a checkpoint once most of it is stale
+    def log(self, line):
+        if self.journal is None:
+            return
+        os.write(self.journal, line.encode('ascii'))
+        self.journalLines += 1
+        if self.journalLines > 2 * len(self) + 1024:
+            self.checkpoint()
+
+    # Replace the journal with one line per live entry, least recently used first,
+    # then the variants stored for each URL whose responses vary
+    # It is written to a temporary file and renamed over the old one, so a crash
+    # leaves either the old journal or the new one
+    def checkpoint(self):
+        expires = self.expires
+        where = self.store.where
+        lines = [f'+ {key} {size} {int(expires[key])}{where(key)}\n' for key, size in self.probation.items()]
+        lines += [f'* {key} {size} {int(expires[key])}{where(key)}\n' for key, size in self.protected.items()]
+        for key, names in self.varies.items():
+            lines.append(f'~ {key} {",".join(names)}\n')
+            lines += [f'> {key} {variant}\n' for variant in self.variants.get(key, ()) if variant in expires]
+        tmpPath = os.path.join(self.tmpDir, f'index.{os.getpid()}')
+        with open(tmpPath, 'w', encoding='ascii') as f:
+            f.writelines(lines)
+        os.replace(tmpPath, self.indexPath)
+        if self.journal is not None:
+            os.close(self.journal)
+        self.journal = os.open(self.indexPath, os.O_WRONLY | os.O_APPEND)
+        self.journalLines = len(lines)
+
+    # Checkpoint the index and stop journaling, e.g. when the proxy shuts down
+    def close(self):
+        if self.journal is not None:
+            self.checkpoint()
+            os.close(self.journal)
+            self.journal = None
+            self.store.close()
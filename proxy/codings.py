@@ -0,0 +1,193 @@
+# Content codings the proxy compresses cached responses with (RFC 9110 8.4.1)
+# Shared by the blocking proxy loop and the event-loop engine: a compressible
+# response is encoded once, when it is stored, and sent encoded to clients that
+# accept the coding, or decoded on the fly for those that don't
+import zlib
+
+from httpmsg import get_header, parse_head
+
+# Most bytes decoded from a stored body at a time, so a small body that expands
+# a lot is still sent a bounded piece at a time
+DECODE_BLOCK = 65536
+# Coding compressible responses are stored with unless configured otherwise
+STORE_CODING = 'gzip'
+# Responses smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 256
+# Media types compressed at store time; text/* is compressed as well
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'application/xhtml+xml',
+                      'application/rss+xml', 'application/atom+xml', 'image/svg+xml'}
+
+# A content coding, built on zlib
+# name: Content-Encoding token
+# wbits: zlib window bits selecting the container: 31 for gzip, 15 for zlib ('deflate')
+# level: Compression level
+class ZlibCodec:
+    def __init__(self, name, wbits, level=6):
+        self.name = name
+        self.wbits = wbits
+        self.level = level
+
+    def encoder(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+
+    def decoder(self):
+        return zlib.decompressobj(self.wbits)
+
+# Codings by name. Others can be added with register_codec(): a codec needs a
+# name, and encoder() and decoder() methods returning objects that work like
+# zlib's compressobj() and decompressobj()
+CODECS = {}
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+register_codec(ZlibCodec('gzip', 31))
+register_codec(ZlibCodec('deflate', 15))
+
+# Parse the Accept-Encoding header of a request (RFC 9110 12.5.3)
+# requestHeaders: Headers of the request
+# Returns: {coding: str (lower case): q: float}, empty if there is no Accept-Encoding
+def accepted_codings(requestHeaders):
+    qvalues = {}
+    for item in (get_header(requestHeaders, 'Accept-Encoding') or '').split(','):
+        if not item.strip():
+            continue
+        name, semicolon, params = item.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, equals, value = param.strip().partition('=')
+            if key.lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name.strip().lower()] = q
+    return qvalues
+
+# Check whether a client accepts a content coding
+# requestHeaders: Headers of the request
+# coding: Content coding, e.g. 'gzip'
+def accepts_coding(requestHeaders, coding):
+    qvalues = accepted_codings(requestHeaders)
+    if coding in qvalues:
+        return qvalues[coding] > 0
+    # x-gzip is an old alias of gzip
+    if coding == 'gzip' and 'x-gzip' in qvalues:
+        return qvalues['x-gzip'] > 0
+    return qvalues.get('*', 0) > 0
+
+# Check whether a response should be compressed before it is stored
+# Only complete 200 responses of a compressible type that aren't already encoded qualify
+# statusLine: Status line of the response
+# headers: Headers of the response
+def should_compress(statusLine, headers):
+    if statusLine.split()[1] != '200' or get_header(headers, 'Content-Encoding') is not None:
+        return False
+    if 'no-transform' in (get_header(headers, 'Cache-Control') or '').lower():
+        return False
+    contentLength = get_header(headers, 'Content-Length')
+    if contentLength is not None and contentLength.isdigit() and int(contentLength) < MIN_COMPRESS_SIZE:
+        return False
+    mediaType = (get_header(headers, 'Content-Type') or '').partition(';')[0].strip().lower()
+    return mediaType.startswith('text/') or mediaType in COMPRESSIBLE_TYPES
+
+# Headers to store a compressed response with
+# The length is left out, as cache hits work it out from the stored size. A strong
+# ETag becomes weak, as the stored bytes are no longer the ones it was given for
+# headers: [(header: str, header_value: str)] of the response as the origin sent it
+# coding: Content coding the body is compressed with
+def encoded_headers(headers, coding):
+    encoded = []
+    vary = False
+    for name, value in headers:
+        lower = name.lower()
+        if lower == 'content-length':
+            continue
+        if lower == 'etag' and value.startswith('"'):
+            value = 'W/' + value
+        elif lower == 'vary':
+            vary = True
+            if 'accept-encoding' not in value.lower() and value.strip() != '*':
+                value += ', Accept-Encoding'
+        encoded.append((name, value))
+    encoded.append(('Content-Encoding', coding))
+    if not vary:
+        encoded.append(('Vary', 'Accept-Encoding'))
+    return encoded
+
+# Find the codec a stored response has to be decoded with before it is sent,
+# because it is encoded in a coding the client doesn't accept
+# head: Stored header section, with or without its blank line
+# requestHeaders: Headers of the request
+# Returns: The codec, or None to send the response as it is stored
+def codec_to_decode(head, requestHeaders):
+    # Most responses aren't encoded, and can skip parsing the header section
+    if b'content-encoding' not in head.lower():
+        return None
+    statusLine, headers = parse_head(head)
+    coding = (get_header(headers, 'Content-Encoding') or '').strip().lower()
+    if coding not in CODECS or accepts_coding(requestHeaders, coding):
+        return None
+    return CODECS[coding]
+
+# Headers to send a stored response with once its body has been decoded
+# headers: [(header: str, header_value: str)] of the stored response
+def decoded_headers(headers):
+    return [h for h in headers if h[0].lower() not in ('content-encoding', 'content-length')]
+
+# Decode a stored body piece by piece
+# codec: Codec the body was encoded with
+# pieces: Iterable of the encoded body, in order
+# Yields: Decoded bytes, at most DECODE_BLOCK at a time
+def decode(codec, pieces):
+    decoder = codec.decoder()
+    for piece in pieces:
+        data = decoder.decompress(piece, DECODE_BLOCK)
+        while data:
+            yield data
+            data = decoder.decompress(decoder.unconsumed_tail, DECODE_BLOCK)
+    data = decoder.flush()
+    if data:
+        yield data
+
+# Read the body of an open cache file a block at a time
+# cachef: Cache file opened for reading
+# offset: Where the body starts
+def file_pieces(cachef, offset, blockSize=65536):
+    cachef.seek(offset)
+    while True:
+        piece = cachef.read(blockSize)
+        if not piece:
+            break
+        yield piece
+
+# Stands in for a CacheFile (or Flight), compressing the body on its way into it
+# The header section is written as it is, together with the first piece of the body
+# cachef: CacheFile or Flight the compressed response is written to
+# codec: Codec to compress with
+# head: Header section to store, from encoded_headers()
+class EncodingCacheFile:
+    def __init__(self, cachef, codec, head):
+        self.cachef = cachef
+        self.encoder = codec.encoder()
+        self.head = head
+
+    def write(self, data):
+        self.writev([data])
+
+    def writev(self, buffers):
+        encoded = [self.encoder.compress(data) for data in buffers]
+        if self.head is not None:
+            encoded.insert(0, self.head)
+            self.head = None
+        encoded = [data for data in encoded if data]
+        if encoded:
+            self.cachef.writev(encoded)
+
+    def commit(self):
+        self.writev([])
+        self.cachef.writev([self.encoder.flush()])
+        self.cachef.commit()
+
+    def abort(self):
+        self.cachef.abort()
@@ -0,0 +1,1003 @@
+# Event-loop engine for the proxy
+# Runs the same parse / forward / cache steps as the blocking loop in proxy.py,
+# but every client is a task on one asyncio event loop, so a slow origin only
+# stalls the client that asked for it
+from socket import *
+import asyncio
+import signal
+import time
+
+import iostats
+import metrics
+from asyncsock import AsyncSocketFile, NullSocketFile
+from cache import (MemoryCache, cache_key, read_cached_head, cached_head, make_entry, entry_buffers, read_stored_head,
+                   requested_ranges, range_response, RANGE_HEADERS,
+                   cache_control, response_expiry, stored_validators, revalidation_headers, refreshed_expiry,
+                   stale_windows, vary_names, SERVER_ERRORS, NEGATIVE_TTLS)
+from httpmsg import (request_filename, split_host, strip_hop_by_hop, closes_connection,
+                     response_body_length, request_body_length, expects_continue, CONTINUE,
+                     parse_head, header_block, chunk_size, chunk_header, strip_chunked, LAST_CHUNK,
+                     error_response, Headers, HeaderTooLarge, HEADER_TIMEOUT, BODY_TIMEOUT)
+from upstream import ConnectionPool, CircuitBreaker
+from codings import (CODECS, STORE_CODING, should_compress, encoded_headers, decoded_headers, codec_to_decode,
+                     decode, file_pieces, EncodingCacheFile)
+from resolver import DnsCache
+from metrics import METRICS_PATH, RequestTimer, metrics_response, cache_gauges
+from tunnel import Tunnel, connect_target, relay_async, ESTABLISHED
+
+# Seconds clients get to finish their requests once the engine is asked to stop,
+# less than the prefork supervisor gives a worker, so the engine gets to close
+# the connections itself
+DRAIN_TIMEOUT = 20
+# Most connections one client IP address may have open at once; more are turned
+# away as soon as they are accepted, so one client can't use up the proxy
+MAX_CLIENT_CONNECTIONS = 64
+
+# The origin closed a kept-alive connection before answering a request on it
+class UpstreamClosed(Exception):
+    pass
+
+# Read an HTTP message head from a socket file object and parse it
+# sockf: AsyncSocketFile to read from
+# Returns: (headline: str, Headers), with an empty headline if the peer closed first
+async def parse_http_headers(sockf):
+    return parse_head(await sockf.read_head())
+
+# Read the status line and headers of a response from a server
+# sockf: AsyncSocketFile connected to server
+# Returns: (statusLine: str, Headers)
+async def read_response_head(sockf):
+    try:
+        statusLine, headers = await parse_http_headers(sockf)
+    except ConnectionError as e:
+        raise UpstreamClosed(e)
+    if len(statusLine) == 0:
+        raise UpstreamClosed('connection closed before the status line')
+    return statusLine, headers
+
+# Writes relayed bytes to a socket file and, optionally, a cache file
+# Small pieces such as header sections and chunk size lines are held back and go
+# out with the next piece of body, in one sendmsg() to the socket and one
+# writev() to the cache file
+# sockf: AsyncSocketFile to write to
+# cachef: CacheFile to store a copy in, or None
+class GatherWriter:
+    def __init__(self, sockf, cachef=None):
+        self.sockf = sockf
+        self.cachef = cachef
+        self.held = []
+        self.cacheHeld = []
+
+    # Hold a piece back until the next write() or flush()
+    # cacheData: What to store in the cache instead, if it differs from data
+    def hold(self, data, cacheData=None):
+        self.held.append(data)
+        self.cacheHeld.append(data if cacheData is None else cacheData)
+
+    async def write(self, data):
+        self.hold(data)
+        await self.flush()
+
+    async def flush(self):
+        if self.held:
+            buffers, self.held = self.held, []
+            await self.sockf.writev(buffers)
+        if self.cacheHeld:
+            buffers, self.cacheHeld = self.cacheHeld, []
+            if self.cachef is not None:
+                self.cachef.writev(buffers)
+
+# Copy a body of known length from a socket file to a GatherWriter
+# sockf: AsyncSocketFile to read from
+# nbytes: Number of bytes to copy
+# writer: GatherWriter to relay to
+async def copy_body(sockf, nbytes, writer):
+    while nbytes > 0:
+        bodyChunk = await sockf.read_view(nbytes)
+        if not bodyChunk:
+            raise ConnectionError('connection closed mid-body')
+        await writer.write(bodyChunk)
+        nbytes -= len(bodyChunk)
+
+# Relay a chunked body as-is, following the chunk framing to find its end
+# sockf: AsyncSocketFile to read from
+# writer: GatherWriter to relay to
+async def relay_chunked(sockf, writer):
+    while True:
+        sizeLine = await sockf.readline()
+        if not sizeLine:
+            raise ConnectionError('connection closed mid-body')
+        writer.hold(sizeLine)
+        chunkSize = chunk_size(sizeLine)
+        if chunkSize == 0:
+            break
+        # Chunk data plus its trailing CRLF
+        await copy_body(sockf, chunkSize + 2, writer)
+
+    # Trailer section, ended by an empty line
+    while True:
+        trailer = await sockf.readline()
+        writer.hold(trailer)
+        if len(trailer.rstrip(b'\r\n')) == 0:
+            break
+    await writer.flush()
+
+# Decode a chunked body, yielding chunk data as it arrives
+# A piece is yielded as soon as it is received, without waiting for the rest
+# of its chunk. Chunk extensions and trailer fields are dropped
+# sockf: AsyncSocketFile to read from
+# Yields: memoryviews of chunk data, each only valid until the next one is asked for
+async def dechunk(sockf):
+    while True:
+        sizeLine = await sockf.readline()
+        if not sizeLine.endswith(b'\n'):
+            raise ConnectionError('connection closed mid-body')
+        chunkSize = chunk_size(sizeLine)
+        if chunkSize == 0:
+            break
+        while chunkSize > 0:
+            data = await sockf.read_view(chunkSize)
+            if not data:
+                raise ConnectionError('connection closed mid-body')
+            chunkSize -= len(data)
+            yield data
+        if (await sockf.readline()).strip():
+            raise ValueError('chunk data longer than its size')
+
+    # Trailer section, ended by an empty line
+    while True:
+        trailer = await sockf.readline()
+        if not trailer.endswith(b'\n'):
+            raise ConnectionError('connection closed mid-body')
+        if not trailer.strip():
+            break
+
+# Forward a server response to the client and save to cache
+# Hop-by-hop headers are left out of the cache file; the Connection header the
+# client sees depends on whether its connection is being kept alive
+# A chunked body is decoded as it arrives. The cache stores the plain body, so
+# hits get a Content-Length worked out from its size; the client gets each piece
+# re-encoded as a chunk as soon as it is received, or the plain body followed by
+# a close if chunking can't be used on its connection
+# sockf: AsyncSocketFile connected to server
+# cachef: CacheFile to store the response in, or None. It is committed once the
+#         whole response is in it, and aborted otherwise
+# clisockf: AsyncSocketFile connected to client
+# method: Method of the forwarded request
+# keepAlive: Whether the client connection should stay open after this response
+# head: (statusLine, headers) if they have already been read with read_response_head()
+# canChunk: Whether the client understands chunked bodies (HTTP/1.1 and later)
+# coding: Content coding to compress a compressible response with before it is
+#         stored, or None to store it as it is. The client gets it as the origin sent it
+# Returns: (reusable: bool, keepAlive: bool) whether the server and client
+#          connections can each carry another request
+async def forward_and_cache_response(sockf, cachef, clisockf, method='GET', keepAlive=False, head=None,
+                                     canChunk=True, coding=None):
+    try:
+        statusLine, headers = head if head is not None else await read_response_head(sockf)
+    except UpstreamClosed:
+        if cachef is not None:
+            cachef.abort()
+        raise
+
+    bodyLength = response_body_length(method, statusLine, headers)
+    # A body that runs until close can't be followed by another response
+    reusable = bodyLength is not None and not closes_connection(statusLine, headers)
+    rechunk = bodyLength == 'chunked' and keepAlive and canChunk
+    keepAlive = keepAlive and bodyLength is not None and (bodyLength != 'chunked' or rechunk)
+
+    headers = strip_hop_by_hop(headers)
+    if bodyLength == 'chunked':
+        headers = strip_chunked(headers)
+    clientHeaders = (headers + [('Transfer-Encoding', 'chunked')]) if rechunk else headers
+    connectionHeader = ('Connection', 'keep-alive' if keepAlive else 'close')
+    cacheHead = header_block(statusLine, headers)
+    if cachef is not None and coding is not None and should_compress(statusLine, headers):
+        # The encoder stores its own header section ahead of the compressed body
+        cachef = EncodingCacheFile(cachef, CODECS[coding], header_block(statusLine, encoded_headers(headers, coding)))
+        cacheHead = b''
+
+    try:
+        writer = GatherWriter(clisockf, cachef)
+        # The header section goes out with the first piece of the body
+        writer.hold(header_block(statusLine, clientHeaders + [connectionHeader]), cacheHead)
+
+        if bodyLength == 'chunked':
+            async for data in dechunk(sockf):
+                # Only the client sees the chunk framing; a chunk's trailing CRLF
+                # waits to go out with the next one
+                if rechunk:
+                    writer.hold(chunk_header(len(data)), b'')
+                await writer.write(data)
+                if rechunk:
+                    writer.hold(b'\r\n', b'')
+            if rechunk:
+                writer.hold(LAST_CHUNK, b'')
+        elif bodyLength is not None:
+            await copy_body(sockf, bodyLength, writer)
+        else:
+            # No framing: the body ends when the server closes the connection
+            while True:
+                bodyChunk = await sockf.read_view(65536)
+                if not bodyChunk:
+                    break
+                await writer.write(bodyChunk)
+        await writer.flush()
+    except Exception as e:
+        # The client has a truncated response, so neither connection can be reused
+        print(e)
+        reusable = keepAlive = False
+        if cachef is not None:
+            cachef.abort()
+    else:
+        if cachef is not None:
+            cachef.commit()
+    return reusable, keepAlive
+
+# Send a cached response to the client
+# The Connection header is added here, and a Content-Length is filled in for
+# bodies that were stored without framing, so the connection can be reused.
+# Responses small enough for the memory cache are promoted into it. For the
+# rest only the first block of the file is read into memory: it goes out with
+# the header section, and the rest of the body is streamed with sendfile()
+# cachef: Stored response from DiskCache.open(), closed once it has been sent
+# clisockf: AsyncSocketFile connected to client
+# keepAlive: Whether the client connection should stay open after this response
+# memCache: MemoryCache to promote the response into, or None
+# key: cache_key() of the response
+# requestHeaders: Headers of the request, for any Range and Accept-Encoding, or None
+# canChunk: Whether the client understands chunked bodies (HTTP/1.1 and later)
+# Returns: Whether the client connection can stay open
+async def send_cached_response(cachef, clisockf, keepAlive, memCache=None, key=None, requestHeaders=None,
+                               canChunk=True):
+    with cachef:
+        size = cachef.size
+        if memCache is not None and size <= memCache.maxEntrySize:
+            entry = make_entry(cachef.read())
+            memCache.put(key, entry)
+            return await send_entry(entry, clisockf, keepAlive, requestHeaders, canChunk)
+
+        data, headerEnd = read_cached_head(cachef)
+        if requestHeaders is not None:
+            codec = codec_to_decode(data[:headerEnd], requestHeaders)
+            if codec is not None:
+                return await send_decoded(clisockf, data[:headerEnd - 4], decode(codec, file_pieces(cachef, headerEnd)),
+                                          keepAlive, canChunk)
+        if requestHeaders is not None and requestHeaders.get('Range') is not None:
+            ranges = requested_ranges(data[:headerEnd - 4], size - headerEnd, requestHeaders)
+            if ranges is not None:
+                await send_ranges(cachef, headerEnd, data[:headerEnd - 4], ranges, size - headerEnd, clisockf, keepAlive)
+                return keepAlive
+        head = cached_head(data[:headerEnd - 4], size - headerEnd, keepAlive)
+        await clisockf.writev([head, memoryview(data)[headerEnd:]])
+        if size > len(data):
+            await clisockf.sendfile(cachef.file, cachef.base + len(data), size - len(data))
+        return keepAlive
+
+# Send a stored response decoded from its content coding, for a client that
+# doesn't accept the coding. The decoded size isn't known until it has all been
+# sent, so the body is chunked if the client connection is being kept alive,
+# and ended by closing the connection otherwise
+# clisockf: AsyncSocketFile connected to client
+# head: Stored header section without its blank line
+# pieces: Iterable of the decoded body, from decode()
+# keepAlive: Whether the client connection should stay open after this response
+# canChunk: Whether the client understands chunked bodies (HTTP/1.1 and later)
+# Returns: Whether the client connection can stay open
+async def send_decoded(clisockf, head, pieces, keepAlive, canChunk=True):
+    statusLine, headers = parse_head(head)
+    headers = decoded_headers(strip_hop_by_hop(headers))
+    keepAlive = keepAlive and canChunk
+    if keepAlive:
+        headers.append(('Transfer-Encoding', 'chunked'))
+    headers.append(('Connection', 'keep-alive' if keepAlive else 'close'))
+
+    writer = GatherWriter(clisockf)
+    writer.hold(header_block(statusLine, headers))
+    for data in pieces:
+        if keepAlive:
+            writer.hold(chunk_header(len(data)))
+        await writer.write(data)
+        if keepAlive:
+            writer.hold(b'\r\n')
+    if keepAlive:
+        writer.hold(LAST_CHUNK)
+    await writer.flush()
+    return keepAlive
+
+# Send byte ranges of a cache file, each seeked to and sent with sendfile(),
+# so a small range of a large response doesn't read the rest of it
+# cachef: Stored response opened for reading
+# bodyStart: Offset of the body in the response
+# head: Stored header section without its blank line
+# ranges: [(first, last)] from requested_ranges()
+# bodySize: Size of the stored body
+# clisockf: AsyncSocketFile connected to client
+# keepAlive: Whether the client connection should stay open after this response
+async def send_ranges(cachef, bodyStart, head, ranges, bodySize, clisockf, keepAlive):
+    head, parts = range_response(head, ranges, bodySize, keepAlive)
+    buffers = [head]
+    for part in parts:
+        if isinstance(part, bytes):
+            buffers.append(part)
+            continue
+        await clisockf.writev(buffers)
+        buffers = []
+        await clisockf.sendfile(cachef.file, cachef.base + bodyStart + part[0], part[1])
+    if buffers:
+        await clisockf.writev(buffers)
+
+# Send a memory cache entry, or the byte ranges of it the request asks for,
+# as views of the entry
+# entry: (data: bytes, headerEnd: int) from make_entry()
+# clisockf: AsyncSocketFile connected to client
+# keepAlive: Whether the client connection should stay open after this response
+# requestHeaders: Headers of the request, for any Range and Accept-Encoding, or None
+# canChunk: Whether the client understands chunked bodies (HTTP/1.1 and later)
+# Returns: Whether the client connection can stay open
+async def send_entry(entry, clisockf, keepAlive, requestHeaders=None, canChunk=True):
+    data, headerEnd = entry
+    ranges = None
+    if requestHeaders is not None:
+        codec = codec_to_decode(data[:headerEnd], requestHeaders)
+        if codec is not None:
+            return await send_decoded(clisockf, data[:headerEnd - 4], decode(codec, [memoryview(data)[headerEnd:]]),
+                                      keepAlive, canChunk)
+        if requestHeaders.get('Range') is not None:
+            ranges = requested_ranges(data[:headerEnd - 4], len(data) - headerEnd, requestHeaders)
+    if ranges is None:
+        await clisockf.writev(entry_buffers(entry, keepAlive))
+        return keepAlive
+    head, parts = range_response(data[:headerEnd - 4], ranges, len(data) - headerEnd, keepAlive)
+    view = memoryview(data)[headerEnd:]
+    await clisockf.writev([head] + [part if isinstance(part, bytes) else view[part[0]:part[0] + part[1]]
+                                    for part in parts])
+    return keepAlive
+
+# Forward a client request to a server
+# The request head is sent together with the first piece of any body, and the
+# body is streamed from the client a receive buffer at a time, never held whole
+# sockf: AsyncSocketFile connected to server
+# requestUri: The request URI to request from the server
+# hostn: The Host header value to include in the forwarded request
+# origRequestLine: The Request Line from the original client request
+# origHeaders: The HTTP headers from the original client request
+# clisockf: AsyncSocketFile connected to client, to read the request body from
+# bodyLength: Length of the request body, or 'chunked', from request_body_length()
+async def forward_request(sockf, requestUri, hostn, origRequestLine, origHeaders, clisockf=None, bodyLength=0):
+    # The proxy answers Expect: 100-continue itself, so the server mustn't see it
+    headers = [h for h in strip_hop_by_hop(origHeaders) if h[0] != 'Host' and h[0].lower() != 'expect']
+    headers.append(('Host', hostn))
+    # Ask the server to keep the connection open so it can go back to the pool
+    headers.append(('Connection', 'keep-alive'))
+
+    method = origRequestLine.split()[0]
+
+    # The proxy speaks HTTP/1.1 to servers whatever version the client used
+    writer = GatherWriter(sockf)
+    writer.hold(header_block(f'{method} {requestUri} HTTP/1.1', headers))
+    if bodyLength != 0 and expects_continue(origHeaders):
+        await clisockf.write(CONTINUE)
+    if bodyLength == 'chunked':
+        # Relayed with its chunk framing, which the server gets Transfer-Encoding for
+        await relay_chunked(clisockf, writer)
+    elif bodyLength > 0:
+        await copy_body(clisockf, bodyLength, writer)
+    await writer.flush()
+
+# A cache miss being fetched from the origin, which later requests for the same
+# key follow instead of fetching it again (single-flight)
+# It stands in for the CacheFile the response is stored in: every write to the
+# file wakes the followers, which send the new bytes straight from the file
+class Flight:
+    def __init__(self):
+        self.cachef = None
+        # Bytes in the cache file so far
+        self.written = 0
+        self.done = False
+        self.aborted = False
+        self.changed = asyncio.Event()
+
+    # Start sharing the response being written to a CacheFile
+    def attach(self, cachef):
+        self.cachef = cachef
+
+    def write(self, data):
+        self.writev([data])
+
+    def writev(self, buffers):
+        self.cachef.writev(buffers)
+        self.written = self.cachef.size
+        self.notify()
+
+    def commit(self):
+        self.cachef.commit()
+        self.finish()
+
+    def abort(self):
+        self.cachef.abort()
+        self.aborted = True
+        self.finish()
+
+    # End the flight, with or without a response stored
+    def finish(self):
+        self.done = True
+        self.notify()
+
+    # Wake every follower waiting on the current event, and give later ones a new one
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    # Wait until there are more than offset bytes in the cache file, or the flight is over
+    async def wait(self, offset):
+        while self.written <= offset and not self.done:
+            await self.changed.wait()
+
+# Proxy state shared by every client connection
+# diskCache: DiskCache holding the cache files
+# idleTimeout: Seconds a kept-alive client connection may sit between requests
+# maxRequests: Requests served on one client connection before it is closed
+# memCache: MemoryCache in front of the disk cache
+# staleWhileRevalidate: Seconds past expiry an entry is served while it is refreshed
+#                       in the background, for responses without their own window
+# staleIfError: Seconds past expiry an entry is served when the origin fails,
+#               for responses without their own window
+# negativeTtls: How long errors are cached, as in NEGATIVE_TTLS
+# dnsCache: DnsCache that origin host names are resolved with
+# storeCoding: Content coding compressible responses are stored with, or None to store them as they are
+# drainTimeout: Seconds clients get to finish their requests after a SIGTERM
+# headerTimeout: Seconds a client gets to send a request's header section, from its first byte
+# bodyTimeout: Seconds a client may leave its request body, or a response sent to it, without progress
+# maxClientConnections: Most connections open at once from one client IP address
+class Engine:
+    def __init__(self, diskCache, idleTimeout=15.0, maxRequests=100, memCache=None,
+                 staleWhileRevalidate=0, staleIfError=0, negativeTtls=NEGATIVE_TTLS, dnsCache=None,
+                 storeCoding=STORE_CODING, drainTimeout=DRAIN_TIMEOUT, headerTimeout=HEADER_TIMEOUT,
+                 bodyTimeout=BODY_TIMEOUT, maxClientConnections=MAX_CLIENT_CONNECTIONS):
+        self.diskCache = diskCache
+        self.idleTimeout = idleTimeout
+        self.headerTimeout = headerTimeout
+        self.bodyTimeout = bodyTimeout
+        self.maxClientConnections = maxClientConnections
+        # Client IP address -> connections open from it
+        self.clientConnections = {}
+        self.maxRequests = maxRequests
+        self.drainTimeout = drainTimeout
+        self.memCache = memCache if memCache is not None else MemoryCache()
+        self.staleWhileRevalidate = staleWhileRevalidate
+        self.staleIfError = staleIfError
+        self.negativeTtls = negativeTtls
+        self.storeCoding = storeCoding
+        self.dnsCache = dnsCache if dnsCache is not None else DnsCache()
+        self.pool = ConnectionPool(resolver=self.dnsCache)
+        # Origins that are failing are not asked again until their circuit closes
+        self.breaker = CircuitBreaker()
+        # key -> Flight of the cache miss being fetched for it
+        self.inflight = {}
+        # Requests that followed another request's fetch
+        self.coalesced = 0
+        # Keys being refreshed in the background
+        self.refreshing = set()
+        # Stale responses served while refreshing, and because the origin failed
+        self.staleServed = 0
+        self.staleOnError = 0
+        # Keep references to running tasks so they aren't garbage collected mid-request
+        self.tasks = set()
+        # Tasks serving client connections, and those of them waiting for a client's next request
+        self.clients = set()
+        self.idle = set()
+        # Set once the engine is asked to stop accepting clients
+        self.stopping = asyncio.Event()
+
+    # Serve one client connection, reading requests from it in order until the
+    # client closes it, goes idle, or reaches maxRequests
+    # Pipelined requests wait in the AsyncSocketFile buffer until their turn
+    # tcpCliSock: Non-blocking socket connected to the client
+    # clientIp: Address the client connected from, counted in clientConnections, or None
+    async def handle_client(self, tcpCliSock, clientIp=None):
+        cliSock_f = AsyncSocketFile(tcpCliSock, self.bodyTimeout)
+        metrics.connection_opened()
+        try:
+            for served in range(1, self.maxRequests + 1):
+                try:
+                    # A request is timed from when its first bytes arrive
+                    if not cliSock_f.pending():
+                        # Idle connections are closed straight away when the engine stops
+                        self.idle.add(asyncio.current_task())
+                        try:
+                            await asyncio.wait_for(cliSock_f.fill(), self.idleTimeout)
+                        finally:
+                            self.idle.discard(asyncio.current_task())
+                    timer = RequestTimer()
+                    # However slowly it trickles in, the rest of the header section has headerTimeout to arrive
+                    try:
+                        requestLine, requestHeaders = await asyncio.wait_for(
+                            parse_http_headers(cliSock_f), self.headerTimeout)
+                    except (asyncio.TimeoutError, HeaderTooLarge) as e:
+                        timedOut = isinstance(e, asyncio.TimeoutError)
+                        print('Request header timed out' if timedOut else e)
+                        metrics.error('timeout' if timedOut else 'client')
+                        try:
+                            await cliSock_f.write(error_response('408 Request Timeout' if timedOut
+                                                                 else '431 Request Header Fields Too Large'))
+                        except OSError as e:
+                            print(e)
+                        break
+                except asyncio.TimeoutError:
+                    break
+                timer.mark('parse')
+
+                if len(requestLine) == 0:
+                    break
+
+                keepAlive = (served < self.maxRequests and not self.stopping.is_set()
+                             and not closes_connection(requestLine, requestHeaders))
+                sent = cliSock_f.sent
+                keepAlive = await self.handle_request(cliSock_f, requestLine, requestHeaders, keepAlive, timer=timer)
+                timer.finish(cliSock_f.sent - sent)
+                # A client whose request was under way when the engine was stopped isn't waited for again
+                if not keepAlive or self.stopping.is_set():
+                    break
+        except Exception as e:
+            print(e)
+            metrics.error('timeout' if cliSock_f.timedOut else 'client')
+        finally:
+            tcpCliSock.close()
+            metrics.connection_closed()
+            if clientIp is not None:
+                count = self.clientConnections[clientIp] - 1
+                if count:
+                    self.clientConnections[clientIp] = count
+                else:
+                    del self.clientConnections[clientIp]
+
+    # Answer one request from the cache or the origin
+    # cliSock_f: AsyncSocketFile connected to the client
+    # requestLine: Request line from the client
+    # requestHeaders: Headers from the client
+    # keepAlive: Whether the client connection should stay open after the response
+    # coalesce: Whether a cache miss may share another request's fetch of the same key
+    # serveStale: Whether a stale entry may be served while it is refreshed in the background
+    # timer: RequestTimer to mark the request's phases and the source of its response on,
+    #        or None if the request isn't recorded
+    # Returns: True if the client connection can carry another request
+    async def handle_request(self, cliSock_f, requestLine, requestHeaders, keepAlive, coalesce=True, serveStale=True,
+                             timer=None):
+        timer = timer or RequestTimer()
+        method = requestLine.split()[0]
+        if requestLine.split()[1] == METRICS_PATH:
+            # Asked for the proxy's own metrics rather than for an origin
+            timer.source = 'admin'
+            await cliSock_f.write(metrics_response(keepAlive, cache_gauges(self.diskCache, self.memCache)))
+            return keepAlive
+        if method == 'CONNECT':
+            return await self.tunnel(cliSock_f, requestLine.split()[1], timer)
+        filename = request_filename(requestLine.split()[1])
+        if len(filename) == 0:
+            timer.source = 'error'
+            return False
+
+        # Key of the URL, and of the response this request selects, which differ if the URL's responses vary
+        urlKey = key = None
+        # Header section of a stale entry being revalidated
+        storedHead = None
+        forwardHeaders = requestHeaders
+        # Whether a stale entry can be served if the origin fails
+        staleIfError = False
+        bodyLength = request_body_length(requestHeaders)
+        if bodyLength is None:
+            # Where the body ends can't be told, so neither can where the next request starts
+            timer.source = 'error'
+            await cliSock_f.write(error_response('400 Bad Request'))
+            iostats.count('responses')
+            return False
+        canChunk = not requestLine.endswith('HTTP/1.0')
+        # Only cache GET requests (not POST, PUT, DELETE, etc.)
+        if method == 'GET':
+            urlKey = cache_key(filename)
+            key = self.diskCache.select(urlKey, requestHeaders)
+            onDisk = self.diskCache.lookup(key)
+            # A client asking for no-cache gets a revalidated response
+            noCache = 'no-cache' in cache_control(requestHeaders)
+            fresh = self.diskCache.fresh(key) and not noCache
+            entry = self.memCache.get(key) if fresh else None
+            timer.mark('lookup')
+            if entry is not None:
+                timer.source = 'cache'
+                keepAlive = await send_entry(entry, cliSock_f, keepAlive, requestHeaders, canChunk)
+                timer.mark('transfer')
+                iostats.count('responses')
+                return keepAlive
+
+            try:
+                if onDisk and fresh:
+                    timer.source = 'cache'
+                    keepAlive = await send_cached_response(self.diskCache.open(key), cliSock_f, keepAlive,
+                                                           self.memCache, key, requestHeaders, canChunk)
+                    timer.mark('transfer')
+                    iostats.count('responses')
+                    return keepAlive
+                if onDisk:
+                    head = read_stored_head(self.diskCache.open(key))
+                    staleness = self.diskCache.staleness(key)
+                    windows = stale_windows(head, self.staleWhileRevalidate, self.staleIfError)
+                    if serveStale and not noCache and staleness < windows[0] and bodyLength == 0:
+                        # Stale, but the client needn't wait for the origin: answer with the
+                        # stored copy now and bring it up to date in the background
+                        self.refresh_in_background(key, requestLine, requestHeaders)
+                        self.staleServed += 1
+                        timer.source = 'cache'
+                        keepAlive = await self.send_stale(cliSock_f, key, keepAlive, requestHeaders, canChunk)
+                        timer.mark('transfer')
+                        return keepAlive
+                    staleIfError = staleness < windows[1]
+                    # Stale: ask the origin whether it has changed, if it can tell us
+                    validators = stored_validators(head)
+                    if validators:
+                        storedHead = head
+                        forwardHeaders = revalidation_headers(requestHeaders, validators)
+            except FileNotFoundError as e:
+                # Deleted behind the index's back: forget it and fetch it again
+                print(e)
+                self.diskCache.remove(key, unlink=False)
+
+        hostn = filename.partition('/')[0]
+        hostname, portn = split_host(hostn)
+
+        flight = None
+        if key is not None:
+            leader = self.inflight.get(key) if coalesce else None
+            if leader is not None:
+                self.coalesced += 1
+                result = await self.follow(leader, cliSock_f, keepAlive, requestHeaders)
+                if result is not None:
+                    # Sent from the cache file the leader was filling
+                    timer.source = 'cache'
+                    timer.mark('transfer')
+                    return result
+                # The leader's response couldn't be shared, but it may have refreshed
+                # the cache: start over, fetching independently if it is still a miss
+                return await self.handle_request(cliSock_f, requestLine, requestHeaders, keepAlive, False, serveStale,
+                                                 timer)
+            if coalesce:
+                flight = self.inflight[key] = Flight()
+
+        origin = (hostname, portn)
+        # Whether anything has been sent to the client yet
+        answered = False
+        # What to tell the client if the origin gives no response to relay
+        errorStatus = '502 Bad Gateway'
+        try:
+            while True:
+                if not self.breaker.allow(origin):
+                    # The origin has been failing: don't wait on it again yet
+                    print(f'Circuit open for {hostn}')
+                    errorStatus = '503 Service Unavailable'
+                    break
+                try:
+                    conn, reused = await self.pool.acquire(hostname, portn, timer)
+                except (OSError, asyncio.TimeoutError) as e:
+                    # There is no response to cache, so the origin is remembered instead
+                    print(e or 'Connect timed out')
+                    self.breaker.failure(origin, self.negativeTtls['connect'])
+                    metrics.error('connect')
+                    if isinstance(e, asyncio.TimeoutError):
+                        errorStatus = '504 Gateway Timeout'
+                    break
+                reusable = False
+                try:
+                    await forward_request(conn.sockf, f'/{filename.partition("/")[2]}', hostn,
+                                          requestLine, forwardHeaders, cliSock_f, bodyLength)
+
+                    statusLine, headers = await read_response_head(conn.sockf)
+                    timer.mark('first_byte')
+                    if statusLine.split()[1] in SERVER_ERRORS:
+                        self.breaker.failure(origin)
+                    else:
+                        self.breaker.success(origin)
+                    if staleIfError and statusLine.split()[1] in SERVER_ERRORS:
+                        # The error response is dropped along with the connection
+                        print(statusLine)
+                        break
+                    answered = True
+                    if storedHead is not None and statusLine.split()[1] == '304':
+                        # Unchanged: keep the stored body and only refresh its expiry
+                        reusable = not closes_connection(statusLine, headers)
+                        self.diskCache.refresh(key, refreshed_expiry(storedHead, headers, requestHeaders) or 0)
+                        timer.source = 'cache'
+                        keepAlive = await send_cached_response(self.diskCache.open(key), cliSock_f, keepAlive,
+                                                               self.memCache, key, requestHeaders, canChunk)
+                        timer.mark('transfer')
+                        iostats.count('responses')
+                        return keepAlive
+
+                    cachef = None
+                    if key is not None:
+                        # Whatever was cached is out of date now
+                        self.memCache.discard(key)
+                        expires = response_expiry(statusLine, headers, requestHeaders, negativeTtls=self.negativeTtls)
+                        storeKey = key
+                        if expires is not None:
+                            # The response may vary on other headers than the ones the request was looked up by
+                            storeKey = self.diskCache.store_key(urlKey, vary_names(headers), requestHeaders)
+                            self.memCache.discard(storeKey)
+                            cachef = self.diskCache.open_entry(storeKey, expires)
+                        else:
+                            self.diskCache.remove(key)
+                        if cachef is not None and flight is not None and storeKey == key:
+                            # Followers read the response from the cache file as it is written
+                            # A variant other than the one they looked up isn't shared: they fetch their own
+                            flight.attach(cachef)
+                            cachef = flight
+                    timer.source = 'origin'
+                    reusable, keepAlive = await forward_and_cache_response(
+                        conn.sockf, cachef, cliSock_f, method, keepAlive, (statusLine, headers), canChunk,
+                        self.storeCoding)
+                    timer.mark('transfer')
+                    iostats.count('responses')
+                    return keepAlive
+                except UpstreamClosed as e:
+                    # A pooled connection the server closed under us: retry on a new one,
+                    # unless the request body has already been read from the client
+                    if reused and bodyLength == 0:
+                        continue
+                    print(e)
+                    self.breaker.failure(origin)
+                    metrics.error('upstream')
+                except Exception as e:
+                    print(e)
+                    if cliSock_f.timedOut:
+                        # The client stopped sending its request body
+                        errorStatus = '408 Request Timeout'
+                        metrics.error('timeout')
+                    else:
+                        if isinstance(e, TimeoutError):
+                            errorStatus = '504 Gateway Timeout'
+                        metrics.error('upstream')
+                finally:
+                    self.pool.release(conn, reusable)
+                break
+
+            if staleIfError and not answered:
+                # The origin failed: a stale copy is better than an error
+                self.staleOnError += 1
+                timer.source = 'cache'
+                keepAlive = await self.send_stale(cliSock_f, key, keepAlive, requestHeaders, canChunk)
+                timer.mark('transfer')
+                return keepAlive
+            if not answered:
+                timer.source = 'error'
+                try:
+                    await cliSock_f.write(error_response(errorStatus))
+                    iostats.count('responses')
+                except OSError as e:
+                    print(e)
+                timer.mark('transfer')
+            return False
+        finally:
+            if flight is not None:
+                del self.inflight[key]
+                flight.finish()
+
+    # Answer a CONNECT request: connect to the host and port it names and relay
+    # bytes between it and the client until both are done
+    # cliSock_f: AsyncSocketFile connected to the client
+    # target: Request target, host:port
+    # timer: RequestTimer of the request
+    # Returns: False, as the client connection ends with the tunnel
+    async def tunnel(self, cliSock_f, target, timer):
+        address = connect_target(target)
+        if address is None:
+            timer.source = 'error'
+            await cliSock_f.write(error_response('400 Bad Request'))
+            return False
+        if not self.breaker.allow(address):
+            print(f'Circuit open for {target}')
+            timer.source = 'error'
+            await cliSock_f.write(error_response('503 Service Unavailable'))
+            return False
+
+        loop = asyncio.get_running_loop()
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            resolved = await self.dnsCache.resolve_async(*address)
+            timer.mark('dns')
+            await asyncio.wait_for(loop.sock_connect(sock, resolved), self.pool.connectTimeout)
+            timer.mark('connect')
+        except (OSError, asyncio.TimeoutError) as e:
+            print(e or 'Connect timed out')
+            sock.close()
+            self.breaker.failure(address, self.negativeTtls['connect'])
+            metrics.error('connect')
+            timer.source = 'error'
+            timedOut = isinstance(e, asyncio.TimeoutError)
+            await cliSock_f.write(error_response('504 Gateway Timeout' if timedOut else '502 Bad Gateway'))
+            return False
+        self.breaker.success(address)
+
+        timer.source = 'tunnel'
+        tunnel = Tunnel(target)
+        try:
+            await cliSock_f.write(ESTABLISHED)
+            # Anything the client sent right behind its request is the start of the tunnel's traffic
+            await relay_async(cliSock_f.sock, sock, tunnel, cliSock_f.rbuf.take(cliSock_f.pending()))
+        except OSError as e:
+            print(e)
+        finally:
+            sock.close()
+            tunnel.close()
+            timer.mark('transfer')
+        return False
+
+    # Send a stored entry whatever its freshness, from memory if it is there
+    # cliSock_f: AsyncSocketFile connected to the client
+    # key: cache_key() of the entry
+    # keepAlive: Whether the client connection should stay open after the response
+    # requestHeaders: Headers of the request, for any Range and Accept-Encoding
+    # canChunk: Whether the client understands chunked bodies (HTTP/1.1 and later)
+    # Returns: Whether the client connection can stay open
+    async def send_stale(self, cliSock_f, key, keepAlive, requestHeaders=None, canChunk=True):
+        entry = self.memCache.get(key)
+        if entry is not None:
+            keepAlive = await send_entry(entry, cliSock_f, keepAlive, requestHeaders, canChunk)
+        else:
+            keepAlive = await send_cached_response(self.diskCache.open(key), cliSock_f, keepAlive, self.memCache, key,
+                                                   requestHeaders, canChunk)
+        iostats.count('responses')
+        return keepAlive
+
+    # Revalidate a stale entry in a task of its own, unless it is already being
+    # refreshed or fetched, so there is at most one refresh per key at a time
+    # The request that found the entry stale is repeated, with nobody to answer
+    # key: cache_key() of the entry
+    # requestLine: Request line from the client
+    # requestHeaders: Headers from the client
+    def refresh_in_background(self, key, requestLine, requestHeaders):
+        if key in self.refreshing or key in self.inflight:
+            return
+        self.refreshing.add(key)
+        # The whole response is refreshed, whatever part of it the client wanted
+        requestHeaders = Headers(h for h in requestHeaders if h[0].lower() not in RANGE_HEADERS)
+
+        async def refresh():
+            try:
+                await self.handle_request(NullSocketFile(), requestLine, requestHeaders, True, serveStale=False)
+            except Exception as e:
+                print(e)
+            finally:
+                self.refreshing.discard(key)
+
+        task = asyncio.create_task(refresh())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # Answer a request by following another request's fetch of the same key
+    # The response is sent from the cache file while the leader is still writing
+    # it, each piece as soon as it is written
+    # flight: The leader's Flight
+    # cliSock_f: AsyncSocketFile connected to the client
+    # keepAlive: Whether the client connection should stay open after the response
+    # requestHeaders: Headers of the request, for its Accept-Encoding
+    # Returns: True if the client connection can carry another request, or None
+    #          if nothing was sent because the leader isn't storing a response,
+    #          or is storing it in a coding the client doesn't accept
+    async def follow(self, flight, cliSock_f, keepAlive, requestHeaders=None):
+        await flight.wait(0)
+        if flight.done:
+            # Stored already, not stored at all, or failed before we started
+            return None
+
+        base = flight.cachef.base
+        with open(flight.cachef.tmpPath, 'rb') as cachef:
+            cachef.seek(base)
+            data, headerEnd = read_cached_head(cachef)
+            if requestHeaders is not None and codec_to_decode(data[:headerEnd], requestHeaders) is not None:
+                # Stored compressed, in a coding this client doesn't accept: it is
+                # decoded from the cache once it is all there
+                while not flight.done:
+                    await flight.wait(flight.written)
+                return None
+            statusLine, headers = parse_head(data[:headerEnd - 4])
+            # A body without framing ends when the connection closes, as its size isn't known yet
+            keepAlive = keepAlive and response_body_length('GET', statusLine, headers) is not None
+            headers.append(('Connection', 'keep-alive' if keepAlive else 'close'))
+            await cliSock_f.writev([header_block(statusLine, headers), memoryview(data)[headerEnd:]])
+
+            offset = len(data)
+            while True:
+                await flight.wait(offset)
+                if flight.aborted:
+                    # The client has a truncated response
+                    return False
+                if flight.written > offset:
+                    await cliSock_f.sendfile(cachef, base + offset, flight.written - offset)
+                    offset = flight.written
+                elif flight.done:
+                    break
+        iostats.count('responses')
+        return keepAlive
+
+    # Compact the disk cache's storage in the background, a step at a time,
+    # letting clients be served between steps
+    # interval: Seconds between checks for anything to compact
+    async def compact_forever(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                while self.diskCache.compact():
+                    await asyncio.sleep(0)
+            except OSError as e:
+                print(e)
+
+    # Accept clients forever, serving each one as its own task
+    # tcpSerSock: Listening server socket
+    async def accept_forever(self, tcpSerSock):
+        loop = asyncio.get_running_loop()
+        while True:
+            acceptStart = time.perf_counter()
+            tcpCliSock, addr = await loop.sock_accept(tcpSerSock)
+            metrics.observe('accept', time.perf_counter() - acceptStart)
+            clientIp = addr[0]
+            count = self.clientConnections.get(clientIp, 0)
+            if count >= self.maxClientConnections:
+                # Turned away before anything is read, so the connection costs next to nothing
+                print(f'Too many connections from {clientIp}')
+                metrics.error('rejected')
+                try:
+                    tcpCliSock.send(error_response('503 Service Unavailable'))
+                except OSError:
+                    pass
+                tcpCliSock.close()
+                continue
+            self.clientConnections[clientIp] = count + 1
+            task = asyncio.create_task(self.handle_client(tcpCliSock, clientIp))
+            self.clients.add(task)
+            task.add_done_callback(self.clients.discard)
+
+    # Stop accepting clients, e.g. on SIGTERM; serve() then drains and returns
+    def stop(self):
+        self.stopping.set()
+
+    # Accept and serve clients until stop() is called, then drain: close idle
+    # connections and give the others up to drainTimeout to finish the request
+    # they are on, each getting Connection: close
+    # tcpSerSock: Listening server socket
+    async def serve(self, tcpSerSock):
+        loop = asyncio.get_running_loop()
+        tcpSerSock.setblocking(False)
+        self.tasks.add(asyncio.create_task(self.pool.reap_forever()))
+        self.tasks.add(asyncio.create_task(self.compact_forever()))
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.stop)
+        except (NotImplementedError, RuntimeError):
+            # No signal handlers on Windows, or outside the main thread
+            pass
+        accepting = asyncio.create_task(self.accept_forever(tcpSerSock))
+        stopping = asyncio.create_task(self.stopping.wait())
+        try:
+            await asyncio.wait([accepting, stopping], return_when=asyncio.FIRST_COMPLETED)
+            if accepting.done():
+                # Accepting failed: let the error out
+                accepting.result()
+            accepting.cancel()
+            await asyncio.gather(accepting, return_exceptions=True)
+            # New connections go to the other workers sharing the port from now on
+            tcpSerSock.close()
+            for task in list(self.idle):
+                task.cancel()
+            if self.clients:
+                done, pending = await asyncio.wait(list(self.clients), timeout=self.drainTimeout)
+                for task in pending:
+                    task.cancel()
+        finally:
+            accepting.cancel()
+            stopping.cancel()
+            self.pool.close()
+
+# Run the engine on a listening socket until interrupted, or until it has drained after a SIGTERM
+def run(tcpSerSock, diskCache, staleWhileRevalidate=0, staleIfError=0, negativeTtls=NEGATIVE_TTLS, dnsCache=None,
+        storeCoding=STORE_CODING):
+    asyncio.run(Engine(diskCache, staleWhileRevalidate=staleWhileRevalidate, staleIfError=staleIfError,
+                       negativeTtls=negativeTtls, dnsCache=dnsCache, storeCoding=storeCoding).serve(tcpSerSock))
@@ -0,0 +1,279 @@
+# Helpers for picking apart HTTP messages that are shared by the
+# blocking proxy loop in proxy.py and the event-loop engine in engine.py
+
+# Split the request URI from a request line into the cache filename
+# requestUri: The request URI, either an absolute http:// URI or a path
+# Returns: filename: str, e.g. 'localhost:5000/test' (empty for '/')
+def request_filename(requestUri):
+    # if a scheme is included, split off the scheme, otherwise split off a leading slash
+    uri_parts = requestUri.partition('http://')
+    if uri_parts[1] == '':
+        return requestUri.partition('/')[2]
+    return uri_parts[2]
+
+# Split the host part of a cache filename into a host name and port number
+# hostn: The host part of the filename, e.g. 'localhost:5000'
+# Returns: (hostname: str, portn: int)
+def split_host(hostn):
+    if ':' in hostn:
+        hostname, portn = hostn.split(':')
+        return hostname, int(portn)
+    return hostn, 80
+
+# Headers that only describe a single connection and must not be forwarded
+# Transfer-Encoding is handled separately, as request bodies are relayed with
+# their framing while response bodies are decoded, so it isn't listed here
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer', 'upgrade'}
+
+# Limits that keep a slow or broken peer from holding on to a connection, and the
+# memory and (in the blocking loop) the whole proxy that go with it
+# Seconds a client gets to send a whole request header section: from the first
+# byte of the request in the engine, from accept() in the blocking loop
+HEADER_TIMEOUT = 10.0
+# Seconds a client may leave its request body, or a response being sent to it,
+# without progress before its connection is dropped
+BODY_TIMEOUT = 30.0
+# Slowest rate, in bytes per second, a client may take a file sent with sendfile()
+# at, over and above BODY_TIMEOUT, as one sendfile() is waited on as a whole
+MIN_SEND_RATE = 16384
+# Most bytes a header section may take up before the message is refused
+MAX_HEADER_BYTES = 65536
+
+# A header section ran past MAX_HEADER_BYTES without ending
+class HeaderTooLarge(ValueError):
+    pass
+
+# Reusable receive buffer that HTTP messages are parsed out of in place
+# Sockets receive straight into it with recv_into(space()); parsed data is
+# taken off the front, and the space is reused once everything is consumed
+# size: Initial capacity, grown when a single header section doesn't fit
+class RecvBuffer:
+    def __init__(self, size=65536):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        # Unread bytes are data[start:end]
+        self.start = 0
+        self.end = 0
+        # Where the last search for the end of a header section left off
+        self.scanned = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    # Get the free space at the end of the buffer to receive into
+    # The unread bytes are moved to the front first if the buffer is full
+    def space(self):
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+        elif self.end == len(self.data):
+            pending = self.end - self.start
+            data = self.data
+            if pending == len(data):
+                # One header section is bigger than the whole buffer
+                data = bytearray(2 * len(data))
+            data[:pending] = self.data[self.start:self.end]
+            self.data = data
+            self.view = memoryview(data)
+            self.scanned -= self.start
+            self.start = 0
+            self.end = pending
+        return self.view[self.end:]
+
+    # Record nbytes received into the memoryview returned by space()
+    def advance(self, nbytes):
+        self.end += nbytes
+
+    # Take a complete header section off the front of the buffer
+    # The search for CRLF-CRLF resumes where the previous call stopped, so
+    # each byte is scanned once however many pieces the header arrives in
+    # Raises: HeaderTooLarge if the section is longer than maxBytes, whether or not it has ended
+    # Returns: The request or status line and header lines without the
+    #          blank line, or None if the section hasn't all arrived yet
+    def take_head(self, maxBytes=MAX_HEADER_BYTES):
+        end = self.data.find(b'\r\n\r\n', max(self.scanned, self.start), self.end)
+        if end < 0:
+            if self.end - self.start > maxBytes:
+                raise HeaderTooLarge(f'Header section longer than {maxBytes} bytes')
+            self.scanned = max(self.start, self.end - 3)
+            return None
+        if end - self.start > maxBytes:
+            raise HeaderTooLarge(f'Header section longer than {maxBytes} bytes')
+        head = bytes(self.view[self.start:end])
+        self.start = self.scanned = end + 4
+        return head
+
+    # Take one line, including its line ending, off the front of the buffer
+    # Returns: The line, or None if it hasn't all arrived yet
+    def take_line(self):
+        end = self.data.find(b'\n', self.start, self.end)
+        if end < 0:
+            return None
+        return self.take(end + 1 - self.start)
+
+    # Take up to nbytes off the front of the buffer as a copy
+    def take(self, nbytes):
+        return bytes(self.take_view(nbytes))
+
+    # Take up to nbytes off the front of the buffer without copying them
+    # The view is only valid until the next call to space()
+    def take_view(self, nbytes):
+        nbytes = min(nbytes, self.end - self.start)
+        view = self.view[self.start:self.start + nbytes]
+        self.start += nbytes
+        return view
+
+# Headers of one message: a list of (header, header_value) tuples in the order
+# they were sent, plus a case-insensitive index by name for O(1) lookups
+# Repeated headers are joined with ', ' in the index, as for list-valued headers
+class Headers(list):
+    def __init__(self, items=()):
+        super().__init__(items)
+        index = {}
+        for name, value in self:
+            key = name.lower()
+            index[key] = index[key] + ', ' + value if key in index else value
+        self.index = index
+
+    def append(self, header):
+        super().append(header)
+        key = header[0].lower()
+        index = self.index
+        index[key] = index[key] + ', ' + header[1] if key in index else header[1]
+
+    def get(self, name, default=None):
+        return self.index.get(name.lower(), default)
+
+# Parse a header section taken off a RecvBuffer
+# The section is decoded once as a whole; header bytes are ISO-8859-1
+# head: Header section without its blank line
+# Returns: (headline: str, Headers)
+def parse_head(head):
+    lines = head.decode('latin-1').split('\r\n')
+    items = []
+    for line in lines[1:]:
+        # Skip lines without a colon
+        name, colon, value = line.partition(':')
+        if colon:
+            items.append((name.strip(), value.strip()))
+    return lines[0].strip(), Headers(items)
+
+# Serialize a request or status line and headers into a header section
+# headline: Request or status line
+# headers: [(header: str, header_value: str)]
+def header_block(headline, headers):
+    head = headline + '\r\n'
+    for header in headers:
+        head += f'{header[0]}: {header[1]}\r\n'
+    return (head + '\r\n').encode('latin-1')
+
+# Find a header value
+# headers: Headers, or [(header: str, header_value: str)]
+# name: Header name, matched case-insensitively
+# Returns: The header value, or None
+def get_header(headers, name):
+    if isinstance(headers, Headers):
+        return headers.get(name)
+    name = name.lower()
+    for header in headers:
+        if header[0].lower() == name:
+            return header[1]
+    return None
+
+# Remove hop-by-hop headers, including any the Connection header names
+# headers: [(header: str, header_value: str)]
+def strip_hop_by_hop(headers):
+    dropped = set(HOP_BY_HOP)
+    for header in headers:
+        if header[0].lower() == 'connection':
+            dropped.update(token.strip().lower() for token in header[1].split(','))
+    return [h for h in headers if h[0].lower() not in dropped]
+
+# Check whether the sender of a message will close the connection after it
+# headline: Request or status line of the message
+# headers: [(header: str, header_value: str)]
+def closes_connection(headline, headers):
+    tokens = [token.strip().lower() for token in (get_header(headers, 'Connection') or '').split(',')]
+    if 'close' in tokens:
+        return True
+    # HTTP/1.0 connections close unless keep-alive was asked for
+    return 'HTTP/1.0' in headline and 'keep-alive' not in tokens
+
+# Parse the size line that starts a chunk of a chunked body
+# sizeLine: The line, with any chunk extensions and its line ending
+# Returns: The size of the chunk data
+def chunk_size(sizeLine):
+    size = sizeLine.split(b';')[0].strip()
+    if not size or size.strip(b'0123456789abcdefABCDEF'):
+        raise ValueError(f'bad chunk size line {bytes(sizeLine)!r}')
+    return int(size, 16)
+
+# Size line for a chunk of n bytes of data, which is followed by the data and CRLF
+def chunk_header(n):
+    return b'%x\r\n' % n
+
+# Last chunk and empty trailer section that end a chunked body
+LAST_CHUNK = b'0\r\n\r\n'
+
+# Headers for a body that has been decoded from chunked: 'chunked' is taken out
+# of Transfer-Encoding, and any Content-Length is dropped, as the chunking overrode it
+# headers: [(header: str, header_value: str)]
+def strip_chunked(headers):
+    stripped = []
+    for header in headers:
+        name = header[0].lower()
+        if name == 'transfer-encoding':
+            codings = [c.strip() for c in header[1].split(',') if c.strip().lower() != 'chunked']
+            if codings:
+                stripped.append((header[0], ', '.join(codings)))
+        elif name != 'content-length':
+            stripped.append(header)
+    return stripped
+
+# Work out where the body of a request ends
+# headers: [(header: str, header_value: str)]
+# Returns: Content-Length as an int, or 'chunked'; a request with neither has no body
+#          None if the Content-Length isn't a non-negative number, so the request can't be framed
+def request_body_length(headers):
+    transferEncoding = get_header(headers, 'Transfer-Encoding')
+    if transferEncoding is not None and transferEncoding.lower().endswith('chunked'):
+        return 'chunked'
+    contentLength = get_header(headers, 'Content-Length')
+    if contentLength is None:
+        return 0
+    # isdigit() also turns away signs, spaces and lists of lengths
+    if not contentLength.isdigit() or not contentLength.isascii():
+        return None
+    return int(contentLength)
+
+# Check whether a client wants a 100 Continue before it sends the request body
+# headers: [(header: str, header_value: str)]
+def expects_continue(headers):
+    return (get_header(headers, 'Expect') or '').lower() == '100-continue'
+
+# Interim response that tells a client to go ahead and send its request body
+CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+# Response the proxy makes up itself when the origin gives it none to relay
+# status: Status code and reason phrase, e.g. '502 Bad Gateway'
+# Returns: The whole response, which closes the connection
+def error_response(status):
+    body = status.encode() + b'\n'
+    return header_block(f'HTTP/1.1 {status}', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body))),
+                                               ('Connection', 'close')]) + body
+
+# Work out where the body of a response ends
+# method: Method of the request the response answers
+# statusLine: Status line of the response
+# headers: [(header: str, header_value: str)]
+# Returns: Content-Length as an int, 'chunked', or None if the body runs until the server closes
+def response_body_length(method, statusLine, headers):
+    status = statusLine.split()[1] if len(statusLine.split()) > 1 else ''
+    if method == 'HEAD' or status.startswith('1') or status in ('204', '304'):
+        return 0
+    transferEncoding = get_header(headers, 'Transfer-Encoding')
+    if transferEncoding is not None and transferEncoding.lower().endswith('chunked'):
+        return 'chunked'
+    contentLength = get_header(headers, 'Content-Length')
+    if contentLength is not None:
+        return int(contentLength)
+    return None
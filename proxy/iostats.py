@@ -0,0 +1,35 @@
+# Counters of the system calls the proxy makes on sockets and cache files
+# Dividing them by the number of responses sent gives the syscall cost of a response
+counts = {
+    'select': 0,
+    'recv': 0,
+    'send': 0,
+    'sendfile': 0,
+    'cache_open': 0,
+    'cache_write': 0,
+    'responses': 0,
+}
+
+def count(name, n=1):
+    counts[name] += n
+
+# Time spent on work other than I/O system calls, in seconds, and how many
+# times it was done: 'resolve' is host name resolution for origin connects
+timings = {
+    'resolve': 0.0,
+}
+timed = {
+    'resolve': 0,
+}
+
+def record_time(name, seconds):
+    timings[name] += seconds
+    timed[name] += 1
+
+# Total I/O system calls made so far, across all counters
+def syscalls():
+    return sum(n for name, n in counts.items() if name != 'responses')
+
+# Average I/O system calls per response sent so far
+def syscalls_per_response():
+    return syscalls() / max(1, counts['responses'])
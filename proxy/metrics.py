@@ -0,0 +1,186 @@
+# Latency histograms and counters of the requests the proxy serves, shared by
+# the blocking proxy loop and the event-loop engine, and served in the
+# Prometheus text format at METRICS_PATH on the proxy port
+# Recording a request costs a few perf_counter() calls and dictionary updates;
+# the text is only put together when it is asked for
+from bisect import bisect_left
+import time
+
+import iostats
+from httpmsg import header_block
+
+# Path on the proxy port that the metrics are served at
+METRICS_PATH = '/__proxy/metrics'
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Phases of a request that are timed:
+# accept: waiting in accept() for the connection, once per connection
+# parse: from the first bytes of the request arriving to its header section being parsed
+# lookup: looking the request up in the cache
+# dns: resolving the origin's host name, when a new connection is made
+# connect: connecting to the origin, when no idle connection could be reused
+# first_byte: from sending the request to the origin to having its response's header section
+# transfer: sending the response to the client, from the cache or as it arrives from the origin
+# total: from the first bytes of the request to the last of the response
+PHASES = ('accept', 'parse', 'lookup', 'dns', 'connect', 'first_byte', 'transfer', 'total')
+
+# Where the response to a request came from: the cache (including stale and
+# revalidated copies), the origin, an error the proxy made up itself, the
+# proxy's own admin URLs such as METRICS_PATH, or a CONNECT tunnel
+SOURCES = ('cache', 'origin', 'error', 'admin', 'tunnel')
+
+# Fixed-bucket histogram of durations
+# buckets: Upper bounds of the buckets, in seconds, ascending
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # Observations per bucket, not cumulative; the last is above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+histograms = {phase: Histogram() for phase in PHASES}
+# Responses and the bytes sent with them to clients, by source
+responses = {source: 0 for source in SOURCES}
+sentBytes = {source: 0 for source in SOURCES}
+# Client connections accepted so far, and open now
+connections = 0
+openConnections = 0
+# Failures by kind: origins that couldn't be connected to, fetches that failed
+# after connecting, client connections that ended in an error, clients that were
+# too slow sending a request or taking a response, and connections turned away
+# because their client had too many open
+errors = {'connect': 0, 'upstream': 0, 'client': 0, 'timeout': 0, 'rejected': 0}
+# CONNECT tunnels opened so far and open now, and the bytes relayed through
+# them: up from clients to origins, and down
+tunnels = 0
+openTunnels = 0
+tunnelBytes = {'up': 0, 'down': 0}
+
+def observe(phase, seconds):
+    histograms[phase].observe(seconds)
+
+def error(kind):
+    errors[kind] += 1
+
+def connection_opened():
+    global connections, openConnections
+    connections += 1
+    openConnections += 1
+
+def connection_closed():
+    global openConnections
+    openConnections -= 1
+
+def tunnel_opened():
+    global tunnels, openTunnels
+    tunnels += 1
+    openTunnels += 1
+
+def tunnel_closed(bytesUp, bytesDown):
+    global openTunnels
+    openTunnels -= 1
+    tunnelBytes['up'] += bytesUp
+    tunnelBytes['down'] += bytesDown
+
+# Times the phases of one request as it is served, and records them once it is done
+# Each mark() ends a phase that started where the last one ended, so the phases
+# of a request add up to its total
+# start: perf_counter() time the request started at, or None for now
+class RequestTimer:
+    def __init__(self, start=None):
+        self.start = self.last = time.perf_counter() if start is None else start
+        self.phases = {}
+        # Where the response came from, one of SOURCES; None until it is known
+        self.source = None
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    # Record the request's phases and total, and what was sent for it
+    # sent: Bytes sent to the client for it
+    def finish(self, sent):
+        now = time.perf_counter()
+        for phase, seconds in self.phases.items():
+            histograms[phase].observe(seconds)
+        histograms['total'].observe(now - self.start)
+        source = self.source or 'origin'
+        responses[source] += 1
+        sentBytes[source] += sent
+
+# Format a label set
+# labels: [(name, value)]
+def label_text(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+# Everything recorded so far, in the Prometheus text exposition format (version 0.0.4)
+# gauges: [(name, help, value)] of the caller's own gauges to add, such as cache sizes
+# Returns: The text, encoded
+def render(gauges=()):
+    lines = []
+
+    def family(name, kind, help, samples):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for sampleName, labels, value in samples:
+            lines.append(f'{sampleName}{label_text(labels)} {value}')
+
+    samples = []
+    for phase in PHASES:
+        histogram = histograms[phase]
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            samples.append(('proxy_request_phase_seconds_bucket', [('phase', phase), ('le', bound)], cumulative))
+        samples.append(('proxy_request_phase_seconds_sum', [('phase', phase)], f'{histogram.sum:.6f}'))
+        samples.append(('proxy_request_phase_seconds_count', [('phase', phase)], histogram.count))
+    family('proxy_request_phase_seconds', 'histogram', 'Time spent in each phase of a request.', samples)
+
+    family('proxy_responses_total', 'counter', 'Responses sent, by where they came from.',
+           [('proxy_responses_total', [('source', source)], responses[source]) for source in SOURCES])
+    family('proxy_sent_bytes_total', 'counter', 'Bytes sent to clients, by where the response came from.',
+           [('proxy_sent_bytes_total', [('source', source)], sentBytes[source]) for source in SOURCES])
+    served = responses['cache'] + responses['origin']
+    family('proxy_cache_hit_ratio', 'gauge', 'Share of the responses not made up by the proxy that came from the cache.',
+           [('proxy_cache_hit_ratio', [], f'{responses["cache"] / served:.6f}' if served else '0')])
+    family('proxy_connections_total', 'counter', 'Client connections accepted.',
+           [('proxy_connections_total', [], connections)])
+    family('proxy_open_connections', 'gauge', 'Client connections open now.',
+           [('proxy_open_connections', [], openConnections)])
+    family('proxy_tunnels_total', 'counter', 'CONNECT tunnels opened.', [('proxy_tunnels_total', [], tunnels)])
+    family('proxy_open_tunnels', 'gauge', 'CONNECT tunnels open now.', [('proxy_open_tunnels', [], openTunnels)])
+    family('proxy_tunnel_bytes_total', 'counter', 'Bytes relayed through closed CONNECT tunnels, by direction.',
+           [('proxy_tunnel_bytes_total', [('direction', direction)], n) for direction, n in tunnelBytes.items()])
+    family('proxy_errors_total', 'counter', 'Failures, by kind.',
+           [('proxy_errors_total', [('kind', kind)], n) for kind, n in errors.items()])
+    family('proxy_syscalls_total', 'counter', 'I/O system calls made on sockets and cache files.',
+           [('proxy_syscalls_total', [('call', call)], n) for call, n in iostats.counts.items()
+            if call != 'responses'])
+    for name, help, value in gauges:
+        family(name, 'gauge', help, [(name, [], value)])
+    return ('\n'.join(lines) + '\n').encode()
+
+# Gauges of how much the cache tiers hold, for render()
+def cache_gauges(diskCache, memCache):
+    return [('proxy_disk_cache_entries', 'Responses in the disk cache.', len(diskCache)),
+            ('proxy_disk_cache_bytes', 'Bytes of responses in the disk cache.', diskCache.size),
+            ('proxy_memory_cache_entries', 'Responses in the memory cache.', len(memCache.entries)),
+            ('proxy_memory_cache_bytes', 'Bytes of responses in the memory cache.', memCache.size)]
+
+# The metrics as a whole HTTP response
+# keepAlive: Whether the client connection stays open after it
+# gauges: As for render()
+def metrics_response(keepAlive, gauges=()):
+    body = render(gauges)
+    return header_block('HTTP/1.1 200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                                            ('Content-Length', str(len(body))), ('Cache-Control', 'no-store'),
+                                            ('Connection', 'keep-alive' if keepAlive else 'close')]) + body
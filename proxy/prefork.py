@@ -0,0 +1,104 @@
+# Prefork supervisor: runs a server in several worker processes, so it can use
+# as many cores as there are workers rather than the one core the GIL allows
+# a single process. Each worker binds a listening socket of its own to the same
+# port with SO_REUSEPORT, and the kernel spreads new connections over them
+# The supervisor restarts a worker that dies. On SIGTERM or SIGINT it asks every
+# worker to drain with SIGTERM: stop accepting, finish the requests it has
+# started, and exit. Workers still running after drainTimeout are killed
+import os
+import signal
+import sys
+import time
+import traceback
+
+# Seconds workers get to finish their requests once asked to stop
+DRAIN_TIMEOUT = 30
+# A worker that dies sooner than this after it started is restarted after a
+# delay, doubling up to MAX_RESTART_DELAY while it keeps dying, so a worker
+# that can't start doesn't have the supervisor forking in a loop
+MIN_UPTIME = 1.0
+MAX_RESTART_DELAY = 30.0
+
+# Run a worker in a forked child, exiting the child once it returns
+# serve: Called with the worker number to run the worker
+# Returns: The child's pid, in the supervisor
+def fork_worker(serve, worker):
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    # The supervisor decides when workers stop: a Ctrl-C reaches the whole
+    # process group, but only the supervisor acts on it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    status = 0
+    try:
+        serve(worker)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 0
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(status)
+
+def signal_workers(children, signum):
+    for pid in children:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+# Run workers until SIGTERM or SIGINT, then drain them
+# workers: Number of worker processes
+# serve: Called with the worker number (0 to workers - 1) in each worker process;
+#        it should listen with SO_REUSEPORT, and return once it has drained after a SIGTERM
+# drainTimeout: Seconds workers get to drain before they are killed
+def supervise(workers, serve, drainTimeout=DRAIN_TIMEOUT):
+    # pid -> (worker number, when it started)
+    children = {}
+    # worker number -> when to start it again, after it died
+    restarts = {}
+    # worker number -> how long it waited to be restarted the last time
+    delays = {}
+    stopSignals = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopSignals.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopSignals.append(signum))
+
+    for worker in range(workers):
+        children[fork_worker(serve, worker)] = (worker, time.monotonic())
+    print(f'Started {workers} workers')
+
+    deadline = None
+    killed = False
+    while children or (restarts and deadline is None):
+        now = time.monotonic()
+        if stopSignals and deadline is None:
+            print(f'Draining {len(children)} workers')
+            deadline = now + drainTimeout
+            restarts.clear()
+            signal_workers(children, signal.SIGTERM)
+        elif deadline is not None and now > deadline and not killed:
+            print(f'Killing {len(children)} workers that did not drain in time')
+            killed = True
+            signal_workers(children, signal.SIGKILL)
+
+        pid, status = os.waitpid(-1, os.WNOHANG) if children else (0, 0)
+        if pid == 0:
+            for worker, at in list(restarts.items()):
+                if at <= now:
+                    del restarts[worker]
+                    children[fork_worker(serve, worker)] = (worker, time.monotonic())
+            time.sleep(0.05)
+            continue
+
+        worker, started = children.pop(pid)
+        if deadline is not None:
+            continue
+        print(f'Worker {worker} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting it')
+        delay = 0
+        if now - started < MIN_UPTIME:
+            delay = min(max(2 * delays.get(worker, 0), 0.5), MAX_RESTART_DELAY)
+        delays[worker] = delay
+        restarts[worker] = now + delay
+    print('Workers stopped')
@@ -1,9 +1,29 @@
 from socket import *
 import sys
 import os
-import shutil
 import select
-import hashlib
+import signal
+
+import time
+
+import engine
+import iostats
+import metrics
+import prefork
+from cache import (DiskCache, MemoryCache, cache_key, read_cached_head, cached_head, make_entry, entry_buffers,
+                   requested_ranges, range_response,
+                   read_stored_head, cache_control, response_expiry, stored_validators, revalidation_headers,
+                   refreshed_expiry, stale_windows, vary_names, SERVER_ERRORS, STALE_WHILE_REVALIDATE, STALE_IF_ERROR,
+                   NEGATIVE_TTLS)
+from httpmsg import (request_filename, split_host, parse_head, header_block, RecvBuffer,
+                     request_body_length, expects_continue, CONTINUE, response_body_length,
+                     chunk_size, strip_chunked, error_response, HeaderTooLarge, HEADER_TIMEOUT, BODY_TIMEOUT)
+from upstream import CircuitBreaker, CONNECT_TIMEOUT, UPSTREAM_IDLE_TIMEOUT
+from resolver import DnsCache
+from codings import (CODECS, STORE_CODING, should_compress, encoded_headers, decoded_headers, codec_to_decode,
+                     decode, file_pieces, EncodingCacheFile)
+from metrics import METRICS_PATH, RequestTimer, metrics_response, cache_gauges
+from tunnel import Tunnel, connect_target, relay, ESTABLISHED
 
 cacheDir = os.path.join(os.path.dirname(__file__), 'cache')
 
@@ -12,147 +32,328 @@ cacheDir = os.path.join(os.path.dirname(__file__), 'cache')
 # respond to any SIGINT or SIGKILL signals
 # Shouldn't be a problem on Mac or Linux
 # Additional note for WINDOWS: select.select() only works on sockets, so waitable should be a socket
-def wait_interruptible(waitable, timeLeft):
+# deadline: time.monotonic() time to give up at with TimeoutError, or None to wait forever
+def wait_interruptible(waitable, timeLeft, deadline=None):
     while True:
-        ready = select.select([waitable], [], [], timeLeft)
+        wait = timeLeft if deadline is None else max(0, min(timeLeft, deadline - time.monotonic()))
+        ready = select.select([waitable], [], [], wait)
+        iostats.count('select')
         if len(ready[0]) > 0:
             return
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError('Peer sent nothing before the deadline')
 
-# interruptible versions of accept(), recv(), readline(), read()
+# interruptible versions of accept(), recv(), recv_into()
 def interruptible_accept(socket):
     wait_interruptible(socket, 5)
     return socket.accept()
 
-def interruptible_recv(socket, nbytes):
-    wait_interruptible(socket, 5)
+def interruptible_recv(socket, nbytes, deadline=None):
+    wait_interruptible(socket, 5, deadline)
     return socket.recv(nbytes)
 
-def interruptible_readline(fileObj):
-    wait_interruptible(fileObj, 5)
-    return fileObj.readline()
-
-def interruptible_read(fileObj, nbytes=-1):
-    wait_interruptible(fileObj, 5)
-    return fileObj.read(nbytes)
+def interruptible_recv_into(socket, buffer, deadline=None):
+    wait_interruptible(socket, 5, deadline)
+    return socket.recv_into(buffer)
+
+# Buffered file object over a blocking socket, used in place of makefile('rwb', 0)
+# Data is received in large pieces straight into a reusable RecvBuffer, and the
+# socket is only waited on once everything already received has been read
+# idleTimeout: Seconds one receive or send may wait for the peer before TimeoutError
+#              is raised, or None to wait as long as it takes
+class SocketFile:
+    def __init__(self, sock, idleTimeout=None):
+        self.sock = sock
+        self.rbuf = RecvBuffer()
+        self.eof = False
+        # Bytes sent so far
+        self.sent = 0
+        self.idleTimeout = idleTimeout
+        # time.monotonic() time the current phase, such as reading a header section,
+        # has to be done by, or None
+        self.deadline = None
+        # Whether a receive or send ran out of time; the connection is no use after that
+        self.timedOut = False
+        if idleTimeout is not None:
+            # Sends wait at most this long for the peer to make room
+            sock.settimeout(idleTimeout)
+
+    # Receive more data from the socket into the buffer
+    # Raises: TimeoutError if nothing arrives within idleTimeout or before the deadline
+    # Returns: False once the peer has closed the connection
+    def fill(self):
+        if self.eof:
+            return False
+        deadline = self.deadline
+        if self.idleTimeout is not None:
+            idleDeadline = time.monotonic() + self.idleTimeout
+            deadline = idleDeadline if deadline is None else min(deadline, idleDeadline)
+        try:
+            nbytes = interruptible_recv_into(self.sock, self.rbuf.space(), deadline)
+        except TimeoutError:
+            self.timedOut = True
+            raise
+        iostats.count('recv')
+        if nbytes == 0:
+            self.eof = True
+            return False
+        self.rbuf.advance(nbytes)
+        return True
+
+    # Read a request or status line and its headers, up to the blank line
+    # Raises: HeaderTooLarge if the section runs past MAX_HEADER_BYTES
+    # Returns: The header section, or b'' if the peer closed before completing it
+    def read_head(self):
+        while True:
+            head = self.rbuf.take_head()
+            if head is not None:
+                return head
+            if not self.fill():
+                return b''
+
+    def readline(self):
+        while True:
+            line = self.rbuf.take_line()
+            if line is not None:
+                return line
+            if not self.fill():
+                return self.rbuf.take(len(self.rbuf))
+
+    # Read up to nbytes, returning b'' at EOF
+    def read(self, nbytes):
+        if not len(self.rbuf):
+            self.fill()
+        return self.rbuf.take(nbytes)
+
+    # Read up to nbytes without copying them out of the receive buffer
+    # The view is only valid until the next read
+    def read_view(self, nbytes):
+        if not len(self.rbuf):
+            self.fill()
+        return self.rbuf.take_view(nbytes)
+
+    def write(self, data):
+        self.writev([data])
+
+    # Send several buffers with a single sendmsg() call
+    def writev(self, buffers):
+        total = sum(len(b) for b in buffers)
+        self.sent += total
+        try:
+            sent = self.sock.sendmsg(buffers)
+            iostats.count('send')
+            if sent < total:
+                self.sock.sendall(memoryview(b''.join(buffers))[sent:])
+                iostats.count('send')
+        except TimeoutError:
+            self.timedOut = True
+            raise
+
+    # Send count bytes of a file from offset with sendfile(), without reading them in
+    # socket.sendfile() falls back to read() and send() where os.sendfile() isn't available
+    # With an idleTimeout, each piece sendfile() sends has that long to go out
+    def sendfile(self, file, offset, count):
+        try:
+            self.sock.sendfile(file, offset, count)
+        except TimeoutError:
+            self.timedOut = True
+            raise
+        iostats.count('sendfile')
+        self.sent += count
+
+    def flush(self):
+        pass
 
 # Read an HTTP message from a socket file object and parse it
-# sockf: Socket file object to read from
-# Returns: (headline: str, [(header: str, header_value: str)])
+# sockf: SocketFile to read from
+# Returns: (headline: str, Headers)
 def parse_http_headers(sockf):
-    # Read the first line from the HTTP message
-    # This will either be the Request Line (request) or the Status Line (response)
-    headline = interruptible_readline(sockf).decode().strip()
-
-    # Set up list for headers
-    headers = []
+    # Read everything up to the empty line '\r\n' that ends the header section,
+    # then split out the first line and the headers.
+    # The first line will either be the Request Line (request) or the Status Line (response)
+    return parse_head(sockf.read_head())
+
+# Decode a chunked body, yielding chunk data as it arrives
+# A piece is yielded as soon as it is received, without waiting for the rest
+# of its chunk. Chunk extensions and trailer fields are dropped
+# sockf: SocketFile to read from
+# Yields: memoryviews of chunk data, each only valid until the next one is asked for
+def dechunk(sockf):
     while True:
-        # Read a line at a time
-        header = interruptible_readline(sockf).decode()
-        # If it's the empty line '\r\n', it's the end of the header section
-        if len(header.rstrip('\r\n')) == 0:
+        sizeLine = sockf.readline()
+        if not sizeLine.endswith(b'\n'):
+            raise ConnectionError('connection closed mid-body')
+        chunkSize = chunk_size(sizeLine)
+        if chunkSize == 0:
+            break
+        while chunkSize > 0:
+            data = sockf.read_view(chunkSize)
+            if not data:
+                raise ConnectionError('connection closed mid-body')
+            chunkSize -= len(data)
+            yield data
+        if sockf.readline().strip():
+            raise ValueError('chunk data longer than its size')
+
+    # Trailer section, ended by an empty line
+    while True:
+        trailer = sockf.readline()
+        if not trailer.endswith(b'\n'):
+            raise ConnectionError('connection closed mid-body')
+        if not trailer.strip():
             break
 
-        # Partition header by colon
-        headerPartitions = header.partition(':')
-
-        # Skip if there's no colon
-        if headerPartitions[1] == '':
-            continue
-
-        headers.append((headerPartitions[0].strip(), headerPartitions[2].strip()))
-
-    return(headline, headers)
+# Read a response body a receive buffer at a time
+# sockf: SocketFile to read from
+# bodyLength: From response_body_length()
+# Yields: memoryviews of the body, each only valid until the next one is asked for
+def read_body(sockf, bodyLength):
+    if bodyLength == 'chunked':
+        yield from dechunk(sockf)
+    elif bodyLength is None:
+        # No framing: the body ends when the server closes the connection
+        while True:
+            bodyChunk = sockf.read_view(65536)
+            if not bodyChunk:
+                break
+            yield bodyChunk
+    else:
+        while bodyLength > 0:
+            bodyChunk = sockf.read_view(bodyLength)
+            if not bodyChunk:
+                raise ConnectionError('connection closed mid-body')
+            bodyLength -= len(bodyChunk)
+            yield bodyChunk
 
 # Forward a server response to the client and save to cache
+# The status line and headers are serialized once and go out together with the
+# first piece of the body: one sendmsg() to the client and one writev() to the cache
+# A chunked body is decoded as it arrives and passed on as a plain body, which
+# the closing connection ends; the cache stores the plain body too, so hits get
+# a Content-Length worked out from its size
 # sockf: Socket file object connected to server
-# fileCachePath: Path to cache file
+# cachef: CacheFile to store the response in, or None. It is committed once the
+#         whole response is in it, and aborted otherwise
 # clisockf: Socket file object connected to client
-def forward_and_cache_response(sockf, fileCachePath, clisockf):
-    cachef = None
-
-    # Create the intermediate directories to the cache file
-    if fileCachePath is not None:
-        os.makedirs(os.path.dirname(fileCachePath), exist_ok=True)
-        # Open/create cache file
-        cachef = open(fileCachePath, 'w+b')
-
+# head: (statusLine, headers) if they have already been read from the server
+# method: Method of the forwarded request
+# coding: Content coding to compress a compressible response with before it is
+#         stored, or None to store it as it is
+def forward_and_cache_response(sockf, cachef, clisockf, head=None, method='GET', coding=None):
+    complete = False
     try:
         # Read response from server
-        statusLine, headers = parse_http_headers(sockf)
+        statusLine, headers = head if head is not None else parse_http_headers(sockf)
+        bodyLength = response_body_length(method, statusLine, headers)
+        if bodyLength == 'chunked':
+            headers = strip_chunked(headers)
         # Filter out the Connection header from the server
         headers = [h for h in headers if h[0] != 'Connection']
         # Replace with our own Connection header
-        # We will close all connections after sending the response.
-        # This is an inefficient,  single-threaded proxy!
+        # The blocking fallback serves one request per client connection and closes
+        # it after the response; keep-alive is only implemented in the engine
         headers.append(('Connection', 'close'))
         # Fill in start.
-        
-        # Write status line to client and cache
-        statusLineBytes = (statusLine + '\r\n').encode()
-        clisockf.write(statusLineBytes)
-        if cachef is not None:
-            cachef.write(statusLineBytes)
-        
-        # Write headers to client and cache
-        for header in headers:
-            headerLine = f'{header[0]}: {header[1]}\r\n'.encode()
-            clisockf.write(headerLine)
-            if cachef is not None:
-                cachef.write(headerLine)
-        
-        # Write empty line to separate headers from body
-        clisockf.write(b'\r\n')
-        if cachef is not None:
-            cachef.write(b'\r\n')
-        
-        # Get Content-Length if present
-        contentLength = None
-        for header in headers:
-            if header[0].lower() == 'content-length':
-                contentLength = int(header[1])
-                break
-        
-        # Read and forward body
-        if contentLength is not None:
-            # If content length is known, read that many bytes
-            bytesLeft = contentLength
-            while bytesLeft > 0:
-                chunkSize = min(4096, bytesLeft)
-                bodyChunk = interruptible_read(sockf, chunkSize)
-                if not bodyChunk:
-                    break
-                clisockf.write(bodyChunk)
+
+        # Status line, headers and the empty line that separates them from the body
+        # The cache copy leaves out the Connection header, which is per connection
+        head = header_block(statusLine, headers)
+        cacheHead = header_block(statusLine, headers[:-1])
+        if cachef is not None and coding is not None and should_compress(statusLine, headers):
+            # The encoder stores its own header section ahead of the compressed body
+            cachef = EncodingCacheFile(cachef, CODECS[coding],
+                                       header_block(statusLine, encoded_headers(headers[:-1], coding)))
+            cacheHead = b''
+
+        # Read and forward the body as it arrives
+        for bodyChunk in read_body(sockf, bodyLength):
+            if head is not None:
+                clisockf.writev([head, bodyChunk])
                 if cachef is not None:
-                    cachef.write(bodyChunk)
-                bytesLeft -= len(bodyChunk)
-        else:
-            # If content length is not known, read until EOF
-            while True:
-                bodyChunk = interruptible_read(sockf, 4096)
-                if not bodyChunk:
-                    break
+                    cachef.writev([cacheHead, bodyChunk])
+                head = None
+            else:
                 clisockf.write(bodyChunk)
                 if cachef is not None:
                     cachef.write(bodyChunk)
-        
+
+        # Response without a body
+        if head is not None:
+            clisockf.write(head)
+            if cachef is not None:
+                cachef.write(cacheHead)
+
         clisockf.flush()
+        # read_body() raises if the server closed the connection before the whole body was sent
+        complete = len(statusLine) > 0
 
         # Fill in end.
     except Exception as e:
         print(e)
     finally:
         if cachef is not None:
-            cachef.close()
+            if complete:
+                cachef.commit()
+            else:
+                cachef.abort()
+
+# Copy a body of known length from one socket file to another, a receive
+# buffer at a time, so memory use doesn't grow with the size of the body
+# sockf: SocketFile to read from
+# nbytes: Number of bytes to copy
+# destf: SocketFile to write to
+# held: Buffers to send together with the first piece, e.g. a header section
+def copy_body(sockf, nbytes, destf, held=()):
+    held = list(held)
+    while nbytes > 0:
+        bodyChunk = sockf.read_view(nbytes)
+        if not bodyChunk:
+            raise ConnectionError('connection closed mid-body')
+        destf.writev(held + [bodyChunk])
+        held = []
+        nbytes -= len(bodyChunk)
+    if held:
+        destf.writev(held)
+
+# Relay a chunked body as-is, following the chunk framing to find its end
+# sockf: SocketFile to read from
+# destf: SocketFile to write to
+# held: Buffers to send together with the first piece, e.g. a header section
+def relay_chunked(sockf, destf, held=()):
+    held = list(held)
+    while True:
+        sizeLine = sockf.readline()
+        if not sizeLine:
+            raise ConnectionError('connection closed mid-body')
+        held.append(sizeLine)
+        chunkSize = chunk_size(sizeLine)
+        if chunkSize == 0:
+            break
+        # Chunk data plus its trailing CRLF
+        copy_body(sockf, chunkSize + 2, destf, held)
+        held = []
+
+    # Trailer section, ended by an empty line
+    while True:
+        trailer = sockf.readline()
+        held.append(trailer)
+        if len(trailer.rstrip(b'\r\n')) == 0:
+            break
+    destf.writev(held)
 
 # Forward a client request to a server
+# The request body, if any, is streamed from the client behind the request head
 # sockf: Socket file object connected to server
 # requestUri: The request URI to request from the server
 # hostn: The Host header value to include in the forwarded request
 # origRequestLine: The Request Line from the original client request
 # origHeaders: The HTTP headers from the original client request
-def forward_request(sockf, requestUri, hostn, origRequestLine, origHeaders):
+# clisockf: Socket file object connected to client, to read the request body from
+# bodyLength: Length of the request body, or 'chunked', from request_body_length()
+def forward_request(sockf, requestUri, hostn, origRequestLine, origHeaders, clisockf=None, bodyLength=0):
     # Filter out the original Host header and replace it with our own
-    headers = [h for h in origHeaders if h[0] != 'Host']
+    # The proxy answers Expect: 100-continue itself, so the server mustn't see it
+    headers = [h for h in origHeaders if h[0] != 'Host' and h[0].lower() != 'expect']
     headers.append(('Host', hostn))
     # Send request to the server
     # Fill in start.
@@ -162,65 +363,313 @@ def forward_request(sockf, requestUri, hostn, origRequestLine, origHeaders):
     method = requestLineParts[0]
     version = requestLineParts[2]
 
-    # Write request line
-    newRequestLine = f'{method} {requestUri} {version}\r\n'
-    sockf.write(newRequestLine.encode())
-
-    # Write headers
-    for header in headers:
-        headerLine = f'{header[0]}: {header[1]}\r\n'
-        sockf.write(headerLine.encode())
-
-    # Write empty line to end headers
-    sockf.write(b'\r\n')
+    # Request line, headers and the empty line that ends them, sent in the same
+    # sendmsg() as the first piece of the body
+    head = header_block(f'{method} {requestUri} {version}', headers)
+    if bodyLength != 0 and expects_continue(origHeaders):
+        clisockf.write(CONTINUE)
+    if bodyLength == 'chunked':
+        relay_chunked(clisockf, sockf, [head])
+    elif bodyLength > 0:
+        copy_body(clisockf, bodyLength, sockf, [head])
+    else:
+        sockf.write(head)
     sockf.flush()
 
     # Fill in end.
 
-def proxyServer(port):
-    if os.path.isdir(cacheDir):
-        shutil.rmtree(cacheDir)
+# Send a cached response to the client, closing the connection after it
+# Small responses are promoted to the memory cache; for big ones only the first
+# block is read, and the rest of the body is streamed with sendfile()
+# clisockf: SocketFile connected to client
+# cachef: Stored response from DiskCache.open(), closed once it has been sent
+# memCache: MemoryCache to promote the response into
+# key: cache_key() of the response
+# requestHeaders: Headers of the request, for any Range and Accept-Encoding, or None
+def send_cached_response(clisockf, cachef, memCache, key, requestHeaders=None):
+    with cachef:
+        size = cachef.size
+        if size <= memCache.maxEntrySize:
+            # Small enough to promote to the memory cache
+            entry = make_entry(cachef.read())
+            memCache.put(key, entry)
+            send_entry(entry, clisockf, requestHeaders)
+            return
+        # Send the header section, with our Connection header, and the
+        # start of the body read along with it
+        data, headerEnd = read_cached_head(cachef)
+        if requestHeaders is not None:
+            codec = codec_to_decode(data[:headerEnd], requestHeaders)
+            if codec is not None:
+                send_decoded(clisockf, data[:headerEnd - 4], decode(codec, file_pieces(cachef, headerEnd)))
+                return
+        if requestHeaders is not None and requestHeaders.get('Range') is not None:
+            ranges = requested_ranges(data[:headerEnd - 4], size - headerEnd, requestHeaders)
+            if ranges is not None:
+                send_ranges(clisockf, cachef, headerEnd, data[:headerEnd - 4], ranges, size - headerEnd)
+                return
+        clisockf.writev([cached_head(data[:headerEnd - 4], size - headerEnd, False),
+                         memoryview(data)[headerEnd:]])
+        # sendfile() streams the rest from the page cache to the socket, so a
+        # big cached response is never read into memory
+        clisockf.sendfile(cachef.file, cachef.base + len(data), size - len(data))
+
+# Send byte ranges of a cache file: each range is seeked to and sent with
+# sendfile(), so a small range of a large response doesn't read the rest of it
+# clisockf: SocketFile connected to client
+# cachef: Stored response opened for reading
+# bodyStart: Offset of the body in the response
+# head: Stored header section without its blank line
+# ranges: [(first, last)] from requested_ranges()
+# bodySize: Size of the stored body
+def send_ranges(clisockf, cachef, bodyStart, head, ranges, bodySize):
+    head, parts = range_response(head, ranges, bodySize, False)
+    buffers = [head]
+    for part in parts:
+        if isinstance(part, bytes):
+            buffers.append(part)
+            continue
+        clisockf.writev(buffers)
+        buffers = []
+        clisockf.sendfile(cachef.file, cachef.base + bodyStart + part[0], part[1])
+    if buffers:
+        clisockf.writev(buffers)
+
+# Answer a CONNECT request: connect to the host and port it names and relay
+# bytes between it and the client until both are done
+# The proxy serves nobody else while the tunnel is open
+# clisockf: SocketFile connected to client
+# target: Request target, host:port
+# dnsCache: DnsCache to resolve the host with
+# breaker: CircuitBreaker of the origins
+# negativeTtls: How long a failed connect keeps the circuit open, as in NEGATIVE_TTLS
+# timer: RequestTimer of the request
+def serve_tunnel(clisockf, target, dnsCache, breaker, negativeTtls, timer):
+    address = connect_target(target)
+    if address is None:
+        timer.source = 'error'
+        clisockf.write(error_response('400 Bad Request'))
+        return
+    if not breaker.allow(address):
+        print(f'Circuit open for {target}')
+        timer.source = 'error'
+        clisockf.write(error_response('503 Service Unavailable'))
+        return
+
+    c = socket(AF_INET, SOCK_STREAM)
+    try:
+        resolved = dnsCache.resolve(*address)
+        timer.mark('dns')
+        c.settimeout(CONNECT_TIMEOUT)
+        c.connect(resolved)
+        c.settimeout(None)
+        timer.mark('connect')
+    except OSError as e:
+        print(e)
+        c.close()
+        breaker.failure(address, negativeTtls['connect'])
+        metrics.error('connect')
+        timer.source = 'error'
+        clisockf.write(error_response('504 Gateway Timeout' if isinstance(e, TimeoutError) else '502 Bad Gateway'))
+        return
+    breaker.success(address)
+
+    timer.source = 'tunnel'
+    tunnel = Tunnel(target)
+    try:
+        clisockf.write(ESTABLISHED)
+        # Anything the client sent right behind its request is the start of the tunnel's traffic
+        relay(clisockf.sock, c, tunnel, clisockf.rbuf.take(len(clisockf.rbuf)))
+    except OSError as e:
+        print(e)
+    finally:
+        c.close()
+        tunnel.close()
+        timer.mark('transfer')
+        print(tunnel.summary())
+
+# Send a memory cache entry, or the byte ranges of it the request asks for
+# entry: (data: bytes, headerEnd: int) from make_entry()
+# clisockf: SocketFile connected to client
+# requestHeaders: Headers of the request, for any Range and Accept-Encoding, or None
+def send_entry(entry, clisockf, requestHeaders=None):
+    data, headerEnd = entry
+    ranges = None
+    if requestHeaders is not None:
+        codec = codec_to_decode(data[:headerEnd], requestHeaders)
+        if codec is not None:
+            send_decoded(clisockf, data[:headerEnd - 4], decode(codec, [memoryview(data)[headerEnd:]]))
+            return
+        if requestHeaders.get('Range') is not None:
+            ranges = requested_ranges(data[:headerEnd - 4], len(data) - headerEnd, requestHeaders)
+    if ranges is None:
+        clisockf.writev(entry_buffers(entry, False))
+        return
+    head, parts = range_response(data[:headerEnd - 4], ranges, len(data) - headerEnd, False)
+    view = memoryview(data)[headerEnd:]
+    clisockf.writev([head] + [part if isinstance(part, bytes) else view[part[0]:part[0] + part[1]] for part in parts])
+
+# Send a stored response decoded from its content coding, for a client that
+# doesn't accept the coding. The decoded size isn't known up front, so the
+# body is ended by closing the connection
+# clisockf: SocketFile connected to client
+# head: Stored header section without its blank line
+# pieces: Iterable of the decoded body, from decode()
+def send_decoded(clisockf, head, pieces):
+    statusLine, headers = parse_head(head)
+    headers = decoded_headers([h for h in headers if h[0] != 'Connection']) + [('Connection', 'close')]
+    held = [header_block(statusLine, headers)]
+    for data in pieces:
+        clisockf.writev(held + [data])
+        held = []
+    if held:
+        clisockf.writev(held)
+
+# Run the proxy on a port
+# port: Port to listen on
+# mode: 'event' serves every client concurrently on the event-loop engine in engine.py,
+#       'blocking' serves one client at a time with the loop below
+# cacheDir: Directory of the disk cache; entries from earlier runs are served
+# staleWhileRevalidate: Seconds past expiry a response without its own stale-while-revalidate
+#                       is served while it is refreshed in the background ('event' only)
+# staleIfError: Seconds past expiry a response without its own stale-if-error
+#               is served when the origin can't be reached or answers with a server error
+# negativeTtls: How long errors are cached, by class, as in NEGATIVE_TTLS
+# storeCoding: Content coding compressible responses are stored with, or None to store them as they are
+# cacheLayout: 'files' keeps each cached response in a file of its own, 'segments' appends them to segment files
+# workers: Number of processes to serve in; more than one runs a prefork supervisor (prefork.py)
+#          whose workers share the port with SO_REUSEPORT
+# worker: Number of the worker this is, when running under the supervisor
+def proxyServer(port, mode='event', cacheDir=cacheDir, staleWhileRevalidate=STALE_WHILE_REVALIDATE,
+                staleIfError=STALE_IF_ERROR, negativeTtls=NEGATIVE_TTLS, storeCoding=STORE_CODING, cacheLayout='files',
+                workers=1, worker=None):
+    if workers > 1:
+        prefork.supervise(workers, lambda worker: proxyServer(port, mode, cacheDir, staleWhileRevalidate, staleIfError,
+                                                              negativeTtls, storeCoding, cacheLayout, worker=worker))
+        sys.exit()
+
+    # Size-bounded store of cached responses under cacheDir, warm from the last run
+    if worker is not None and cacheLayout != 'files':
+        # Only the 'files' layout can be shared, so each worker keeps segments of its own
+        diskCache = DiskCache(os.path.join(cacheDir, f'worker-{worker}'), layout=cacheLayout)
+    else:
+        diskCache = DiskCache(cacheDir, layout=cacheLayout, worker=worker)
+    # Origin host names are only resolved again once their resolution expires
+    dnsCache = DnsCache()
     # Create a server socket, bind it to a port and start listening
     tcpSerSock = socket(AF_INET, SOCK_STREAM)
 
     # Fill in start.
     
     tcpSerSock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if worker is not None:
+        # Every worker listens on the port, and the kernel spreads connections over them
+        tcpSerSock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     tcpSerSock.bind(('', port))
-    tcpSerSock.listen(5)
 
     # Fill in end.
 
+    if mode == 'event':
+        # Thousands of clients may be connecting at once, so allow a long accept queue
+        tcpSerSock.listen(SOMAXCONN)
+        try:
+            engine.run(tcpSerSock, diskCache, staleWhileRevalidate, staleIfError, negativeTtls, dnsCache, storeCoding)
+        except KeyboardInterrupt:
+            pass
+        diskCache.close()
+        tcpSerSock.close()
+        sys.exit()
+
+    tcpSerSock.listen(5)
+
+    # Hot responses are kept in memory in front of the disk cache
+    memCache = MemoryCache()
+    # Origins that are failing are not asked again until their circuit closes
+    breaker = CircuitBreaker()
+
+    # SIGTERM lets the client being served finish, then stops the loop
+    serving = {'busy': False, 'stopping': False}
+
+    def stop(signum, frame):
+        serving['stopping'] = True
+        if not serving['busy']:
+            raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+
     tcpCliSock = None
     try:
-        while 1:
+        while not serving['stopping']:
             # Start receiving data from the client
             print('Ready to serve...')
+            acceptStart = time.perf_counter()
             tcpCliSock, addr = interruptible_accept(tcpSerSock)
+            serving['busy'] = True
+            metrics.observe('accept', time.perf_counter() - acceptStart)
+            metrics.connection_opened()
 
             print('Received a connection from:', addr)
-            cliSock_f = tcpCliSock.makefile('rwb', 0)
-
-            # Read and parse request from client
-            requestLine, requestHeaders = parse_http_headers(cliSock_f)
+            cliSock_f = SocketFile(tcpCliSock, BODY_TIMEOUT)
+
+            # Read and parse request from client, timing it from when its first bytes arrive
+            # Every other client waits while this one is served, so it only gets
+            # HEADER_TIMEOUT from accept() to send its whole header section
+            cliSock_f.deadline = time.monotonic() + HEADER_TIMEOUT
+            try:
+                cliSock_f.fill()
+                timer = RequestTimer()
+                requestLine, requestHeaders = parse_http_headers(cliSock_f)
+                timer.mark('parse')
+            except (TimeoutError, HeaderTooLarge) as e:
+                print(e)
+                timedOut = isinstance(e, TimeoutError)
+                metrics.error('timeout' if timedOut else 'client')
+                try:
+                    cliSock_f.write(error_response('408 Request Timeout' if timedOut
+                                                   else '431 Request Header Fields Too Large'))
+                except OSError as e:
+                    print(e)
+                requestLine = ''
+            cliSock_f.deadline = None
             print(requestLine)
 
             if len(requestLine) == 0:
+                tcpCliSock.close()
+                metrics.connection_closed()
+                serving['busy'] = False
                 continue
 
             # Extract the request URI from the given message
             requestUri = requestLine.split()[1]
-
-            # if a scheme is included, split off the scheme, otherwise split off a leading slash
-            uri_parts = requestUri.partition('http://')
-            if uri_parts[1] == '':
-                filename = requestUri.partition('/')[2]
-            else:
-                filename = uri_parts[2]
+            filename = request_filename(requestUri)
 
             print(f'filename: {filename}')
 
-            if len(filename) > 0:
+            if requestUri == METRICS_PATH:
+                # Asked for the proxy's own metrics rather than for an origin
+                timer.source = 'admin'
+                try:
+                    cliSock_f.write(metrics_response(False, cache_gauges(diskCache, memCache)))
+                except OSError as e:
+                    print(e)
+                timer.finish(cliSock_f.sent)
+            elif requestLine.split()[0] == 'CONNECT':
+                try:
+                    serve_tunnel(cliSock_f, requestUri, dnsCache, breaker, negativeTtls, timer)
+                except OSError as e:
+                    print(e)
+                iostats.count('responses')
+                timer.finish(cliSock_f.sent)
+            elif request_body_length(requestHeaders) is None:
+                # A Content-Length that isn't a number: there is no telling where the body ends
+                timer.source = 'error'
+                try:
+                    cliSock_f.write(error_response('400 Bad Request'))
+                except OSError as e:
+                    print(e)
+                iostats.count('responses')
+                timer.finish(cliSock_f.sent)
+            elif len(filename) > 0:
                 # Compute the path to the cache file from the request URI
                 # Change for Part Three
                 fileCachePath = None
@@ -231,12 +680,37 @@ def proxyServer(port):
                 method = requestLine.split()[0]
                 
                 # Only cache GET requests (not POST, PUT, DELETE, etc.)
+                entry = None
+                # Header section of a stale entry being revalidated
+                storedHead = None
+                forwardHeaders = requestHeaders
+                # Whether a stale entry can be served if the origin fails
+                staleOk = False
                 if method == 'GET':
-                    # Create a hash of the filename to use as cache file name
-                    filename_hash = hashlib.md5(filename.encode()).hexdigest()
-                    fileCachePath = os.path.join(cacheDir, filename_hash)
+                    # Create a hash of the filename to use as cache file name, or of the
+                    # filename and the request headers that select one of its variants
+                    urlKey = cache_key(filename)
+                    key = diskCache.select(urlKey, requestHeaders)
                     # Check if cache file exists
-                    cached = os.path.isfile(fileCachePath)
+                    onDisk = diskCache.lookup(key)
+                    fileCachePath = diskCache.path(key)
+                    # Only fresh entries are served as they are; a client asking for
+                    # no-cache gets a revalidated response
+                    cached = diskCache.fresh(key) and 'no-cache' not in cache_control(requestHeaders)
+                    entry = memCache.get(key) if cached else None
+                    if onDisk and not cached:
+                        # Stale: ask the origin whether it has changed, if it can tell us
+                        try:
+                            head = read_stored_head(diskCache.open(key))
+                            staleOk = diskCache.staleness(key) < stale_windows(head, 0, staleIfError)[1]
+                            validators = stored_validators(head)
+                            if validators:
+                                storedHead = head
+                                forwardHeaders = revalidation_headers(requestHeaders, validators)
+                        except FileNotFoundError as e:
+                            print(e)
+                            diskCache.remove(key, unlink=False)
+                    timer.mark('lookup')
                 # Fill in end.
                 
                 print(f'fileCachePath: {fileCachePath}')
@@ -246,11 +720,17 @@ def proxyServer(port):
                     # Read response from cache and transmit to client
                     # Fill in start.
 
+                    timer.source = 'cache'
                     try:
-                        with open(fileCachePath, 'r+b') as cachef:
-                            data = cachef.read()
-                            cliSock_f.write(data)
-                            cliSock_f.flush()
+                        if entry is None:
+                            send_cached_response(cliSock_f, diskCache.open(key), memCache, key, requestHeaders)
+                        else:
+                            send_entry(entry, cliSock_f, requestHeaders)
+                        timer.mark('transfer')
+                    except FileNotFoundError as e:
+                        # Deleted behind the index's back: forget it so the next request refetches it
+                        print(e)
+                        diskCache.remove(key, unlink=False)
                     except Exception as e:
                         print(e)
 
@@ -266,60 +746,122 @@ def proxyServer(port):
                     # Fill in start.
 
                     # Parsing host name and port number
-                    if ':' in hostn:
-                        hostname, portn = hostn.split(':')
-                        portn = int(portn)
-                    else:
-                        hostname = hostn
-                        portn = 80
+                    hostname, portn = split_host(hostn)
                     
                     # Fill in end.
 
+                    origin = (hostname, portn)
+                    # Whether anything has been sent to the client yet
+                    answered = False
+                    # What to tell the client if the origin gives no response to relay
+                    errorStatus = '502 Bad Gateway'
                     try:
+                        if not breaker.allow(origin):
+                            # The origin has been failing: don't wait on it again yet
+                            errorStatus = '503 Service Unavailable'
+                            raise ConnectionRefusedError(f'Circuit open for {hostn}')
+
                         # Connect to the socket
                         # Fill in start.
 
-                        c.connect((hostname, portn))
+                        try:
+                            address = dnsCache.resolve(hostname, portn)
+                            timer.mark('dns')
+                            c.settimeout(CONNECT_TIMEOUT)
+                            c.connect(address)
+                            timer.mark('connect')
+                        except OSError:
+                            # There is no response to cache, so the origin is remembered instead
+                            breaker.failure(origin, negativeTtls['connect'])
+                            metrics.error('connect')
+                            raise
 
                         # Fill in end.
 
                         # Create a temporary file on this socket and ask port 80 for the file requested by the client
-                        fileobj = c.makefile('rwb', 0)
-                        
-                        # For POST requests, read the body from client first
-                        post_body = None
-                        if method == 'POST':
-                            content_length = None
-                            for header in requestHeaders:
-                                if header[0].lower() == 'content-length':
-                                    content_length = int(header[1])
-                                    break
-                            
-                            if content_length is not None and content_length > 0:
-                                post_body = b''
-                                bytes_remaining = content_length
-                                while bytes_remaining > 0:
-                                    chunk_size = min(4096, bytes_remaining)
-                                    data = interruptible_read(cliSock_f, chunk_size)
-                                    if len(data) == 0:
-                                        break
-                                    post_body += data
-                                    bytes_remaining -= len(data)
-                        
-                        forward_request(fileobj, f'/{filename.partition("/")[2]}', hostn, requestLine, requestHeaders)
+                        # From here on the origin gets UPSTREAM_IDLE_TIMEOUT for each receive and send
+                        fileobj = SocketFile(c, UPSTREAM_IDLE_TIMEOUT)
                         
-                        # Send POST body after headers if present
-                        if post_body is not None:
-                            fileobj.write(post_body)
-                            fileobj.flush()
-
-                        # Read the response from the server, cache, and forward it to client
-                        forward_and_cache_response(fileobj, fileCachePath, cliSock_f)
+                        # Send the request, streaming any body (POST, PUT, PATCH...) from the client
+                        forward_request(fileobj, f'/{filename.partition("/")[2]}', hostn, requestLine, forwardHeaders,
+                                        cliSock_f, request_body_length(requestHeaders))
+
+                        statusLine, headers = parse_http_headers(fileobj)
+                        timer.mark('first_byte')
+                        if statusLine.split()[1] in SERVER_ERRORS:
+                            breaker.failure(origin)
+                        else:
+                            breaker.success(origin)
+                        if staleOk and statusLine.split()[1] in SERVER_ERRORS:
+                            print(statusLine)
+                        elif storedHead is not None and statusLine.split()[1] == '304':
+                            answered = True
+                            # Unchanged: keep the stored body and only refresh its expiry
+                            diskCache.refresh(key, refreshed_expiry(storedHead, headers, requestHeaders) or 0)
+                            timer.source = 'cache'
+                            send_cached_response(cliSock_f, diskCache.open(key), memCache, key, requestHeaders)
+                            timer.mark('transfer')
+                            print('Revalidated cache')
+                        else:
+                            answered = True
+                            # Read the response from the server, cache, and forward it to client
+                            cachef = None
+                            if method == 'GET':
+                                # Whatever was cached is out of date now
+                                memCache.discard(key)
+                                expires = response_expiry(statusLine, headers, requestHeaders, negativeTtls=negativeTtls)
+                                if expires is not None:
+                                    # The response may vary on other headers than it was looked up by
+                                    storeKey = diskCache.store_key(urlKey, vary_names(headers), requestHeaders)
+                                    memCache.discard(storeKey)
+                                    cachef = diskCache.open_entry(storeKey, expires)
+                                else:
+                                    diskCache.remove(key)
+                            timer.source = 'origin'
+                            forward_and_cache_response(fileobj, cachef, cliSock_f, (statusLine, headers), method,
+                                                       storeCoding)
+                            timer.mark('transfer')
+                    except TimeoutError as e:
+                        print(e)
+                        if cliSock_f.timedOut:
+                            # The client stopped sending its request body, or taking the response
+                            errorStatus = '408 Request Timeout'
+                            metrics.error('timeout')
+                        else:
+                            errorStatus = '504 Gateway Timeout'
+                            # Failures to connect have been counted already
+                            if 'connect' in timer.phases:
+                                metrics.error('upstream')
                     except Exception as e:
                         print(e)
+                        if 'connect' in timer.phases:
+                            metrics.error('upstream')
                     finally:
                         c.close()
+
+                    if staleOk and not answered:
+                        # The origin failed: a stale copy is better than an error
+                        timer.source = 'cache'
+                        try:
+                            send_cached_response(cliSock_f, diskCache.open(key), memCache, key, requestHeaders)
+                            print('Read stale from cache after an origin error')
+                        except Exception as e:
+                            print(e)
+                    elif not answered:
+                        timer.source = 'error'
+                        try:
+                            cliSock_f.write(error_response(errorStatus))
+                        except OSError as e:
+                            print(e)
+                    timer.mark('transfer')
+
+                iostats.count('responses')
+                timer.finish(cliSock_f.sent)
             tcpCliSock.close()
+            metrics.connection_closed()
+            # Between clients, reclaim a little of the space dead segment entries take up
+            diskCache.compact()
+            serving['busy'] = False
     except KeyboardInterrupt:
         pass
 
@@ -329,9 +871,15 @@ def proxyServer(port):
     if tcpCliSock is not None:
         tcpCliSock.close()
     tcpSerSock.close()
+    diskCache.close()
 
     # Fill in end.
     sys.exit()
 
 if __name__ == "__main__":
-    proxyServer(8888)
\ No newline at end of file
+    # Usage: python proxy.py [port] [event|blocking] [files|segments] [workers]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8888
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'event'
+    cacheLayout = sys.argv[3] if len(sys.argv) > 3 else 'files'
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    proxyServer(port, mode, cacheLayout=cacheLayout, workers=workers)
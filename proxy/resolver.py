@@ -0,0 +1,140 @@
+# Cache of origin host name resolutions, shared by the blocking proxy loop and
+# the event-loop engine, so a cache miss doesn't wait on getaddrinfo() every time
+from socket import *
+import asyncio
+import threading
+import time
+
+import iostats
+
+# Seconds a resolution is used for; getaddrinfo() doesn't report the record's TTL
+DNS_TTL = 60.0
+# Seconds a failed resolution is remembered for
+DNS_NEGATIVE_TTL = 5.0
+# Share of DNS_TTL after which a resolution is refreshed in the background, so
+# a host that keeps being asked for never has to be resolved by a request
+DNS_REFRESH_AHEAD = 0.8
+
+# Resolve a host name with getaddrinfo()
+# Returns: [(ip: str, portn: int)], in the order the resolver gave them
+def getaddrinfo_resolver(hostname, portn):
+    addresses = []
+    for family, type, proto, canonname, sockaddr in getaddrinfo(hostname, portn, AF_INET, SOCK_STREAM):
+        if sockaddr not in addresses:
+            addresses.append(sockaddr)
+    return addresses
+
+# Resolved addresses of one (host, port), or the error resolving it failed with
+class DnsEntry:
+    def __init__(self, addresses, error, expires, refreshAt):
+        self.addresses = addresses
+        self.error = error
+        self.expires = expires
+        self.refreshAt = refreshAt
+        # Round-robin position in addresses
+        self.next = 0
+
+    # Get the address to connect to next, going round the addresses in turn
+    def next_address(self):
+        address = self.addresses[self.next % len(self.addresses)]
+        self.next += 1
+        return address
+
+# Resolution cache with TTLs, negative caching and refresh ahead of expiry
+# A host with several addresses is connected to on each of them in turn
+# ttl: Seconds a resolution is used for
+# negativeTtl: Seconds a failed resolution is remembered for
+# refreshAhead: Share of ttl after which a resolution is refreshed in a background thread
+# resolver: Function of (hostname, portn) returning [(ip, portn)], or raising OSError
+class DnsCache:
+    def __init__(self, ttl=DNS_TTL, negativeTtl=DNS_NEGATIVE_TTL, refreshAhead=DNS_REFRESH_AHEAD,
+                 resolver=getaddrinfo_resolver):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.refreshAhead = refreshAhead
+        self.resolver = resolver
+        # (hostname, portn) -> DnsEntry
+        self.entries = {}
+        # (hostname, portn) -> Thread refreshing it
+        self.refreshing = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Get the next address of a host from the cache without resolving it
+    # Starts a background refresh if the resolution is due for one
+    # Raises: OSError if resolving the host failed less than negativeTtl ago
+    # Returns: (ip: str, portn: int), or None if the host has to be resolved first
+    def cached(self, hostname, portn, now=None):
+        key = (hostname, portn)
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.expires <= now:
+                return None
+            self.hits += 1
+            if entry.error is not None:
+                # A new exception each time, as raising one again adds to its traceback
+                raise type(entry.error)(*entry.error.args)
+            if now >= entry.refreshAt and key not in self.refreshing:
+                thread = self.refreshing[key] = threading.Thread(target=self.refresh_in_background, args=key,
+                                                                 daemon=True)
+                thread.start()
+            return entry.next_address()
+
+    # Resolve a host, blocking on the resolver, and cache the outcome
+    # keepOld: Keep a resolution that hasn't expired yet if this one fails
+    # Raises: OSError if the host can't be resolved
+    # Returns: The DnsEntry now cached for the host
+    def refresh(self, hostname, portn, keepOld=True):
+        key = (hostname, portn)
+        start = time.perf_counter()
+        try:
+            addresses, error = self.resolver(hostname, portn), None
+            if not addresses:
+                error = gaierror(EAI_NONAME, f'No addresses for {hostname}')
+        except OSError as e:
+            addresses, error = [], e
+        iostats.record_time('resolve', time.perf_counter() - start)
+
+        now = time.monotonic()
+        with self.lock:
+            self.refreshing.pop(key, None)
+            old = self.entries.get(key)
+            if error is not None:
+                if keepOld and old is not None and old.error is None and old.expires > now:
+                    print(f'Keeping old addresses of {hostname}: {error}')
+                    # Retried no more often than a failure is remembered for
+                    old.refreshAt = now + self.negativeTtl
+                    return old
+                self.entries[key] = DnsEntry([], error, now + self.negativeTtl, now + self.negativeTtl)
+                raise error
+            entry = self.entries[key] = DnsEntry(addresses, None, now + self.ttl, now + self.ttl * self.refreshAhead)
+            return entry
+
+    # refresh() on a thread of its own: the outcome is cached, so there is
+    # nobody to raise a failure to
+    def refresh_in_background(self, hostname, portn):
+        try:
+            self.refresh(hostname, portn)
+        except OSError as e:
+            print(e)
+
+    # Get the next address of a host, resolving it if it isn't cached
+    # Raises: OSError if the host can't be resolved
+    # Returns: (ip: str, portn: int)
+    def resolve(self, hostname, portn):
+        address = self.cached(hostname, portn)
+        if address is None:
+            self.misses += 1
+            entry = self.refresh(hostname, portn, keepOld=False)
+            with self.lock:
+                address = entry.next_address()
+        return address
+
+    # resolve() for the event loop: only a miss waits, on a worker thread
+    async def resolve_async(self, hostname, portn):
+        address = self.cached(hostname, portn)
+        if address is None:
+            address = await asyncio.get_running_loop().run_in_executor(None, self.resolve, hostname, portn)
+        return address
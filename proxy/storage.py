@@ -0,0 +1,410 @@
+# Layouts the disk cache keeps stored responses in, picked with DiskCache(layout=...)
+# 'files' gives every response a file of its own. 'segments' appends responses
+# to large segment files instead, so a small response costs neither an inode
+# nor an open() per hit, nor most of a filesystem block
+# DiskCache decides what is stored and journals where; a layout only reads and
+# writes the bytes
+import os
+
+import iostats
+
+# Size a segment is appended to before a new one is started
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Full segments with less than this share of their bytes still live are compacted
+COMPACT_RATIO = 0.5
+# Most live bytes one compact() call copies, so a compaction step holds up
+# requests no longer than a large cache write would
+COMPACT_BUDGET = 1024 * 1024
+
+# Path of the disk cache file for a key
+# Files are sharded into two levels of subdirectories by the first four hex
+# digits of the key, so no directory holds more than a small share of them
+def cache_path(cacheDir, key):
+    return os.path.join(cacheDir, key[:2], key[2:4], key)
+
+# Cache file opened for writing without a userspace buffer, so that the pieces
+# of a response (header section, first body chunk) reach the kernel together
+# in one os.writev() call instead of one write() each
+# The response is written to a temporary file, and only renamed to its final
+# path by commit() once it is all there, so a crash or an upstream error never
+# leaves a truncated file where it would be served. abort() deletes the
+# temporary file instead
+# path: Path of the cache file; intermediate directories are created
+# tmpPath: Where to write the file until it is committed, on the same filesystem
+# onClose: Called with the size of the file when it is committed, or None when aborted
+class CacheFile:
+    def __init__(self, path, tmpPath, onClose=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.tmpPath = tmpPath
+        # Where the response starts in tmpPath
+        self.base = 0
+        self.onClose = onClose
+        self.size = 0
+        self.f = open(tmpPath, 'wb', buffering=0)
+        iostats.count('cache_open')
+
+    def write(self, data):
+        self.writev([data])
+
+    def writev(self, buffers):
+        total = sum(len(b) for b in buffers)
+        written = os.writev(self.f.fileno(), buffers)
+        iostats.count('cache_write')
+        self.size += total
+        if written < total:
+            # Short write: finish off what's left one write() at a time
+            rest = memoryview(b''.join(buffers))[written:]
+            while rest:
+                rest = rest[self.f.write(rest):]
+                iostats.count('cache_write')
+
+    def commit(self):
+        self.f.close()
+        # rename() replaces any older copy atomically: readers see one or the other
+        os.replace(self.tmpPath, self.path)
+        if self.onClose is not None:
+            self.onClose(self.size)
+
+    def abort(self):
+        self.f.close()
+        os.unlink(self.tmpPath)
+        if self.onClose is not None:
+            self.onClose(None)
+
+# A stored response opened for reading: a whole cache file, or a slice of a segment
+# It is read with os.pread(), so any number of them can share one open file.
+# sendfile() sends it from file, at base plus the offset within the response
+# file: Open file the response is in
+# base: Offset of the response in the file
+# size: Size of the response
+# onClose: Called once when it is closed
+class StoredFile:
+    def __init__(self, file, base, size, onClose=None):
+        self.file = file
+        self.base = base
+        self.size = size
+        self.onClose = onClose
+        self.pos = 0
+
+    # Read up to nbytes from the current position, or all the rest of the response
+    def read(self, nbytes=-1):
+        if nbytes < 0 or nbytes > self.size - self.pos:
+            nbytes = self.size - self.pos
+        data = os.pread(self.file.fileno(), nbytes, self.base + self.pos) if nbytes else b''
+        while 0 < len(data) < nbytes:
+            # Short read: a regular file only gives one at its end
+            more = os.pread(self.file.fileno(), nbytes - len(data), self.base + self.pos + len(data))
+            if not more:
+                break
+            data += more
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.onClose is not None:
+            self.onClose()
+            self.onClose = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Each response in a file of its own, at cache_path() of its key
+# cacheDir: Directory the files are kept in
+# tmpDir: Directory responses are written to until they are committed
+class FileStore:
+    def __init__(self, cacheDir, tmpDir):
+        self.cacheDir = cacheDir
+        self.tmpDir = tmpDir
+
+    def path(self, key):
+        return cache_path(self.cacheDir, key)
+
+    # Journal fields locating a stored response: none, as its key is enough
+    def where(self, key):
+        return ''
+
+    # Record where a committed or reloaded response is
+    # location: As passed to a writer's onClose, or None
+    def place(self, key, location, size):
+        pass
+
+    # Stop locating a response, without deleting it
+    def forget(self, key):
+        pass
+
+    # Delete a forgotten response
+    # Raises: FileNotFoundError if it is already gone
+    def delete(self, key):
+        os.unlink(self.path(key))
+
+    # Open a stored response for reading
+    # Raises: FileNotFoundError if it isn't there
+    def open(self, key):
+        f = open(self.path(key), 'rb')
+        return StoredFile(f, 0, os.fstat(f.fileno()).st_size, f.close)
+
+    # Start writing a response
+    # onClose: Called with the size of the response when it is committed, or None when aborted
+    def create(self, key, onClose):
+        return CacheFile(self.path(key), os.path.join(self.tmpDir, f'{key}.{os.getpid()}'), onClose)
+
+    # Called once DiskCache has placed every response in its journal
+    # Returns: Keys of the responses that can't be there any more
+    def loaded(self):
+        return []
+
+    # Replaced files are deleted as they are replaced, so there is never anything to compact
+    def compact(self, onMove, budget=COMPACT_BUDGET):
+        return False
+
+    def close(self):
+        pass
+
+# One segment file of a SegmentStore, opened once for reading and writing
+# Responses are read from it with os.pread() and written with os.pwritev(), so
+# the file position is never used and the one open file serves everybody
+class Segment:
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        self.file = open(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b', buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+        # Bytes of responses that are still stored, and their keys
+        self.live = 0
+        self.keys = set()
+        # Responses opened from it that haven't been closed yet
+        self.readers = 0
+        self.writing = False
+        self.deleted = False
+
+# Copy count bytes between two open files without reading them into Python
+# where copy_file_range() is available
+def copy_range(src, srcOffset, dst, dstOffset, count):
+    while count > 0:
+        try:
+            n = os.copy_file_range(src.fileno(), dst.fileno(), count, srcOffset, dstOffset)
+        except (AttributeError, OSError):
+            n = os.pwrite(dst.fileno(), os.pread(src.fileno(), min(count, COMPACT_BUDGET), srcOffset), dstOffset)
+        if n == 0:
+            raise OSError(f'{src.name} ended {count} bytes early')
+        srcOffset += n
+        dstOffset += n
+        count -= n
+
+# Responses appended back to back to numbered segment files, located by an
+# in-memory index of key -> (segment, offset, size) that DiskCache journals
+# and checkpoints along with the rest of its index
+# A response being written has a segment to itself and is appended to it in
+# place. An aborted one is cut off again; one cut short by a crash, or replaced
+# or removed later, is dead space. compact() copies the live responses out of
+# full segments that are mostly dead, and deletes the segments
+# cacheDir: Directory the segments are kept in, under segments/
+# tmpDir: Unused: responses are written straight into their segment
+# segmentSize: Size a segment is appended to before a new one is started
+# compactRatio: Share of live bytes below which a full segment is compacted
+class SegmentStore:
+    def __init__(self, cacheDir, tmpDir, segmentSize=SEGMENT_SIZE, compactRatio=COMPACT_RATIO):
+        self.dir = os.path.join(cacheDir, 'segments')
+        os.makedirs(self.dir, exist_ok=True)
+        self.segmentSize = segmentSize
+        self.compactRatio = compactRatio
+        # number -> Segment
+        self.segments = {}
+        for name in sorted(os.listdir(self.dir)):
+            number, dot, extension = name.partition('.')
+            if number.isdigit() and extension == 'seg':
+                self.segments[int(number)] = Segment(int(number), os.path.join(self.dir, name))
+        self.nextNumber = max(self.segments, default=-1) + 1
+        # Segments with room that nobody is writing to, by number
+        self.appending = {n: s for n, s in self.segments.items() if s.size < segmentSize}
+        # key -> (segment number, offset, size)
+        self.locations = {}
+        self.compactions = 0
+
+    # Path of the segment a response is in, or None if it isn't stored
+    def path(self, key):
+        location = self.locations.get(key)
+        return self.segments[location[0]].path if location is not None else None
+
+    def where(self, key):
+        number, offset, size = self.locations[key]
+        return f' {number} {offset}'
+
+    # While the journal is replayed a location may be in a segment that a later
+    # compaction deleted; loaded() drops any that are still there at the end
+    def place(self, key, location, size):
+        self.forget(key)
+        number, offset = location if location is not None else (None, 0)
+        self.locations[key] = (number, offset, size)
+        segment = self.segments.get(number)
+        if segment is not None:
+            segment.live += size
+            segment.keys.add(key)
+
+    # The response's bytes become dead space, reclaimed by compact()
+    def forget(self, key):
+        location = self.locations.pop(key, None)
+        segment = self.segments.get(location[0]) if location is not None else None
+        if segment is not None:
+            segment.live -= location[2]
+            segment.keys.discard(key)
+
+    def delete(self, key):
+        pass
+
+    def open(self, key):
+        location = self.locations.get(key)
+        if location is None:
+            raise FileNotFoundError(f'No stored response for {key}')
+        segment = self.segments[location[0]]
+        segment.readers += 1
+        return StoredFile(segment.file, location[1], location[2], lambda: self.release(segment))
+
+    # Called when a response read from a segment is closed
+    def release(self, segment):
+        segment.readers -= 1
+        if segment.deleted and segment.readers == 0:
+            segment.file.close()
+
+    # Take a segment with room for a writer, starting a new one if none has any
+    def writable(self):
+        if self.appending:
+            segment = self.appending.pop(next(iter(self.appending)))
+        else:
+            segment = self.segments[self.nextNumber] = Segment(
+                self.nextNumber, os.path.join(self.dir, f'{self.nextNumber:08d}.seg'))
+            self.nextNumber += 1
+        segment.writing = True
+        return segment
+
+    # Hand a segment back once its writer is done with it
+    def closed(self, segment):
+        segment.writing = False
+        if segment.size < self.segmentSize and not segment.deleted:
+            self.appending[segment.number] = segment
+
+    def create(self, key, onClose):
+        return SegmentFile(self, self.writable(), onClose)
+
+    # Drop the responses whose segment has gone, and delete the segments nothing
+    # in the journal is stored in any more: left behind by a crash, or emptied
+    # by removals since the last compaction
+    def loaded(self):
+        missing = [key for key, location in self.locations.items() if location[0] not in self.segments]
+        for key in missing:
+            del self.locations[key]
+        for segment in list(self.segments.values()):
+            if segment.live == 0 and not segment.writing:
+                self.delete_segment(segment)
+        return missing
+
+    # Take a step of compacting the full segment with the smallest share of live
+    # bytes, if that is below compactRatio: move up to budget bytes of its live
+    # responses to the end of other segments, and delete it once none are left
+    # onMove: Called with the key of each response moved, so its new location is
+    #         journaled before the segment it was in can be deleted
+    # Returns: Whether there was a segment to compact
+    def compact(self, onMove, budget=COMPACT_BUDGET):
+        victim = None
+        for segment in self.segments.values():
+            if segment.size >= self.segmentSize and not segment.writing and (
+                    segment.live < segment.size * self.compactRatio):
+                if victim is None or segment.live / segment.size < victim.live / victim.size:
+                    victim = segment
+        if victim is None:
+            return False
+        moved = 0
+        for key in list(victim.keys):
+            if moved >= budget:
+                break
+            number, offset, size = self.locations[key]
+            target = self.writable()
+            try:
+                copy_range(victim.file, offset, target.file, target.size, size)
+                location = (target.number, target.size)
+                target.size += size
+            finally:
+                self.closed(target)
+            self.place(key, location, size)
+            onMove(key)
+            moved += size
+        if not victim.keys:
+            self.delete_segment(victim)
+            self.compactions += 1
+        return True
+
+    # Remove a segment file; readers that still have it open keep reading it
+    def delete_segment(self, segment):
+        del self.segments[segment.number]
+        self.appending.pop(segment.number, None)
+        segment.deleted = True
+        os.unlink(segment.path)
+        if segment.readers == 0:
+            segment.file.close()
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.file.close()
+
+# Response being appended to a segment, which has no other writer until this
+# one commits or aborts
+# Followers of the response read it as it is written, from tmpPath at base
+# store: SegmentStore the segment belongs to
+# segment: Segment from SegmentStore.writable()
+# onClose: Called with the size of the response and its (segment number, offset)
+#          when it is committed, or None when aborted
+class SegmentFile:
+    def __init__(self, store, segment, onClose=None):
+        self.store = store
+        self.segment = segment
+        self.tmpPath = segment.path
+        self.base = segment.size
+        self.onClose = onClose
+        self.size = 0
+
+    def write(self, data):
+        self.writev([data])
+
+    def writev(self, buffers):
+        fd = self.segment.file.fileno()
+        total = sum(len(b) for b in buffers)
+        offset = self.base + self.size
+        if hasattr(os, 'pwritev'):
+            written = os.pwritev(fd, buffers, offset)
+        else:
+            written = os.pwrite(fd, b''.join(buffers), offset)
+        iostats.count('cache_write')
+        if written < total:
+            # Short write: finish off what's left one pwrite() at a time
+            rest = memoryview(b''.join(buffers))[written:]
+            while rest:
+                n = os.pwrite(fd, rest, offset + total - len(rest))
+                rest = rest[n:]
+                iostats.count('cache_write')
+        self.size += total
+
+    def commit(self):
+        self.segment.size = self.base + self.size
+        self.store.closed(self.segment)
+        if self.onClose is not None:
+            self.onClose(self.size, (self.segment.number, self.base))
+
+    def abort(self):
+        # Nothing has been appended after it, so the segment can be cut back
+        os.ftruncate(self.segment.file.fileno(), self.base)
+        self.store.closed(self.segment)
+        if self.onClose is not None:
+            self.onClose(None)
+
+# Layouts by the name DiskCache(layout=...) takes
+LAYOUTS = {'files': FileStore, 'segments': SegmentStore}
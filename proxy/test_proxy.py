@@ -1,24 +1,196 @@
 import unittest
-from socket import gethostbyname
+import asyncio
+import os
+import random
+import string
+import tempfile
+import zlib
+import time
+import threading
+import signal
+import socket
+from socket import gethostbyname, create_connection, create_server, socketpair, gaierror, EAI_NONAME, SHUT_WR
 from multiprocessing import Process, Manager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import json
 import app
 import requests
 import proxy
+import engine
+import iostats
+import metrics
+from asyncsock import AsyncSocketFile
+from cache import DiskCache, MemoryCache, cache_key, make_entry, entry_buffers, response_expiry, refreshed_expiry, stale_windows
+from cache import parse_range, if_range_matches, range_response, vary_names, vary_value
+from httpmsg import Headers, parse_head, RecvBuffer, HeaderTooLarge, request_body_length
+from upstream import CircuitBreaker
+from resolver import DnsCache
+from codings import (CODECS, DECODE_BLOCK, accepts_coding, should_compress, encoded_headers, decode,
+                     EncodingCacheFile)
 
 def run_server():
     app.app.run(port=5000)
 
-def run_proxy():
-    proxy.proxyServer(8888)
+# The Flask development server closes every connection, so keep-alive
+# behaviour is checked against this HTTP/1.1 origin instead.
+# Each response body is the client port of the connection it arrived on,
+# except for /big which is BIG_BODY.
+# /validated is fresh for a second and answers If-None-Match with a 304,
+# /no-store must not be cached, /slow sends half of SLOW_BODY and the rest a
+# second later, /chunked sends CHUNKS with chunked encoding, the first a second
+# ahead of the rest, and /stats counts the responses to each path.
+# /swr may be served stale while it is revalidated, which takes the origin a
+# second, and /sie may be served stale on errors: it is a 503 after the first time.
+# /missing is a 404 and /error is a 500.
+# /lang is LANG_BODIES[Accept-Language] and varies on Accept-Language and Accept-Encoding.
+# /text is TEXT_BODY and /big-text BIG_TEXT, both text/html: BIG_TEXT doesn't
+# compress much, so it is still too big for the memory cache once it has been.
+# POST, PUT and PATCH echo the request body back.
+BIG_BODY = bytes(range(256)) * (16 * 1024)
+SLOW_BODY = b'0123456789' * 10000
+CHUNKS = [b'first chunk;', b'x' * 100000, b'last chunk']
+TEXT_BODY = b'<p>A compressible line of text</p>\n' * 1000
+BIG_TEXT = ''.join(random.Random(1).choices(string.ascii_letters, k=600000)).encode()
+LANG_BODIES = {'en': b'hello', 'de': b'hallo', '': b'?'}
+ORIGIN_STATS = {}
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status = 200
+        headers = []
+        if self.path == '/big':
+            body = BIG_BODY
+        elif self.path == '/stats':
+            body = json.dumps(ORIGIN_STATS).encode()
+        elif self.path == '/validated':
+            body = b'validated body'
+            headers = [('Cache-Control', 'max-age=1'), ('ETag', '"v1"')]
+            if self.headers.get('If-None-Match') == '"v1"':
+                status, body = 304, b''
+        elif self.path == '/swr':
+            body = b'swr body'
+            headers = [('Cache-Control', 'max-age=1, stale-while-revalidate=30'), ('ETag', '"v1"')]
+            if self.headers.get('If-None-Match') == '"v1"':
+                time.sleep(1)
+                status, body = 304, b''
+        elif self.path == '/sie':
+            body = b'sie body'
+            headers = [('Cache-Control', 'max-age=1, stale-if-error=60')]
+            if '/sie 200' in ORIGIN_STATS:
+                status, body = 503, b'down'
+        elif self.path in ('/text', '/big-text'):
+            body = TEXT_BODY if self.path == '/text' else BIG_TEXT
+            headers = [('Content-Type', 'text/html; charset=utf-8')]
+        elif self.path == '/lang':
+            body = LANG_BODIES.get(self.headers.get('Accept-Language', ''), b'?')
+            headers = [('Vary', 'Accept-Language, Accept-Encoding')]
+        elif self.path == '/missing':
+            status, body = 404, b'missing'
+        elif self.path == '/error':
+            status, body = 500, b'error'
+        elif self.path == '/no-store':
+            body = b'no-store body'
+            headers = [('Cache-Control', 'no-store')]
+        elif self.path == '/slow':
+            ORIGIN_STATS['/slow 200'] = ORIGIN_STATS.get('/slow 200', 0) + 1
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(SLOW_BODY)))
+            self.end_headers()
+            self.wfile.write(SLOW_BODY[:len(SLOW_BODY) // 2])
+            self.wfile.flush()
+            time.sleep(1)
+            self.wfile.write(SLOW_BODY[len(SLOW_BODY) // 2:])
+            return
+        elif self.path == '/chunked':
+            ORIGIN_STATS['/chunked 200'] = ORIGIN_STATS.get('/chunked 200', 0) + 1
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'%x;ext=1\r\n%s\r\n' % (len(CHUNKS[0]), CHUNKS[0]))
+            self.wfile.flush()
+            time.sleep(1)
+            for chunk in CHUNKS[1:]:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\nX-Trailer: 1\r\n\r\n')
+            return
+        else:
+            body = str(self.client_address[1]).encode()
+        if self.path != '/stats':
+            ORIGIN_STATS[f'{self.path} {status}'] = ORIGIN_STATS.get(f'{self.path} {status}', 0) + 1
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+            while True:
+                chunkSize = int(self.rfile.readline().split(b';')[0], 16)
+                if chunkSize == 0:
+                    break
+                body += self.rfile.read(chunkSize)
+                self.rfile.readline()
+            while self.rfile.readline() not in (b'\r\n', b''):
+                pass
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_PATCH = do_PUT
+
+    def log_message(self, format, *args):
+        pass
+
+def run_keepalive_server():
+    ThreadingHTTPServer(('localhost', 5001), KeepAliveHandler).serve_forever()
+
+# Read one Content-Length framed response from a socket file
+# Returns: (status line: bytes, headers: dict, body: bytes)
+def read_response(sockf):
+    statusLine = sockf.readline().rstrip()
+    headers = {}
+    while True:
+        line = sockf.readline().decode()
+        if line in ('\r\n', ''):
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return statusLine, headers, sockf.read(int(headers['content-length']))
+
+# The proxy's metrics, as {sample: value}
+def scrape_metrics():
+    r = requests.get(f'http://localhost:8888{metrics.METRICS_PATH}')
+    return dict(line.rsplit(' ', 1) for line in r.text.splitlines() if not line.startswith('#'))
+
+def run_proxy(mode, cacheDir, cacheLayout):
+    proxy.proxyServer(8888, mode, cacheDir, cacheLayout=cacheLayout)
 
 class TestProxy(unittest.TestCase):
+    proxyMode = 'event'
+    cacheLayout = 'files'
+
     def setUp(self):
+        self.o_process = Process(target=run_keepalive_server)
+        self.o_process.start()
         self.s_process = Process(target=run_server)
         self.s_process.start()
         self.s_process.join(1)
         print('Server started')
-        self.p_process = Process(target=run_proxy)
+        # The cache now outlives the proxy, so every test gets an empty one
+        self.cacheDir = tempfile.TemporaryDirectory()
+        self.start_proxy()
+
+    def start_proxy(self):
+        self.p_process = Process(target=run_proxy, args=(self.proxyMode, self.cacheDir.name, self.cacheLayout))
         self.p_process.start()
         self.p_process.join(1)
         print('Proxy started')
@@ -26,10 +198,16 @@ class TestProxy(unittest.TestCase):
         self.proxies = { 'http': 'http://localhost:8888' }
 
     def tearDown(self):
+        self.o_process.terminate()
         self.s_process.terminate()
+        # The next test's servers can't bind the ports until these have exited
+        self.o_process.join()
+        self.s_process.join()
         print('Server terminated')
         self.p_process.terminate()
+        self.p_process.join()
         print('Proxy terminated')
+        self.cacheDir.cleanup()
 
     def testBasic200(self):
         r = requests.get('http://localhost:5000/test-basic-200', proxies=self.proxies)
@@ -45,6 +223,62 @@ class TestProxy(unittest.TestCase):
         self.assertEqual(r.status_code, 200, 'Server returned non-200 status code')
         self.assertEqual(r.content.decode(), f'<!doctype html><html><title>Test File</title><p>You provided: test-posts</p><p>We provided: {app.server_string}</p></html>', 'File data does not match')
 
+    def testStreamedUploads(self):
+        upload = bytes(range(256)) * 4096
+        r = requests.put('http://localhost:5001/upload', data=upload, proxies=self.proxies)
+        self.assertEqual(r.content, upload)
+        # A generator is sent with Transfer-Encoding: chunked
+        r = requests.patch('http://localhost:5001/upload', data=(upload[i:i + 65536] for i in range(0, len(upload), 65536)),
+                           proxies=self.proxies)
+        self.assertEqual(r.content, upload)
+
+    def testMalformedContentLength(self):
+        for contentLength in (b'zz', b'-5', b'5, 6'):
+            client = create_connection(('localhost', 8888))
+            try:
+                client.sendall(b'POST http://localhost:5000/test-bad-length HTTP/1.1\r\nContent-Length: '
+                               + contentLength + b'\r\n\r\nhello')
+                sockf = client.makefile('rb')
+                statusLine, headers, body = read_response(sockf)
+                self.assertEqual(statusLine, b'HTTP/1.1 400 Bad Request')
+                self.assertEqual(sockf.read(), b'', 'Connection was left open')
+                sockf.close()
+            finally:
+                client.close()
+
+    def testExpectContinue(self):
+        client = create_connection(('localhost', 8888))
+        try:
+            client.sendall(b'POST http://localhost:5001/upload HTTP/1.1\r\nContent-Length: 5\r\n'
+                           b'Expect: 100-continue\r\n\r\n')
+            sockf = client.makefile('rb')
+            self.assertEqual(sockf.readline(), b'HTTP/1.1 100 Continue\r\n')
+            self.assertEqual(sockf.readline(), b'\r\n')
+            client.sendall(b'hello')
+            statusLine, headers, body = read_response(sockf)
+            self.assertEqual(statusLine, b'HTTP/1.1 200 OK')
+            self.assertEqual(body, b'hello')
+        finally:
+            client.close()
+
+    def testChunkedResponse(self):
+        start = time.monotonic()
+        r = requests.get('http://localhost:5001/chunked', proxies=self.proxies, stream=True)
+        # The first chunk is passed on before the origin has sent the rest
+        self.assertEqual(r.raw.read(len(CHUNKS[0])), CHUNKS[0])
+        self.assertLess(time.monotonic() - start, 0.9, 'First chunk waited for the whole body')
+        self.assertEqual(r.raw.read(), b''.join(CHUNKS[1:]))
+        if self.proxyMode == 'event':
+            self.assertEqual(r.headers['Transfer-Encoding'], 'chunked')
+        r.close()
+
+        # Stored de-chunked, so the hit has a Content-Length
+        r = requests.get('http://localhost:5001/chunked', proxies=self.proxies)
+        self.assertEqual(r.content, b''.join(CHUNKS))
+        self.assertEqual(r.headers['Content-Length'], str(len(b''.join(CHUNKS))))
+        self.assertNotIn('Transfer-Encoding', r.headers)
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/chunked 200': 1})
+
     def testCacheGets(self):
         r = requests.get('http://localhost:5000/test-cache-GETs', proxies=self.proxies)
         self.assertEqual(r.status_code, 200, 'Server returned non-200 status code')
@@ -72,3 +306,1245 @@ class TestProxy(unittest.TestCase):
         count_dict = json.loads(r.content.decode())
         self.assertIn('test-cache-POSTs', count_dict)
         self.assertEqual(count_dict['test-cache-POSTs'], 2)
+
+    def testMemoryCacheHits(self):
+        # Miss, disk hit (promoted to memory), then memory hits
+        for i in range(4):
+            r = requests.get('http://localhost:5000/test-memory-cache', proxies=self.proxies)
+            self.assertEqual(r.status_code, 200, 'Server returned non-200 status code')
+            self.assertEqual(r.content.decode(), f'<!doctype html><html><title>Test File</title><p>You provided: test-memory-cache</p><p>We provided: {app.server_string}</p></html>', 'File data does not match')
+
+        r = requests.get('http://localhost:5000/count', proxies=self.proxies)
+        count_dict = json.loads(r.content.decode())
+        self.assertEqual(count_dict['test-memory-cache'], 1)
+
+    def testSlowClientDoesNotStall(self):
+        if self.proxyMode != 'event':
+            self.skipTest('the blocking loop serves one client at a time')
+        # A client that never finishes its request must not hold up anyone else
+        slow = create_connection(('localhost', 8888))
+        try:
+            slow.sendall(b'GET http://localhost:5000/test-slow HTTP/1.1\r\n')
+            r = requests.get('http://localhost:5000/test-not-stalled', proxies=self.proxies, timeout=5)
+            self.assertEqual(r.status_code, 200, 'Server returned non-200 status code')
+        finally:
+            slow.close()
+
+    def testLargeHeaderRefused(self):
+        # The whole oversized section arrives at once, blank line and all
+        client = create_connection(('localhost', 8888))
+        try:
+            client.sendall(b'GET http://localhost:5000/test-large-header HTTP/1.1\r\n'
+                           + b'X-Filler: ' + b'x' * 70000 + b'\r\n\r\n')
+            sockf = client.makefile('rb')
+            statusLine, headers, body = read_response(sockf)
+            self.assertEqual(statusLine, b'HTTP/1.1 431 Request Header Fields Too Large')
+            self.assertEqual(sockf.read(), b'', 'Connection was left open')
+            sockf.close()
+        finally:
+            client.close()
+
+    def testCoalescedMisses(self):
+        if self.proxyMode != 'event':
+            self.skipTest('the blocking loop serves one client at a time')
+        clients = [create_connection(('localhost', 8888)) for i in range(5)]
+        try:
+            start = time.monotonic()
+            for client in clients:
+                client.sendall(b'GET http://localhost:5001/slow HTTP/1.1\r\n\r\n')
+            files = [client.makefile('rb') for client in clients]
+            for sockf in files:
+                # Every client gets the first half while the origin is still sending the rest
+                self.assertEqual(sockf.readline(), b'HTTP/1.1 200 OK\r\n')
+                while sockf.readline() != b'\r\n':
+                    pass
+                self.assertEqual(sockf.read(len(SLOW_BODY) // 2), SLOW_BODY[:len(SLOW_BODY) // 2])
+            self.assertLess(time.monotonic() - start, 0.9, 'Followers waited for the whole response')
+            for sockf in files:
+                self.assertEqual(sockf.read(len(SLOW_BODY) // 2), SLOW_BODY[len(SLOW_BODY) // 2:])
+                sockf.close()
+        finally:
+            for client in clients:
+                client.close()
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/slow 200': 1})
+
+    def testCacheSurvivesRestart(self):
+        r = requests.get('http://localhost:5000/test-warm-restart', proxies=self.proxies)
+        self.assertEqual(r.status_code, 200, 'Server returned non-200 status code')
+
+        # The response is committed to the cache just after the client has it
+        time.sleep(0.5)
+        # Killed rather than shut down cleanly, so only the index journal is left
+        self.p_process.kill()
+        self.p_process.join()
+        self.start_proxy()
+
+        r = requests.get('http://localhost:5000/test-warm-restart', proxies=self.proxies)
+        self.assertEqual(r.content.decode(), f'<!doctype html><html><title>Test File</title><p>You provided: test-warm-restart</p><p>We provided: {app.server_string}</p></html>', 'File data does not match')
+        r = requests.get('http://localhost:5000/count', proxies=self.proxies)
+        count_dict = json.loads(r.content.decode())
+        self.assertEqual(count_dict['test-warm-restart'], 1)
+
+    def testCacheSurvivesCleanShutdown(self):
+        requests.get('http://localhost:5000/test-clean-restart', proxies=self.proxies)
+        # Fetched again, so the journal holds the entry twice
+        r = requests.get('http://localhost:5000/test-clean-restart', proxies=self.proxies,
+                         headers={'Cache-Control': 'no-cache'})
+        self.assertEqual(r.status_code, 200, 'Server returned non-200 status code')
+        time.sleep(0.5)
+
+        # SIGTERM drains the proxy, which checkpoints the index on its way out
+        self.p_process.terminate()
+        self.p_process.join()
+        self.assertEqual(self.p_process.exitcode, 0)
+        with open(os.path.join(self.cacheDir.name, 'index')) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1, 'Index was not checkpointed')
+        self.assertIn(lines[0][0], '+*')
+        self.start_proxy()
+
+        r = requests.get('http://localhost:5000/test-clean-restart', proxies=self.proxies)
+        self.assertEqual(r.content.decode(), f'<!doctype html><html><title>Test File</title><p>You provided: test-clean-restart</p><p>We provided: {app.server_string}</p></html>', 'File data does not match')
+        r = requests.get('http://localhost:5000/count', proxies=self.proxies)
+        count_dict = json.loads(r.content.decode())
+        self.assertEqual(count_dict['test-clean-restart'], 2)
+
+    def testRevalidation(self):
+        for i in range(2):
+            r = requests.get('http://localhost:5001/validated', proxies=self.proxies)
+            self.assertEqual(r.content, b'validated body')
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/validated 200': 1})
+
+        # Once max-age has passed the entry is revalidated, and the 304 makes it fresh again
+        time.sleep(1.5)
+        for i in range(2):
+            r = requests.get('http://localhost:5001/validated', proxies=self.proxies)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.content, b'validated body')
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/validated 200': 1, '/validated 304': 1})
+
+    def testStaleWhileRevalidate(self):
+        if self.proxyMode != 'event':
+            self.skipTest('the blocking loop has nothing to revalidate in the background')
+        requests.get('http://localhost:5001/swr', proxies=self.proxies)
+        time.sleep(1.5)
+
+        # Stale: served at once, without waiting the second the revalidation takes
+        for i in range(2):
+            start = time.monotonic()
+            r = requests.get('http://localhost:5001/swr', proxies=self.proxies)
+            self.assertLess(time.monotonic() - start, 0.5, 'Stale response waited for the origin')
+            self.assertEqual(r.content, b'swr body')
+
+        # Both requests triggered a single background refresh
+        time.sleep(1.5)
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/swr 200': 1, '/swr 304': 1})
+
+    def testStaleIfError(self):
+        r = requests.get('http://localhost:5001/sie', proxies=self.proxies)
+        self.assertEqual(r.content, b'sie body')
+        time.sleep(1.5)
+
+        # The origin answers with a 503, so the stale copy is served instead
+        r = requests.get('http://localhost:5001/sie', proxies=self.proxies)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b'sie body')
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/sie 200': 1, '/sie 503': 1})
+
+        # And also when the origin can't be reached at all
+        self.o_process.terminate()
+        self.o_process.join()
+        r = requests.get('http://localhost:5001/sie', proxies=self.proxies)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b'sie body')
+
+    def testNegativeCaching(self):
+        for i in range(2):
+            self.assertEqual(requests.get('http://localhost:5001/missing', proxies=self.proxies).status_code, 404)
+            self.assertEqual(requests.get('http://localhost:5001/error', proxies=self.proxies).status_code, 500)
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/missing 404': 1, '/error 500': 1})
+
+    def testDeadOrigin(self):
+        # Nothing listens on this port: the proxy answers for it
+        r = requests.get('http://localhost:5009/dead', proxies=self.proxies)
+        self.assertEqual(r.status_code, 502)
+        # And then doesn't try to connect again until the circuit closes
+        r = requests.get('http://localhost:5009/dead', proxies=self.proxies)
+        self.assertEqual(r.status_code, 503)
+
+    def testNoStore(self):
+        for i in range(2):
+            r = requests.get('http://localhost:5001/no-store', proxies=self.proxies)
+            self.assertEqual(r.content, b'no-store body')
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/no-store 200': 2})
+
+    def testUpstreamKeepAlive(self):
+        if self.proxyMode != 'event':
+            self.skipTest('the blocking loop opens a new connection per request')
+        # Two cache misses in a row should reuse one pooled server connection
+        r1 = requests.get('http://localhost:5001/first', proxies=self.proxies)
+        r2 = requests.get('http://localhost:5001/second', proxies=self.proxies)
+        self.assertEqual(r1.status_code, 200, 'Server returned non-200 status code')
+        self.assertEqual(r1.content, r2.content, 'Server connection was not reused')
+
+    def testRangeRequests(self):
+        requests.get('http://localhost:5001/big', proxies=self.proxies)
+        # Seeked to in the cache file
+        r = requests.get('http://localhost:5001/big', headers={'Range': 'bytes=100000-100099'}, proxies=self.proxies)
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.headers['Content-Range'], f'bytes 100000-100099/{len(BIG_BODY)}')
+        self.assertEqual(r.content, BIG_BODY[100000:100100])
+
+        r = requests.get('http://localhost:5001/big', headers={'Range': 'bytes=0-9,-10'}, proxies=self.proxies)
+        self.assertEqual(r.status_code, 206)
+        self.assertTrue(r.headers['Content-Type'].startswith('multipart/byteranges; boundary='))
+        boundary = r.headers['Content-Type'].partition('boundary=')[2].encode()
+        parts = r.content.split(b'--' + boundary)
+        self.assertEqual(len(parts), 4)
+        self.assertTrue(parts[1].endswith(b'\r\n\r\n' + BIG_BODY[:10] + b'\r\n'))
+        self.assertTrue(parts[2].endswith(b'\r\n\r\n' + BIG_BODY[-10:] + b'\r\n'))
+
+        r = requests.get('http://localhost:5001/big', headers={'Range': f'bytes={len(BIG_BODY)}-'}, proxies=self.proxies)
+        self.assertEqual(r.status_code, 416)
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/big 200': 1})
+
+    def testIfRange(self):
+        requests.get('http://localhost:5001/validated', proxies=self.proxies)
+        # Served from the memory cache
+        r = requests.get('http://localhost:5001/validated', headers={'Range': 'bytes=0-8', 'If-Range': '"v1"'},
+                         proxies=self.proxies)
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, b'validated')
+        # The client has part of another version: it gets the whole response
+        r = requests.get('http://localhost:5001/validated', headers={'Range': 'bytes=0-8', 'If-Range': '"v0"'},
+                         proxies=self.proxies)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b'validated body')
+
+    def testCompressedStorage(self):
+        for path, body in (('/text', TEXT_BODY), ('/big-text', BIG_TEXT)):
+            # The first client gets the response as the origin sent it
+            r = requests.get(f'http://localhost:5001{path}', proxies=self.proxies)
+            self.assertNotIn('Content-Encoding', r.headers)
+            self.assertEqual(r.content, body)
+            time.sleep(0.2)
+
+            # Sent compressed, as it is stored, to a client that accepts gzip
+            r = requests.get(f'http://localhost:5001{path}', headers={'Accept-Encoding': 'gzip'}, proxies=self.proxies)
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            self.assertLess(int(r.headers['Content-Length']), len(body), 'Response was not stored compressed')
+            self.assertIn('Accept-Encoding', r.headers['Vary'])
+            self.assertEqual(r.content, body)
+
+            # And decoded on the fly for one that doesn't
+            r = requests.get(f'http://localhost:5001{path}', headers={'Accept-Encoding': 'identity'}, proxies=self.proxies)
+            self.assertNotIn('Content-Encoding', r.headers)
+            self.assertEqual(r.content, body)
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/text 200': 1, '/big-text 200': 1})
+
+    def testVaryVariants(self):
+        for i in range(2):
+            for language in ('en', 'de', 'EN'):
+                r = requests.get('http://localhost:5001/lang', headers={'Accept-Language': language},
+                                 proxies=self.proxies)
+                self.assertEqual(r.content, LANG_BODIES[language.lower()])
+            time.sleep(0.2)
+        # Clients that differ only in codings the proxy decodes itself share a variant
+        r = requests.get('http://localhost:5001/lang', headers={'Accept-Language': 'de', 'Accept-Encoding': 'identity'},
+                         proxies=self.proxies)
+        self.assertEqual(r.content, b'hallo')
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/lang 200': 2})
+
+    def testLargeCacheHit(self):
+        # The second response is streamed from the cache file with sendfile()
+        for i in range(2):
+            r = requests.get('http://localhost:5001/big', proxies=self.proxies)
+            self.assertEqual(r.status_code, 200, 'Server returned non-200 status code')
+            self.assertEqual(r.content, BIG_BODY, 'File data does not match')
+
+    def testConnectTunnel(self):
+        # A plain TCP echo server stands in for an HTTPS origin; it closes once the client has
+        listener = create_server(('localhost', 0))
+        port = listener.getsockname()[1]
+
+        def echo():
+            conn, addr = listener.accept()
+            with conn:
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    conn.sendall(data)
+
+        server = threading.Thread(target=echo)
+        server.start()
+        payload = bytes(range(256)) * 4096
+        client = create_connection(('localhost', 8888))
+        try:
+            # Bytes sent right behind the request go through the tunnel as well
+            client.sendall(f'CONNECT localhost:{port} HTTP/1.1\r\nHost: localhost:{port}\r\n\r\n'.encode()
+                           + payload[:1000])
+            clientf = client.makefile('rb')
+            self.assertEqual(clientf.readline(), b'HTTP/1.1 200 Connection Established\r\n')
+            self.assertEqual(clientf.readline(), b'\r\n')
+
+            def send_rest():
+                client.sendall(payload[1000:])
+                # Half-close: the echo server sees the end, and closes its side after echoing everything
+                client.shutdown(SHUT_WR)
+            sender = threading.Thread(target=send_rest)
+            sender.start()
+            self.assertEqual(clientf.read(), payload, 'Tunnel data does not match')
+            sender.join()
+        finally:
+            client.close()
+            server.join()
+            listener.close()
+
+        # Nothing listens on the port any more
+        client = create_connection(('localhost', 8888))
+        try:
+            client.sendall(f'CONNECT localhost:{port} HTTP/1.1\r\n\r\n'.encode())
+            self.assertEqual(client.makefile('rb').readline(), b'HTTP/1.1 502 Bad Gateway\r\n')
+        finally:
+            client.close()
+
+    def testMetrics(self):
+        before = scrape_metrics()
+        for i in range(2):
+            requests.get('http://localhost:5000/test-metrics', proxies=self.proxies)
+        after = scrape_metrics()
+
+        def delta(sample):
+            return float(after[sample]) - float(before[sample])
+        self.assertEqual(delta('proxy_responses_total{source="origin"}'), 1)
+        self.assertEqual(delta('proxy_responses_total{source="cache"}'), 1)
+        self.assertEqual(delta('proxy_request_phase_seconds_count{phase="lookup"}'), 2)
+        self.assertEqual(delta('proxy_request_phase_seconds_count{phase="first_byte"}'), 1)
+        self.assertGreater(delta('proxy_sent_bytes_total{source="cache"}'), 0)
+        self.assertEqual(after['proxy_open_connections'], '1')
+        self.assertEqual(after['proxy_disk_cache_entries'], '1')
+
+    def testClientKeepAlivePipelined(self):
+        if self.proxyMode != 'event':
+            self.skipTest('the blocking loop closes the client connection after each response')
+        # A cache miss and then a cache hit, pipelined on one connection
+        request = b'GET http://localhost:5000/test-pipelined HTTP/1.1\r\nHost: localhost:5000\r\n\r\n'
+        expected = f'<!doctype html><html><title>Test File</title><p>You provided: test-pipelined</p><p>We provided: {app.server_string}</p></html>'.encode()
+        client = create_connection(('localhost', 8888))
+        try:
+            client.sendall(request + request)
+            clientf = client.makefile('rb')
+            for i in range(2):
+                statusLine, headers, body = read_response(clientf)
+                self.assertEqual(statusLine, b'HTTP/1.1 200 OK', 'Server returned non-200 status code')
+                self.assertEqual(headers['connection'], 'keep-alive')
+                self.assertEqual(body, expected, 'File data does not match')
+
+            # The connection is still usable afterwards
+            client.sendall(request)
+            self.assertEqual(read_response(clientf)[2], expected, 'File data does not match')
+        finally:
+            client.close()
+
+def run_prefork_proxy(cacheDir):
+    proxy.proxyServer(8888, 'event', cacheDir, workers=2)
+
+# Pids of a process's children
+def child_pids(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT') and os.path.exists('/proc/self/task'),
+                     'needs SO_REUSEPORT and /proc')
+class TestPrefork(unittest.TestCase):
+    def setUp(self):
+        self.o_process = Process(target=run_keepalive_server)
+        self.o_process.start()
+        self.cacheDir = tempfile.TemporaryDirectory()
+        self.p_process = Process(target=run_prefork_proxy, args=(self.cacheDir.name,))
+        self.p_process.start()
+        self.p_process.join(1.5)
+        self.proxies = { 'http': 'http://localhost:8888' }
+
+    def tearDown(self):
+        self.o_process.terminate()
+        self.o_process.join()
+        self.p_process.terminate()
+        self.p_process.join()
+        self.cacheDir.cleanup()
+
+    def testWorkersShareCache(self):
+        self.assertEqual(len(child_pids(self.p_process.pid)), 2)
+        for i in range(8):
+            r = requests.get('http://localhost:5001/prefork', proxies=self.proxies)
+            self.assertEqual(r.status_code, 200, 'Server returned non-200 status code')
+            time.sleep(0.1)
+        # Whichever worker each connection went to, the response was stored once
+        self.assertEqual(requests.get('http://localhost:5001/stats').json(), {'/prefork 200': 1})
+
+    def testCrashedWorkerIsRestarted(self):
+        workers = child_pids(self.p_process.pid)
+        os.kill(workers[0], signal.SIGKILL)
+        for i in range(30):
+            time.sleep(0.1)
+            if len(child_pids(self.p_process.pid)) == 2:
+                break
+        restarted = child_pids(self.p_process.pid)
+        self.assertEqual(len(restarted), 2)
+        self.assertNotIn(workers[0], restarted)
+        r = requests.get('http://localhost:5001/after-restart', proxies=self.proxies)
+        self.assertEqual(r.status_code, 200, 'Server returned non-200 status code')
+
+    def testSigtermDrains(self):
+        responses = []
+        client = threading.Thread(target=lambda: responses.append(
+            requests.get('http://localhost:5001/slow', proxies=self.proxies)))
+        client.start()
+        time.sleep(0.3)
+        self.p_process.terminate()
+        client.join()
+        # The request in progress was finished, and then the supervisor exited
+        self.assertEqual(responses[0].content, SLOW_BODY, 'File data does not match')
+        self.p_process.join(5)
+        self.assertEqual(self.p_process.exitcode, 0)
+
+# Run every scenario again against the blocking fallback loop
+class TestProxyBlocking(TestProxy):
+    proxyMode = 'blocking'
+
+class TestProxySegments(TestProxy):
+    cacheLayout = 'segments'
+
+# A response with 10 headers, as an origin would send it
+RESPONSE_10_HEADERS = b'HTTP/1.1 200 OK\r\n' + b''.join(f'X-Header-{i}: value {i}\r\n'.encode() for i in range(9)) + b'Content-Length: 5\r\n\r\nhello'
+
+class TestGatheredWrites(unittest.TestCase):
+    def setUp(self):
+        self.origin, self.upstream = socketpair()
+        self.client, self.downstream = socketpair()
+        self.origin.sendall(RESPONSE_10_HEADERS)
+
+    def tearDown(self):
+        for sock in (self.origin, self.upstream, self.client, self.downstream):
+            sock.close()
+
+    def testBlockingResponseIsOneSend(self):
+        sendsBefore = iostats.counts['send']
+        proxy.forward_and_cache_response(proxy.SocketFile(self.upstream), None, proxy.SocketFile(self.downstream))
+        self.assertEqual(iostats.counts['send'] - sendsBefore, 1, 'Headers and body were not sent together')
+        self.assertTrue(self.client.recv(4096).endswith(b'Connection: close\r\n\r\nhello'))
+
+    def testEngineResponseIsOneSend(self):
+        async def forward():
+            self.upstream.setblocking(False)
+            self.downstream.setblocking(False)
+            await engine.forward_and_cache_response(AsyncSocketFile(self.upstream), None, AsyncSocketFile(self.downstream))
+
+        sendsBefore = iostats.counts['send']
+        asyncio.run(forward())
+        self.assertEqual(iostats.counts['send'] - sendsBefore, 1, 'Headers and body were not sent together')
+        self.assertTrue(self.client.recv(4096).endswith(b'Connection: close\r\n\r\nhello'))
+
+# Copy data into a RecvBuffer as one recv would
+def receive(rbuf, data):
+    space = rbuf.space()
+    space[:len(data)] = data
+    rbuf.advance(len(data))
+
+class TestRecvBuffer(unittest.TestCase):
+    def testHeadSplitAcrossReads(self):
+        head = b'GET /split HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        # Split everywhere, including inside the CRLFCRLF
+        for split in range(1, len(head)):
+            rbuf = RecvBuffer()
+            receive(rbuf, head[:split])
+            self.assertIsNone(rbuf.take_head())
+            receive(rbuf, head[split:] + b'body')
+            self.assertEqual(rbuf.take_head(), head[:-4])
+            self.assertEqual(rbuf.take(4), b'body')
+            self.assertEqual(len(rbuf), 0)
+
+    def testPipelinedHeads(self):
+        rbuf = RecvBuffer()
+        receive(rbuf, b'GET /a HTTP/1.1\r\nHost: a\r\n\r\nGET /b HTTP/1.1\r\nHost: b\r\n\r\nGET /c')
+        self.assertEqual(rbuf.take_head(), b'GET /a HTTP/1.1\r\nHost: a')
+        self.assertEqual(rbuf.take_head(), b'GET /b HTTP/1.1\r\nHost: b')
+        self.assertIsNone(rbuf.take_head())
+        self.assertEqual(len(rbuf), 6)
+
+    def testSpaceCompactsAndGrows(self):
+        rbuf = RecvBuffer(16)
+        receive(rbuf, b'0123456789abcdef')
+        self.assertEqual(rbuf.take(10), b'0123456789')
+        # Full: the unread bytes move to the front to make room
+        self.assertEqual(len(rbuf.space()), 10)
+        self.assertEqual(len(rbuf.data), 16)
+        receive(rbuf, b'ghijklmnop')
+        # Full of unread bytes: the buffer doubles
+        self.assertEqual(len(rbuf.space()), 16)
+        self.assertEqual(len(rbuf.data), 32)
+        self.assertEqual(rbuf.take(16), b'abcdefghijklmnop')
+        # Everything read: the whole buffer is free again
+        self.assertEqual(len(rbuf.space()), 32)
+
+    def testTakeLineAndView(self):
+        rbuf = RecvBuffer()
+        receive(rbuf, b'5\r\nhello\r\n0')
+        self.assertEqual(rbuf.take_line(), b'5\r\n')
+        view = rbuf.take_view(5)
+        self.assertEqual(bytes(view), b'hello')
+        self.assertEqual(rbuf.take_line(), b'\r\n')
+        # No line ending yet
+        self.assertIsNone(rbuf.take_line())
+        # No more than there is
+        self.assertEqual(bytes(rbuf.take_view(10)), b'0')
+        self.assertEqual(bytes(rbuf.take_view(10)), b'')
+
+    def testParseHead(self):
+        requestLine, headers = parse_head(b'GET /x HTTP/1.1\r\nHost: localhost:5000\r\nno colon here\r\n'
+                                          b'Accept: text/html\r\naccept:  application/json \r\nX-Empty:')
+        self.assertEqual(requestLine, 'GET /x HTTP/1.1')
+        self.assertEqual(list(headers), [('Host', 'localhost:5000'), ('Accept', 'text/html'),
+                                         ('accept', 'application/json'), ('X-Empty', '')])
+        self.assertEqual(headers.get('HOST'), 'localhost:5000')
+        # Repeated headers are joined, whatever their case
+        self.assertEqual(headers.get('Accept'), 'text/html, application/json')
+        self.assertEqual(headers.get('x-empty'), '')
+        self.assertIsNone(headers.get('Content-Length'))
+        self.assertEqual(headers.get('Content-Length', '0'), '0')
+
+        headers.append(('ACCEPT', '*/*'))
+        self.assertEqual(headers.get('accept'), 'text/html, application/json, */*')
+
+    def testRequestBodyLength(self):
+        self.assertEqual(request_body_length(Headers()), 0)
+        self.assertEqual(request_body_length(Headers([('Content-Length', '12')])), 12)
+        self.assertEqual(request_body_length(Headers([('Transfer-Encoding', 'chunked')])), 'chunked')
+        for contentLength in ('zz', '-5', '+5', '', '5, 6', '\u0665'):
+            self.assertIsNone(request_body_length(Headers([('Content-Length', contentLength)])), contentLength)
+
+class TestFreshness(unittest.TestCase):
+    now = 1700000000
+
+    def expiry(self, headers, status='200', requestHeaders=None):
+        return response_expiry(f'HTTP/1.1 {status} OK', Headers(headers), requestHeaders, self.now)
+
+    def testExplicitFreshness(self):
+        self.assertEqual(self.expiry([('Cache-Control', 'max-age=60')]), self.now + 60)
+        self.assertEqual(self.expiry([('Cache-Control', 'max-age=60, s-maxage=10')]), self.now + 10)
+        self.assertEqual(self.expiry([('Cache-Control', 'max-age=60'), ('Age', '20')]), self.now + 40)
+        self.assertEqual(self.expiry([('Date', 'Tue, 14 Nov 2023 22:13:20 GMT'),
+                                      ('Expires', 'Tue, 14 Nov 2023 22:15:20 GMT')]), self.now + 120)
+        self.assertEqual(self.expiry([('Expires', '0')]), self.now)
+        self.assertEqual(self.expiry([('Cache-Control', 'no-cache, max-age=60')]), self.now)
+
+    def testHeuristicFreshness(self):
+        # A tenth of the time since the response was last modified
+        self.assertEqual(self.expiry([('Date', 'Tue, 14 Nov 2023 22:13:20 GMT'),
+                                      ('Last-Modified', 'Tue, 14 Nov 2023 21:13:20 GMT')]), self.now + 360)
+        self.assertEqual(self.expiry([]), self.now + 300)
+        self.assertIsNone(self.expiry([], status='403'))
+
+    def testNegativeFreshness(self):
+        self.assertEqual(self.expiry([], status='404'), self.now + 60)
+        self.assertEqual(self.expiry([], status='410'), self.now + 60)
+        self.assertEqual(self.expiry([], status='500'), self.now + 5)
+        self.assertEqual(self.expiry([('Cache-Control', 'max-age=30')], status='500'), self.now + 30)
+        self.assertIsNone(self.expiry([('Cache-Control', 'no-store')], status='404'))
+        ttls = {'not-found': 600, 'server-error': 0, 'connect': 1}
+        self.assertEqual(response_expiry('HTTP/1.1 404 Not Found', Headers(), None, self.now, ttls), self.now + 600)
+
+    def testNotStored(self):
+        self.assertIsNone(self.expiry([('Cache-Control', 'no-store')]))
+        self.assertIsNone(self.expiry([('Cache-Control', 'private, max-age=60')]))
+        self.assertIsNone(self.expiry([], status='304'))
+        self.assertIsNone(self.expiry([], requestHeaders=Headers([('Cache-Control', 'no-store')])))
+        self.assertIsNone(self.expiry([], requestHeaders=Headers([('Authorization', 'Basic dTpw')])))
+        self.assertIsNotNone(self.expiry([('Cache-Control', 'public')],
+                                         requestHeaders=Headers([('Authorization', 'Basic dTpw')])))
+        self.assertIsNone(self.expiry([('Vary', 'Accept-Language, *')]))
+
+    def testVary(self):
+        self.assertEqual(vary_names(Headers([('Vary', 'Accept-Language, cookie'), ('Vary', 'Accept-Encoding')])),
+                         ('accept-encoding', 'accept-language', 'cookie'))
+        self.assertEqual(vary_names(Headers()), ())
+        self.assertEqual(vary_value(Headers([('Accept-Language', 'en-US, de;q=0.5')]), 'accept-language'), 'en-us,de;q=0.5')
+        self.assertEqual(vary_value(Headers([('Accept-Encoding', 'gzip, deflate, br, zstd;q=0')]), 'accept-encoding'), 'br')
+        self.assertEqual(vary_value(Headers([('Accept-Encoding', 'gzip')]), 'accept-encoding'), '')
+
+    def testStaleWindows(self):
+        self.assertEqual(stale_windows(b'HTTP/1.1 200 OK\r\nCache-Control: max-age=1'), (0, 0))
+        self.assertEqual(stale_windows(b'HTTP/1.1 200 OK\r\nCache-Control: max-age=1', 10, 20), (10, 20))
+        self.assertEqual(stale_windows(b'HTTP/1.1 200 OK\r\nCache-Control: stale-while-revalidate=5, stale-if-error=7',
+                                       10, 20), (5, 7))
+        self.assertEqual(stale_windows(b'HTTP/1.1 200 OK\r\nCache-Control: must-revalidate, stale-if-error=7',
+                                       10, 20), (0, 0))
+
+    def testNotModifiedUpdatesStoredHeaders(self):
+        storedHead = b'HTTP/1.1 200 OK\r\nCache-Control: max-age=1\r\nETag: "v1"'
+        expires = refreshed_expiry(storedHead, Headers([('Cache-Control', 'max-age=600')]))
+        self.assertAlmostEqual(expires, time.time() + 600, delta=5)
+
+CHUNKED_RESPONSE = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                    b'5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n')
+
+class TestChunked(unittest.TestCase):
+    def setUp(self):
+        self.origin, self.upstream = socketpair()
+        self.client, self.downstream = socketpair()
+        self.origin.sendall(CHUNKED_RESPONSE)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.diskCache = DiskCache(self.tmp.name)
+        self.key = cache_key('localhost:5000/chunked')
+
+    def tearDown(self):
+        for sock in (self.origin, self.upstream, self.client, self.downstream):
+            sock.close()
+        self.tmp.cleanup()
+
+    def stored(self):
+        with open(self.diskCache.path(self.key), 'rb') as f:
+            return f.read()
+
+    def testEngineRechunksAndStoresPlainBody(self):
+        async def forward():
+            self.upstream.setblocking(False)
+            self.downstream.setblocking(False)
+            return await engine.forward_and_cache_response(AsyncSocketFile(self.upstream), self.diskCache.open_entry(self.key),
+                                                           AsyncSocketFile(self.downstream), keepAlive=True)
+
+        self.assertEqual(asyncio.run(forward()), (True, True))
+        received = self.client.recv(4096)
+        self.assertIn(b'\r\nTransfer-Encoding: chunked\r\n', received)
+        self.assertTrue(received.endswith(b'\r\n\r\n5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n'))
+        self.assertEqual(self.stored(), b'HTTP/1.1 200 OK\r\n\r\nhello world')
+        entry = make_entry(self.stored())
+        self.assertEqual(entry[0], b'HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\nhello world')
+
+    def testEngineDecodesForClosingClients(self):
+        async def forward():
+            self.upstream.setblocking(False)
+            self.downstream.setblocking(False)
+            return await engine.forward_and_cache_response(AsyncSocketFile(self.upstream), None,
+                                                           AsyncSocketFile(self.downstream), keepAlive=True, canChunk=False)
+
+        self.assertEqual(asyncio.run(forward()), (True, False))
+        self.assertEqual(self.client.recv(4096), b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nhello world')
+
+    def testBlockingDecodes(self):
+        proxy.forward_and_cache_response(proxy.SocketFile(self.upstream), self.diskCache.open_entry(self.key),
+                                         proxy.SocketFile(self.downstream))
+        self.assertEqual(self.client.recv(4096), b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nhello world')
+        self.assertEqual(self.stored(), b'HTTP/1.1 200 OK\r\n\r\nhello world')
+
+    def testBadChunkSizeIsNotStored(self):
+        bad = socketpair()
+        try:
+            bad[0].sendall(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\nhello\r\n0\r\n\r\n')
+            proxy.forward_and_cache_response(proxy.SocketFile(bad[1]), self.diskCache.open_entry(self.key),
+                                             proxy.SocketFile(self.downstream))
+        finally:
+            bad[0].close()
+            bad[1].close()
+        self.assertFalse(os.path.exists(self.diskCache.path(self.key)))
+        self.assertFalse(self.diskCache.lookup(self.key))
+
+class TestSlowPeers(unittest.TestCase):
+    def setUp(self):
+        self.client, self.downstream = socketpair()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.client.close()
+        self.downstream.close()
+        self.tmp.cleanup()
+
+    def testBlockingHeaderDeadline(self):
+        # Half a header section, then nothing: the deadline ends it
+        self.client.sendall(b'GET http://localhost:5000/test-slow HTTP/1.1\r\nHost: local')
+        sockf = proxy.SocketFile(self.downstream, 5)
+        sockf.deadline = time.monotonic() + 0.2
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            proxy.parse_http_headers(sockf)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(sockf.timedOut)
+
+    def testBlockingIdleTimeout(self):
+        # An origin that stops partway through a body
+        self.client.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nhello')
+        sockf = proxy.SocketFile(self.downstream, 0.2)
+        proxy.parse_http_headers(sockf)
+        self.assertEqual(sockf.read(100), b'hello')
+        with self.assertRaises(TimeoutError):
+            sockf.read(95)
+
+    def testHeaderTooLarge(self):
+        rbuf = RecvBuffer()
+        piece = b'X-Filler: ' + b'x' * 8180 + b'\r\n'
+        for i in range(8):
+            rbuf.space()[:len(piece)] = piece
+            rbuf.advance(len(piece))
+            self.assertIsNone(rbuf.take_head())
+        # Past 64 KiB without the blank line
+        rbuf.space()[:len(piece)] = piece
+        rbuf.advance(len(piece))
+        with self.assertRaises(HeaderTooLarge):
+            rbuf.take_head()
+
+    def testEngineSlowHeader(self):
+        async def serve():
+            self.downstream.setblocking(False)
+            server = engine.Engine(DiskCache(self.tmp.name), headerTimeout=0.2)
+            await server.handle_client(self.downstream)
+
+        self.client.sendall(b'GET http://localhost:5000/test-slow HTTP/1.1\r\n')
+        start = time.monotonic()
+        asyncio.run(serve())
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(self.client.recv(4096).startswith(b'HTTP/1.1 408 Request Timeout\r\n'))
+        self.assertEqual(self.client.recv(4096), b'')
+
+    def testEngineLargeHeader(self):
+        async def serve():
+            self.downstream.setblocking(False)
+            await engine.Engine(DiskCache(self.tmp.name)).handle_client(self.downstream)
+
+        # Never ends, but is refused once it is too long
+        self.client.sendall(b'GET http://localhost:5000/test-large HTTP/1.1\r\n' + b'X-Filler: xxxxxxxx\r\n' * 5000)
+        asyncio.run(serve())
+        self.assertTrue(self.client.recv(4096).startswith(b'HTTP/1.1 431 Request Header Fields Too Large\r\n'))
+
+    def testEngineUpstreamIdle(self):
+        async def read():
+            self.downstream.setblocking(False)
+            sockf = AsyncSocketFile(self.downstream, 0.2)
+            with self.assertRaises(TimeoutError):
+                await engine.read_response_head(sockf)
+            return sockf.timedOut
+
+        self.client.sendall(b'HTTP/1.1 200 OK\r\n')
+        self.assertTrue(asyncio.run(read()))
+
+    def testClientConnectionLimit(self):
+        async def connect(port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            await asyncio.sleep(0.05)
+            return reader, writer
+
+        async def serve():
+            listener = create_server(('127.0.0.1', 0))
+            listener.setblocking(False)
+            port = listener.getsockname()[1]
+            server = engine.Engine(DiskCache(self.tmp.name), maxClientConnections=2)
+            accepting = asyncio.create_task(server.accept_forever(listener))
+            try:
+                first = await connect(port)
+                second = await connect(port)
+                self.assertEqual(server.clientConnections, {'127.0.0.1': 2})
+                third = await connect(port)
+                self.assertTrue((await third[0].read()).startswith(b'HTTP/1.1 503 Service Unavailable\r\n'))
+                # Once one of its connections closes, the client may open another
+                first[1].close()
+                await asyncio.sleep(0.1)
+                self.assertEqual(server.clientConnections, {'127.0.0.1': 1})
+                fourth = await connect(port)
+                self.assertEqual(server.clientConnections, {'127.0.0.1': 2})
+                for reader, writer in (second, third, fourth):
+                    writer.close()
+                await asyncio.sleep(0.1)
+                self.assertEqual(server.clientConnections, {})
+            finally:
+                accepting.cancel()
+                for task in list(server.clients):
+                    task.cancel()
+                await asyncio.gather(accepting, *server.clients, return_exceptions=True)
+                listener.close()
+
+        asyncio.run(serve())
+
+class TestRanges(unittest.TestCase):
+    head = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nETag: "v1"\r\nLast-Modified: Tue, 14 Nov 2023 21:13:20 GMT'
+
+    def testParseRange(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(parse_range('bytes=900-', 1000), [(900, 999)])
+        self.assertEqual(parse_range('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(parse_range('bytes=-2000', 1000), [(0, 999)])
+        self.assertEqual(parse_range('bytes=990-2000', 1000), [(990, 999)])
+        self.assertEqual(parse_range('bytes=0-0, 5-9', 1000), [(0, 0), (5, 9)])
+        # Unsatisfiable
+        self.assertEqual(parse_range('bytes=1000-', 1000), [])
+        self.assertEqual(parse_range('bytes=-0', 1000), [])
+        # Invalid, so ignored
+        for value in ('items=0-9', 'bytes=9-0', 'bytes=a-b', 'bytes=-', 'bytes=5', 'bytes=' + ','.join(['0-1'] * 17)):
+            self.assertIsNone(parse_range(value, 1000), value)
+
+    def testIfRange(self):
+        headers = parse_head(self.head)[1]
+        self.assertTrue(if_range_matches('"v1"', headers))
+        self.assertFalse(if_range_matches('"v2"', headers))
+        self.assertFalse(if_range_matches('W/"v1"', headers))
+        self.assertTrue(if_range_matches('Tue, 14 Nov 2023 21:13:20 GMT', headers))
+        self.assertFalse(if_range_matches('Tue, 14 Nov 2023 21:13:21 GMT', headers))
+
+    def testRangeResponse(self):
+        head, parts = range_response(self.head, [(10, 19)], 100, True)
+        self.assertTrue(head.startswith(b'HTTP/1.1 206 Partial Content\r\n'))
+        self.assertIn(b'Content-Range: bytes 10-19/100\r\nContent-Length: 10\r\n', head)
+        self.assertEqual(parts, [(10, 10)])
+
+        head, parts = range_response(self.head, [(0, 0), (99, 99)], 100)
+        self.assertIn(b'Content-Type: multipart/byteranges', head)
+        self.assertEqual([part for part in parts if not isinstance(part, bytes)], [(0, 1), (99, 1)])
+        length = sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+        self.assertIn(f'Content-Length: {length}\r\n'.encode(), head)
+        self.assertIn(b'Content-Type: text/plain\r\nContent-Range: bytes 99-99/100\r\n\r\n', parts[2])
+
+        head, parts = range_response(self.head, [], 100)
+        self.assertTrue(head.startswith(b'HTTP/1.1 416 Range Not Satisfiable\r\n'))
+        self.assertIn(b'Content-Range: bytes */100\r\n', head)
+        self.assertEqual(parts, [])
+
+# Collects what is written to it, in place of a CacheFile
+class MemoryCacheFile:
+    def __init__(self):
+        self.data = b''
+        self.committed = False
+
+    def writev(self, buffers):
+        self.data += b''.join(buffers)
+
+    def commit(self):
+        self.committed = True
+
+class TestMetrics(unittest.TestCase):
+    def testHistogramBuckets(self):
+        histogram = metrics.Histogram((0.001, 0.01))
+        for seconds in (0.0005, 0.001, 0.005, 0.5):
+            histogram.observe(seconds)
+        # Bounds are inclusive, and the last bucket takes everything above them
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+
+    def testRender(self):
+        cacheBefore = metrics.responses['cache']
+        timer = metrics.RequestTimer()
+        timer.mark('lookup')
+        timer.source = 'cache'
+        timer.finish(100)
+        text = metrics.render([('proxy_test_entries', 'Test gauge.', 7)]).decode()
+        self.assertIn('# TYPE proxy_request_phase_seconds histogram', text)
+        samples = dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+        self.assertEqual(samples['proxy_responses_total{source="cache"}'], str(cacheBefore + 1))
+        # Buckets are cumulative, so the last one counts every observation
+        self.assertEqual(samples['proxy_request_phase_seconds_bucket{phase="lookup",le="+Inf"}'],
+                         samples['proxy_request_phase_seconds_count{phase="lookup"}'])
+        self.assertEqual(samples['proxy_test_entries'], '7')
+
+class TestCodings(unittest.TestCase):
+    def testAcceptsCoding(self):
+        self.assertTrue(accepts_coding(Headers([('Accept-Encoding', 'gzip, deflate, br')]), 'gzip'))
+        self.assertTrue(accepts_coding(Headers([('Accept-Encoding', 'br;q=1.0, *;q=0.5')]), 'gzip'))
+        self.assertTrue(accepts_coding(Headers([('Accept-Encoding', 'x-gzip')]), 'gzip'))
+        self.assertFalse(accepts_coding(Headers([('Accept-Encoding', 'gzip;q=0, *')]), 'gzip'))
+        self.assertFalse(accepts_coding(Headers([('Accept-Encoding', 'identity')]), 'gzip'))
+        self.assertFalse(accepts_coding(Headers(), 'gzip'))
+
+    def testShouldCompress(self):
+        html = [('Content-Type', 'text/html; charset=utf-8')]
+        self.assertTrue(should_compress('HTTP/1.1 200 OK', Headers(html)))
+        self.assertTrue(should_compress('HTTP/1.1 200 OK', Headers([('Content-Type', 'application/json')])))
+        self.assertFalse(should_compress('HTTP/1.1 200 OK', Headers([('Content-Type', 'image/png')])))
+        self.assertFalse(should_compress('HTTP/1.1 404 Not Found', Headers(html)))
+        self.assertFalse(should_compress('HTTP/1.1 200 OK', Headers(html + [('Content-Length', '100')])))
+        self.assertFalse(should_compress('HTTP/1.1 200 OK', Headers(html + [('Content-Encoding', 'br')])))
+        self.assertFalse(should_compress('HTTP/1.1 200 OK', Headers(html + [('Cache-Control', 'no-transform')])))
+
+    def testEncodedHeaders(self):
+        headers = encoded_headers([('Content-Length', '5000'), ('ETag', '"v1"'), ('Vary', 'Cookie')], 'gzip')
+        self.assertEqual(headers, [('ETag', 'W/"v1"'), ('Vary', 'Cookie, Accept-Encoding'), ('Content-Encoding', 'gzip')])
+
+    def testEncodeAndDecode(self):
+        cachef = MemoryCacheFile()
+        encoder = EncodingCacheFile(cachef, CODECS['gzip'], b'HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n\r\n')
+        for i in range(0, len(BIG_TEXT), 65536):
+            encoder.writev([BIG_TEXT[i:i + 65536]])
+        encoder.commit()
+        self.assertTrue(cachef.committed)
+        head, _, body = cachef.data.partition(b'\r\n\r\n')
+        self.assertEqual(zlib.decompress(body, 31), BIG_TEXT)
+
+        pieces = list(decode(CODECS['gzip'], [body[:1000], body[1000:]]))
+        self.assertEqual(b''.join(pieces), BIG_TEXT)
+        self.assertLessEqual(max(len(piece) for piece in pieces), DECODE_BLOCK)
+
+class TestCircuitBreaker(unittest.TestCase):
+    origin = ('localhost', 5001)
+
+    def testServerErrorsOpenCircuit(self):
+        breaker = CircuitBreaker(failureThreshold=3, openTime=10)
+        for i in range(2):
+            breaker.failure(self.origin, now=0)
+        breaker.success(self.origin)
+        for i in range(2):
+            breaker.failure(self.origin, now=0)
+        self.assertTrue(breaker.allow(self.origin, now=0), 'Failures not in a row opened the circuit')
+        breaker.failure(self.origin, now=0)
+        self.assertEqual(breaker.state(self.origin, now=5), 'open')
+        self.assertFalse(breaker.allow(self.origin, now=5))
+
+    def testConnectFailureOpensCircuitAtOnce(self):
+        breaker = CircuitBreaker()
+        breaker.failure(self.origin, openTime=2, now=0)
+        self.assertFalse(breaker.allow(self.origin, now=1))
+        self.assertTrue(breaker.allow(('localhost', 5002), now=1))
+        self.assertTrue(breaker.allow(self.origin, now=3))
+
+    def testHalfOpenTrial(self):
+        breaker = CircuitBreaker(failureThreshold=1, openTime=10)
+        breaker.failure(self.origin, now=0)
+        self.assertEqual(breaker.state(self.origin, now=10), 'half-open')
+        # One trial request at a time
+        self.assertTrue(breaker.allow(self.origin, now=10))
+        self.assertFalse(breaker.allow(self.origin, now=11))
+        # A failed trial reopens the circuit
+        breaker.failure(self.origin, now=11)
+        self.assertFalse(breaker.allow(self.origin, now=20))
+        self.assertTrue(breaker.allow(self.origin, now=21))
+        breaker.success(self.origin)
+        self.assertEqual(breaker.state(self.origin), 'closed')
+        self.assertTrue(breaker.allow(self.origin))
+
+# Resolver with /etc/hosts-style entries that counts its lookups
+class StubResolver:
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.lookups = 0
+
+    def __call__(self, hostname, portn):
+        self.lookups += 1
+        if hostname not in self.hosts:
+            raise gaierror(EAI_NONAME, 'Name or service not known')
+        return [(ip, portn) for ip in self.hosts[hostname]]
+
+class TestDnsCache(unittest.TestCase):
+    def setUp(self):
+        self.resolver = StubResolver({'origin': ['10.0.0.1'], 'pool': ['10.0.0.1', '10.0.0.2', '10.0.0.3']})
+
+    def testResolutionIsCached(self):
+        dnsCache = DnsCache(resolver=self.resolver)
+        timedBefore = iostats.timed['resolve']
+        for i in range(3):
+            self.assertEqual(dnsCache.resolve('origin', 80), ('10.0.0.1', 80))
+        self.assertEqual(self.resolver.lookups, 1)
+        self.assertEqual((dnsCache.hits, dnsCache.misses), (2, 1))
+        self.assertEqual(iostats.timed['resolve'] - timedBefore, 1, 'Resolution was not timed')
+
+        # Expired: resolved again
+        dnsCache.entries[('origin', 80)].expires = 0
+        dnsCache.resolve('origin', 80)
+        self.assertEqual(self.resolver.lookups, 2)
+
+    def testRoundRobin(self):
+        dnsCache = DnsCache(resolver=self.resolver)
+        ips = [dnsCache.resolve('pool', 80)[0] for i in range(6)]
+        self.assertEqual(ips, ['10.0.0.1', '10.0.0.2', '10.0.0.3'] * 2)
+
+    def testFailureIsCached(self):
+        dnsCache = DnsCache(resolver=self.resolver)
+        for i in range(2):
+            with self.assertRaises(gaierror):
+                dnsCache.resolve('nowhere', 80)
+        self.assertEqual(self.resolver.lookups, 1)
+
+        dnsCache.entries[('nowhere', 80)].expires = 0
+        self.resolver.hosts['nowhere'] = ['10.0.0.9']
+        self.assertEqual(dnsCache.resolve('nowhere', 80), ('10.0.0.9', 80))
+
+    def testRefreshAhead(self):
+        dnsCache = DnsCache(ttl=60, refreshAhead=0.5, resolver=self.resolver)
+        dnsCache.resolve('origin', 80)
+        self.resolver.hosts['origin'] = ['10.0.0.5']
+        # Past refreshAhead the cached address is still used, while a thread resolves it again
+        self.assertEqual(dnsCache.cached('origin', 80, now=time.monotonic() + 40), ('10.0.0.1', 80))
+        dnsCache.refreshing[('origin', 80)].join()
+        self.assertEqual(dnsCache.resolve('origin', 80), ('10.0.0.5', 80))
+        self.assertEqual(self.resolver.lookups, 2)
+
+    def testFailedRefreshKeepsAddresses(self):
+        dnsCache = DnsCache(resolver=self.resolver)
+        dnsCache.resolve('origin', 80)
+        del self.resolver.hosts['origin']
+        dnsCache.refresh('origin', 80)
+        self.assertEqual(dnsCache.resolve('origin', 80), ('10.0.0.1', 80))
+
+    def testFailedRefreshIsNotRetriedOnEveryHit(self):
+        dnsCache = DnsCache(resolver=self.resolver)
+        dnsCache.resolve('origin', 80)
+        del self.resolver.hosts['origin']
+        # Due for a refresh, which fails
+        dnsCache.entries[('origin', 80)].refreshAt = 0
+        dnsCache.cached('origin', 80)
+        dnsCache.refreshing[('origin', 80)].join()
+        self.assertEqual(self.resolver.lookups, 2)
+        # While the resolver is failing, hits go on using the old addresses without asking it again
+        for i in range(3):
+            self.assertEqual(dnsCache.cached('origin', 80), ('10.0.0.1', 80))
+        self.assertFalse(dnsCache.refreshing)
+        self.assertEqual(self.resolver.lookups, 2)
+
+    def testAsyncResolve(self):
+        dnsCache = DnsCache(resolver=self.resolver)
+        self.assertEqual(asyncio.run(dnsCache.resolve_async('origin', 80)), ('10.0.0.1', 80))
+        self.assertEqual(asyncio.run(dnsCache.resolve_async('origin', 80)), ('10.0.0.1', 80))
+        self.assertEqual(self.resolver.lookups, 1)
+
+class TestMemoryCache(unittest.TestCase):
+    def entry(self, body):
+        return make_entry(b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n' + body)
+
+    def testEntryFraming(self):
+        data = b''.join(entry_buffers(self.entry(b'hello'), True))
+        self.assertEqual(data, b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\nConnection: keep-alive\r\n\r\nhello')
+
+    def testEvictsLeastRecentlyUsed(self):
+        entrySize = len(self.entry(b'x' * 100)[0])
+        memCache = MemoryCache(budget=3 * entrySize)
+        for key in ('a', 'b', 'c'):
+            memCache.put(key, self.entry(b'x' * 100))
+        memCache.get('a')
+        memCache.put('d', self.entry(b'x' * 100))
+        self.assertIsNone(memCache.get('b'))
+        self.assertIsNotNone(memCache.get('a'))
+        self.assertEqual(memCache.evictions, 1)
+        self.assertEqual(memCache.size, 3 * entrySize)
+        self.assertEqual((memCache.hits, memCache.misses), (2, 1))
+
+    def testMaxEntrySize(self):
+        memCache = MemoryCache(maxEntrySize=100)
+        self.assertFalse(memCache.put('big', self.entry(b'x' * 100)))
+        self.assertIsNone(memCache.get('big'))
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    # Store a response of size bytes under a key, as a cache miss would
+    def store(self, diskCache, key, size=100):
+        cachef = diskCache.open_entry(key)
+        if cachef is not None:
+            cachef.write(b'x' * size)
+            cachef.commit()
+        return cachef is not None
+
+    def testShardedPaths(self):
+        diskCache = DiskCache(self.tmp.name)
+        key = cache_key('localhost:5000/test')
+        self.assertEqual(diskCache.path(key), os.path.join(self.tmp.name, key[:2], key[2:4], key))
+        self.assertFalse(diskCache.lookup(key))
+        self.assertTrue(self.store(diskCache, key))
+        self.assertTrue(os.path.isfile(diskCache.path(key)))
+        self.assertTrue(diskCache.lookup(key))
+
+    def testAbortedEntryIsDeleted(self):
+        diskCache = DiskCache(self.tmp.name)
+        key = cache_key('localhost:5000/aborted')
+        cachef = diskCache.open_entry(key)
+        cachef.write(b'HTTP/1.1 200 OK\r\n')
+        cachef.abort()
+        self.assertFalse(os.path.exists(diskCache.path(key)))
+        self.assertFalse(diskCache.lookup(key))
+
+    def testByteLimitEvictsIncrementally(self):
+        diskCache = DiskCache(self.tmp.name, maxBytes=300)
+        keys = [cache_key(f'localhost:5000/{i}') for i in range(5)]
+        for i, key in enumerate(keys):
+            # Each key is more popular than the last, so it is admitted over the entry it replaces
+            for j in range(i + 1):
+                diskCache.lookup(key)
+            self.assertTrue(self.store(diskCache, key))
+        self.assertEqual(len(diskCache), 3)
+        self.assertEqual(diskCache.size, 300)
+        self.assertEqual(diskCache.evictions, 2)
+        self.assertFalse(os.path.exists(diskCache.path(keys[0])))
+        self.assertTrue(os.path.exists(diskCache.path(keys[4])))
+
+    def testOneOffsDoNotDisplacePopularEntries(self):
+        diskCache = DiskCache(self.tmp.name, maxEntries=2)
+        popular = [cache_key(f'localhost:5000/popular-{i}') for i in range(2)]
+        for key in popular:
+            for i in range(3):
+                diskCache.lookup(key)
+            self.store(diskCache, key)
+
+        for i in range(10):
+            oneOff = cache_key(f'localhost:5000/one-off-{i}')
+            self.assertFalse(diskCache.lookup(oneOff))
+            self.assertFalse(self.store(diskCache, oneOff), 'One-off URL was admitted')
+        self.assertEqual(diskCache.rejections, 10)
+        for key in popular:
+            self.assertTrue(diskCache.lookup(key))
+
+    def testIndexSurvivesRestart(self):
+        diskCache = DiskCache(self.tmp.name)
+        keys = [cache_key(f'localhost:5000/{i}') for i in range(3)]
+        for key in keys:
+            self.store(diskCache, key)
+        diskCache.remove(keys[1])
+        # No close(): the journal alone has to be enough after a crash
+        diskCache = DiskCache(self.tmp.name)
+        self.assertEqual(len(diskCache), 2)
+        self.assertEqual(diskCache.size, 200)
+        self.assertEqual(list(diskCache.probation), [keys[0], keys[2]])
+
+        # A clean shutdown checkpoints which entries were protected too
+        diskCache.lookup(keys[2])
+        diskCache.close()
+        diskCache = DiskCache(self.tmp.name)
+        self.assertEqual(list(diskCache.probation), [keys[0]])
+        self.assertEqual(list(diskCache.protected), [keys[2]])
+        self.assertFalse(diskCache.lookup(keys[1]))
+
+    def testUncommittedEntryIsNeverServed(self):
+        diskCache = DiskCache(self.tmp.name)
+        key = cache_key('localhost:5000/truncated')
+        cachef = diskCache.open_entry(key)
+        cachef.write(b'HTTP/1.1 200 OK\r\n')
+        self.assertFalse(os.path.exists(diskCache.path(key)))
+
+        # The proxy dies before committing: the next run neither serves nor keeps the partial file
+        diskCache = DiskCache(self.tmp.name)
+        self.assertFalse(diskCache.lookup(key))
+        self.assertEqual(os.listdir(diskCache.tmpDir), [])
+
+    def testJournalIsCheckpointed(self):
+        diskCache = DiskCache(self.tmp.name, maxEntries=10)
+        key = cache_key('localhost:5000/rewritten')
+        for i in range(2000):
+            diskCache.lookup(key)
+            self.store(diskCache, key)
+        # Each store journals a removal and an add, but only the live entry is kept
+        self.assertLess(diskCache.journalLines, 2 * len(diskCache) + 1024 + 1)
+        diskCache.close()
+        with open(diskCache.indexPath) as f:
+            self.assertEqual(f.read(), f'+ {key} 100 0\n')
+
+    def testSegmentLayout(self):
+        diskCache = DiskCache(self.tmp.name, layout='segments')
+        keys = [cache_key(f'localhost:5000/{i}') for i in range(100)]
+        for key in keys:
+            cachef = diskCache.open_entry(key)
+            cachef.writev([b'HTTP/1.1 200 OK\r\n\r\n', key.encode()])
+            cachef.commit()
+        # An aborted response is cut off again
+        cachef = diskCache.open_entry(cache_key('localhost:5000/aborted'))
+        cachef.write(b'x' * 1000)
+        cachef.abort()
+        diskCache.remove(keys[1])
+        self.assertEqual(os.listdir(diskCache.store.dir), ['00000000.seg'])
+        self.assertEqual(os.path.getsize(diskCache.path(keys[0])), 100 * (19 + 32))
+
+        # The journal says where each response is, so it survives a restart without close()
+        diskCache = DiskCache(self.tmp.name, layout='segments')
+        self.assertEqual(len(diskCache), 99)
+        for key in keys[2:]:
+            with diskCache.open(key) as cachef:
+                self.assertEqual(cachef.read(), b'HTTP/1.1 200 OK\r\n\r\n' + key.encode())
+        with self.assertRaises(FileNotFoundError):
+            diskCache.open(keys[1])
+
+    def testSegmentCompaction(self):
+        diskCache = DiskCache(self.tmp.name, layout='segments')
+        diskCache.store.segmentSize = 1000
+        keys = [cache_key(f'localhost:5000/{i}') for i in range(30)]
+        for key in keys:
+            cachef = diskCache.open_entry(key)
+            cachef.write(key.encode() * 3 + b'0123')
+            cachef.commit()
+        self.assertEqual(sorted(diskCache.store.segments), [0, 1, 2])
+        self.assertFalse(diskCache.compact())
+
+        # Most of the first segment is dead: its live responses are moved out and it is deleted
+        for key in keys[:8]:
+            diskCache.remove(key)
+        reader = diskCache.open(keys[9])
+        self.assertTrue(diskCache.compact())
+        self.assertEqual(sorted(diskCache.store.segments), [1, 2, 3])
+        self.assertFalse(diskCache.compact())
+        # A response opened before it was moved can still be read
+        self.assertEqual(reader.read(32), keys[9].encode())
+        reader.close()
+
+        diskCache = DiskCache(self.tmp.name, layout='segments')
+        self.assertEqual(len(diskCache), 22)
+        for key in keys[8:]:
+            with diskCache.open(key) as cachef:
+                self.assertEqual(cachef.read(), key.encode() * 3 + b'0123')
+
+    def testWorkersShareFiles(self):
+        worker0 = DiskCache(self.tmp.name, worker=0)
+        worker1 = DiskCache(self.tmp.name, worker=1)
+        key = cache_key('localhost:5000/shared')
+        cachef = worker0.open_entry(key, time.time() + 60)
+        cachef.write(b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 5\r\n\r\nhello')
+        cachef.commit()
+        # The other worker finds the file on its first miss, fresh for as long as its headers say
+        self.assertTrue(worker1.lookup(key))
+        self.assertTrue(worker1.fresh(key))
+        self.assertFalse(worker1.fresh(key, time.time() + 61))
+        # Each keeps a journal of its own
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, 'index.0')))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, 'index.1')))
+        # One evicting it leaves the other to find it gone
+        worker0.remove(key)
+        with self.assertRaises(FileNotFoundError):
+            worker1.open(key)
+        self.assertFalse(worker0.lookup(key))
+        with self.assertRaises(ValueError):
+            DiskCache(self.tmp.name, layout='segments', worker=2)
+
+    def testVariants(self):
+        diskCache = DiskCache(self.tmp.name, maxVariants=2)
+        key = cache_key('localhost:5000/negotiated')
+        names = ('accept-language',)
+        english = Headers([('Accept-Language', 'en')])
+        self.assertEqual(diskCache.select(key, english), key)
+        variants = []
+        for language in ('en', 'de', 'fr'):
+            variants.append(diskCache.store_key(key, names, Headers([('Accept-Language', language)])))
+            self.store(diskCache, variants[-1])
+        self.assertEqual(len(set(variants) | {key}), 4)
+        self.assertEqual(diskCache.select(key, english), variants[0])
+        # Only the two variants stored last are kept
+        self.assertFalse(diskCache.lookup(variants[0]))
+        self.assertTrue(diskCache.lookup(variants[1]))
+
+        diskCache = DiskCache(self.tmp.name, maxVariants=2)
+        self.assertEqual(diskCache.select(key, Headers([('Accept-Language', 'fr')])), variants[2])
+        self.assertEqual(list(diskCache.variants[key]), variants[1:])
+
+        # The URL stops varying: its variants can't be selected any more
+        self.assertEqual(diskCache.store_key(key, (), english), key)
+        self.assertEqual(len(diskCache), 0)
+        self.assertEqual(diskCache.select(key, english), key)
+        diskCache.close()
+        self.assertEqual(DiskCache(self.tmp.name).varies, {})
+
+    def testExpiryIsJournaled(self):
+        diskCache = DiskCache(self.tmp.name)
+        key = cache_key('localhost:5000/expiring')
+        cachef = diskCache.open_entry(key, 1000)
+        cachef.write(b'x' * 100)
+        cachef.commit()
+        self.assertTrue(diskCache.fresh(key, now=999))
+        self.assertFalse(diskCache.fresh(key, now=1000))
+
+        diskCache.refresh(key, 2000)
+        diskCache = DiskCache(self.tmp.name)
+        self.assertTrue(diskCache.fresh(key, now=1999))
+        self.assertFalse(diskCache.fresh(key, now=2000))
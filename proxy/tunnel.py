@@ -0,0 +1,142 @@
+# CONNECT tunnels (RFC 9110 9.3.6), which is how HTTPS goes through the proxy:
+# once the proxy has connected to the host and port a client asks for and
+# answered 200, it relays bytes both ways without looking at them
+# The blocking loop and the engine relay the same way: each direction has one
+# preallocated buffer that recv_into() fills and the whole of it is sent on,
+# so a long transfer allocates nothing per read. When one side stops sending,
+# the other side's sending half is shut down and the other direction carries on
+from socket import *
+import asyncio
+import select
+import time
+
+import iostats
+import metrics
+
+# Size of each direction's relay buffer
+RELAY_BUFFER = 65536
+# Seconds a tunnel may carry nothing either way before it is closed
+TUNNEL_IDLE_TIMEOUT = 300.0
+# Answer to a CONNECT request once the tunnel is up
+ESTABLISHED = b'HTTP/1.1 200 Connection Established\r\n\r\n'
+
+# Parse the target of a CONNECT request, in authority form
+# requestUri: Request target, e.g. 'example.com:443'
+# Returns: (hostname: str, portn: int), or None if it isn't a host and port
+def connect_target(requestUri):
+    hostname, colon, portn = requestUri.rpartition(':')
+    if not colon or not hostname or not portn.isdigit():
+        return None
+    return hostname.strip('[]'), int(portn)
+
+# Counters of one tunnel, also added to the totals in metrics
+# target: Host and port the tunnel goes to, as the client asked for them
+class Tunnel:
+    def __init__(self, target):
+        self.target = target
+        self.opened = time.monotonic()
+        # When the tunnel last relayed anything, either way
+        self.last = self.opened
+        # Bytes relayed from the client to the origin, and from the origin to the client
+        self.bytesUp = 0
+        self.bytesDown = 0
+        # recv_into() and send calls made relaying
+        self.recvs = 0
+        self.sends = 0
+        metrics.tunnel_opened()
+
+    # Count bytes relayed one way
+    # up: Whether they went from the client to the origin
+    def relayed(self, up, nbytes):
+        if up:
+            self.bytesUp += nbytes
+        else:
+            self.bytesDown += nbytes
+        self.sends += 1
+        self.last = time.monotonic()
+
+    def close(self):
+        metrics.tunnel_closed(self.bytesUp, self.bytesDown)
+
+    def summary(self):
+        return (f'Tunnel to {self.target} closed after {time.monotonic() - self.opened:.1f}s: '
+                f'{self.bytesUp} bytes up, {self.bytesDown} bytes down, {self.recvs} recvs, {self.sends} sends')
+
+def shutdown_send(sock):
+    try:
+        sock.shutdown(SHUT_WR)
+    except OSError:
+        # The peer is gone already; the other direction will find out
+        pass
+
+# Relay between two blocking sockets until both directions have ended
+# client, origin: Connected sockets, closed by the caller
+# tunnel: Tunnel to count on
+# pending: Bytes the client sent behind its CONNECT request, before the tunnel was up
+# idleTimeout: Seconds without anything to relay before giving up
+# Raises: OSError if either side fails, TimeoutError once idleTimeout passes
+def relay(client, origin, tunnel, pending=b'', idleTimeout=TUNNEL_IDLE_TIMEOUT):
+    if pending:
+        origin.sendall(pending)
+        iostats.count('send')
+        tunnel.relayed(True, len(pending))
+    buffers = {client: memoryview(bytearray(RELAY_BUFFER)), origin: memoryview(bytearray(RELAY_BUFFER))}
+    peers = {client: origin, origin: client}
+    reading = [client, origin]
+    while reading:
+        readable = select.select(reading, [], [], idleTimeout)[0]
+        iostats.count('select')
+        if not readable:
+            if time.monotonic() - tunnel.last >= idleTimeout:
+                raise TimeoutError(f'Tunnel to {tunnel.target} idle for {idleTimeout:.0f}s')
+            continue
+        for sock in readable:
+            view = buffers[sock]
+            nbytes = sock.recv_into(view)
+            iostats.count('recv')
+            tunnel.recvs += 1
+            if nbytes == 0:
+                reading.remove(sock)
+                shutdown_send(peers[sock])
+                continue
+            peers[sock].sendall(view[:nbytes])
+            iostats.count('send')
+            tunnel.relayed(sock is client, nbytes)
+
+# Relay one way between two non-blocking sockets until the sending side is done
+async def pump(src, dst, tunnel, up, idleTimeout):
+    loop = asyncio.get_running_loop()
+    view = memoryview(bytearray(RELAY_BUFFER))
+    while True:
+        try:
+            nbytes = await asyncio.wait_for(loop.sock_recv_into(src, view), idleTimeout)
+        except asyncio.TimeoutError:
+            # Only idle if the other direction has been quiet as well
+            if time.monotonic() - tunnel.last < idleTimeout:
+                continue
+            raise TimeoutError(f'Tunnel to {tunnel.target} idle for {idleTimeout:.0f}s')
+        iostats.count('recv')
+        tunnel.recvs += 1
+        if nbytes == 0:
+            shutdown_send(dst)
+            return
+        await loop.sock_sendall(dst, view[:nbytes])
+        iostats.count('send')
+        tunnel.relayed(up, nbytes)
+
+# Relay between two non-blocking sockets until both directions have ended, as relay() does
+# Raises: OSError if either side fails, TimeoutError once idleTimeout passes
+async def relay_async(client, origin, tunnel, pending=b'', idleTimeout=TUNNEL_IDLE_TIMEOUT):
+    if pending:
+        await asyncio.get_running_loop().sock_sendall(origin, pending)
+        iostats.count('send')
+        tunnel.relayed(True, len(pending))
+    pumps = [asyncio.create_task(pump(client, origin, tunnel, True, idleTimeout)),
+             asyncio.create_task(pump(origin, client, tunnel, False, idleTimeout))]
+    try:
+        await asyncio.gather(*pumps)
+    finally:
+        # If one direction failed, stop the other before the caller closes the sockets
+        for task in pumps:
+            task.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
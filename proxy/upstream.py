@@ -0,0 +1,188 @@
+# Persistent connections from the proxy to origin servers
+from socket import *
+import asyncio
+import time
+
+from asyncsock import AsyncSocketFile
+
+# A keep-alive connection to one origin
+# readTimeout: Seconds the origin may go without sending or taking anything
+#              while a request is under way
+class UpstreamConnection:
+    def __init__(self, key, sock, readTimeout=None):
+        self.key = key
+        self.sock = sock
+        self.sockf = AsyncSocketFile(sock, readTimeout)
+        # Number of requests sent on this connection so far
+        self.requests = 0
+        self.idleSince = time.monotonic()
+
+    def close(self):
+        self.sock.close()
+
+    # Check that an idle connection can still carry a request
+    # The origin may have closed it, or sent bytes nobody asked for
+    def healthy(self):
+        if self.sockf.pending() or self.sockf.eof:
+            return False
+        try:
+            data = self.sock.recv(1, MSG_PEEK)
+        except BlockingIOError:
+            # Nothing to read: the connection is open and quiet
+            return True
+        except OSError:
+            return False
+        if data:
+            print(f'Dropping connection to {self.key[0]}:{self.key[1]}: it sent data nobody asked for')
+        else:
+            # An orderly close
+            self.sockf.eof = True
+        return False
+
+# Seconds to wait for an origin to accept a connection
+CONNECT_TIMEOUT = 5.0
+# Seconds an origin may go without sending anything, before its response or in
+# the middle of its body, before the request is given up on
+UPSTREAM_IDLE_TIMEOUT = 30.0
+
+# Pool of idle keep-alive connections, one list per (host, port)
+# maxIdle: Most idle connections kept per origin
+# idleTimeout: Seconds an idle connection is kept before it is closed
+# maxRequests: Requests sent on a connection before it is retired
+# connectTimeout: Seconds to wait for a new connection before giving up
+# resolver: DnsCache that origin host names are resolved with, or None to leave it to the event loop
+# readTimeout: Seconds a connection may wait on its origin while a request is under way
+class ConnectionPool:
+    def __init__(self, maxIdle=8, idleTimeout=30.0, maxRequests=100, connectTimeout=CONNECT_TIMEOUT, resolver=None,
+                 readTimeout=UPSTREAM_IDLE_TIMEOUT):
+        self.maxIdle = maxIdle
+        self.idleTimeout = idleTimeout
+        self.maxRequests = maxRequests
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.resolver = resolver
+        self.idle = {}
+
+    # Get a connection to an origin, reusing an idle one if a healthy one is available
+    # timer: RequestTimer to mark the 'dns' and 'connect' phases of a new connection on, or None
+    # Raises: OSError if the origin can't be resolved or connected to, TimeoutError after connectTimeout
+    # Returns: (UpstreamConnection, reused: bool)
+    async def acquire(self, hostname, portn, timer=None):
+        key = (hostname, portn)
+        conns = self.idle.get(key)
+        now = time.monotonic()
+        while conns:
+            # Most recently used first, it is the least likely to have been closed
+            conn = conns.pop()
+            if now - conn.idleSince < self.idleTimeout and conn.healthy():
+                return conn, True
+            conn.close()
+
+        address = key if self.resolver is None else await self.resolver.resolve_async(hostname, portn)
+        if timer is not None and self.resolver is not None:
+            timer.mark('dns')
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, address), self.connectTimeout)
+        except BaseException:
+            sock.close()
+            raise
+        if timer is not None:
+            timer.mark('connect')
+        return UpstreamConnection(key, sock, self.readTimeout), False
+
+    # Hand a connection back after a response has been read from it
+    # reusable: False if the response ended the connection or wasn't fully read
+    def release(self, conn, reusable):
+        conn.requests += 1
+        conns = self.idle.setdefault(conn.key, [])
+        if not reusable or conn.requests >= self.maxRequests or len(conns) >= self.maxIdle:
+            conn.close()
+            return
+        conn.idleSince = time.monotonic()
+        conns.append(conn)
+
+    # Close connections that have been idle for longer than idleTimeout
+    def reap(self):
+        cutoff = time.monotonic() - self.idleTimeout
+        for key in list(self.idle):
+            conns = self.idle[key]
+            for conn in conns:
+                if conn.idleSince < cutoff:
+                    conn.close()
+            conns[:] = [conn for conn in conns if conn.idleSince >= cutoff]
+            if not conns:
+                del self.idle[key]
+
+    # Reap idle connections every idleTimeout seconds, forever
+    async def reap_forever(self):
+        while True:
+            await asyncio.sleep(self.idleTimeout)
+            self.reap()
+
+    def close(self):
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.close()
+        self.idle.clear()
+
+# Remembers which origins are failing, per (host, port), so requests to a broken
+# origin fail at once instead of each waiting out a connect timeout
+# A connect failure opens the circuit straight away, for as long as the caller
+# says; failureThreshold server errors in a row open it for openTime seconds.
+# Once it has been open that long one trial request is let through: success
+# closes the circuit, failure opens it again
+# failureThreshold: Server errors in a row that open the circuit
+# openTime: Seconds the circuit stays open after them
+class CircuitBreaker:
+    def __init__(self, failureThreshold=5, openTime=10.0):
+        self.failureThreshold = failureThreshold
+        self.openTime = openTime
+        # key -> failures in a row
+        self.failures = {}
+        # key -> monotonic time the circuit is open until
+        self.openUntil = {}
+        # key -> monotonic time the trial request of a circuit was let through
+        self.trials = {}
+
+    # Check whether a request may be sent to an origin
+    # key: (hostname, portn)
+    # Returns: False while the circuit is open, or while its trial request is
+    #          still out, unless the trial has taken longer than openTime
+    def allow(self, key, now=None):
+        until = self.openUntil.get(key)
+        if until is None:
+            return True
+        now = time.monotonic() if now is None else now
+        if now < until or (key in self.trials and now - self.trials[key] < self.openTime):
+            return False
+        self.trials[key] = now
+        return True
+
+    # Record a response that wasn't a server error
+    def success(self, key):
+        self.failures.pop(key, None)
+        self.openUntil.pop(key, None)
+        self.trials.pop(key, None)
+
+    # Record a failed request
+    # key: (hostname, portn)
+    # openTime: Seconds to open the circuit for straight away, or None to only
+    #           open it for self.openTime after failureThreshold failures in a row
+    def failure(self, key, openTime=None, now=None):
+        failures = self.failures[key] = self.failures.get(key, 0) + 1
+        self.trials.pop(key, None)
+        if openTime is None:
+            # A failed trial reopens the circuit whatever the count
+            if failures < self.failureThreshold and key not in self.openUntil:
+                return
+            openTime = self.openTime
+        self.openUntil[key] = (time.monotonic() if now is None else now) + openTime
+
+    # 'closed', 'open' or 'half-open' (waiting for a trial request to be let through)
+    def state(self, key, now=None):
+        until = self.openUntil.get(key)
+        if until is None:
+            return 'closed'
+        return 'open' if (time.monotonic() if now is None else now) < until else 'half-open'
@@ -1,6 +1,18 @@
 from socket import *
 import threading
 import sys
+import os
+import signal
+import time
+
+# Seconds the clients being served get to finish when the server shuts down
+DRAIN_TIMEOUT = 10
+# Seconds past DRAIN_TIMEOUT preforkServer() waits for a worker to exit before killing it
+KILL_GRACE = 5
+
+# SIGTERM shuts the server down the same way Ctrl-C does
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
 
 def handle_client(connectionSocket):
     try:
@@ -34,13 +46,20 @@ def handle_client(connectionSocket):
         # Close client socket
         connectionSocket.close()
 
-def webServer(port=6789):
+# reusePort: Share the port with other processes listening on it, as the workers of preforkServer() do
+def webServer(port=6789, reusePort=False):
     serverSocket = socket(AF_INET, SOCK_STREAM)
+    # Allow a restarted server to bind while connections from the last run are in TIME_WAIT
+    serverSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reusePort:
+        serverSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     serverSocket.bind(('', port))
     # Allow up to 5 queued connections
     serverSocket.listen(5)
+    signal.signal(signal.SIGTERM, interrupt)
 
     thread_count = 0
+    client_threads = []
 
     try:
         while True:
@@ -50,14 +69,86 @@ def webServer(port=6789):
             client_thread = threading.Thread(target=handle_client, args=(connectionSocket,), name=f"ClientThread-{thread_count}")
             client_thread.daemon = True
             client_thread.start()
+            client_threads = [t for t in client_threads if t.is_alive()] + [client_thread]
 
             # Print the number of active threads
             print(f"Started thread {client_thread.name} for client {addr}")
     
     except KeyboardInterrupt:
         print("\nShutting down gracefully...")
+        # A second signal shouldn't cut the clients off
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         serverSocket.close()
+        # Let the clients being served finish
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        for client_thread in client_threads:
+            client_thread.join(max(0, deadline - time.monotonic()))
+        sys.exit(0)
+
+# A single process only ever runs one thread at a time because of the GIL, so
+# this runs webServer() in several forked worker processes instead, each
+# listening on the same port with SO_REUSEPORT so the kernel spreads the
+# connections over them. A worker that dies is restarted; on Ctrl-C or SIGTERM
+# every worker finishes its clients and the server exits, killing any worker
+# that is still running once it should have drained
+def preforkServer(port=6789, workers=os.cpu_count()):
+    # pid -> when the worker started
+    children = {}
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                webServer(port, reusePort=True)
+            finally:
+                os._exit(0)
+        children[pid] = time.monotonic()
+
+    for i in range(workers):
+        start_worker()
+    signal.signal(signal.SIGTERM, interrupt)
+
+    try:
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid)
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting it")
+            # Don't fork in a loop if workers die as soon as they start
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            start_worker()
+
+    except KeyboardInterrupt:
+        print("\nDraining workers...")
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + DRAIN_TIMEOUT + KILL_GRACE
+        while children and time.monotonic() < deadline:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.05)
+            else:
+                children.pop(pid, None)
+        for pid in children:
+            print(f"Killing worker {pid}, which did not drain in time")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
         sys.exit(0)
 
 if __name__ == "__main__":
-    webServer(6789)
+    # Usage: python multithreaded_server.py [port] [workers]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6789
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    if workers > 1:
+        preforkServer(port, workers)
+    else:
+        webServer(port)
@@ -10,6 +10,8 @@ def webServer(port=6789):
     serverSocket = socket(AF_INET, SOCK_STREAM)
 
     # Prepare a server socket
+    # Allow a restarted server to bind while connections from the last run are in TIME_WAIT
+    serverSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     serverSocket.bind(('', port))
     serverSocket.listen(1)
     try:
@@ -56,5 +58,6 @@ def webServer(port=6789):
         sys.exit(0)
 
 if __name__ == "__main__":
-    webServer(6789)
+    # Usage: python server.py [port]
+    webServer(int(sys.argv[1]) if len(sys.argv) > 1 else 6789)
             
\ No newline at end of file